@@ -1,4 +1,7 @@
 from .analyze import analyze
+from .reprocess import reprocess
+from .demix import get_demix_engine
+from .models import load_pretrained_model
 from .visualize import visualize
 from .sonify import sonify
 from .typings import AnalysisResult
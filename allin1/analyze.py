@@ -1,21 +1,27 @@
+import numpy as np
 import torch
 
-from typing import List, Union
+from typing import List, Optional, Union
 from tqdm import tqdm
-from .demix import demix
-from .spectrogram import extract_spectrograms
-from .models import load_pretrained_model
+from functools import partial
+from .artifacts import ArtifactStore, extract_spectrograms_cached
+from .demix import DEMUCS_MODEL, STEM_FORMATS, delete_stems, demix, separate_stems, stream_stems
+from .spectrogram import extract_spectrograms, extract_spectrograms_in_memory, extract_spectrograms_streaming
+from .models import load_pretrained_model, load_onnx_model, OnnxModel, INFERENCE_BACKENDS
 from .visualize import visualize as _visualize
 from .sonify import sonify as _sonify
 from .helpers import (
+  min_chunk_overlap,
   run_inference,
+  run_batch_inference,
   expand_paths,
   check_paths,
   rmdir_if_empty,
   save_results,
+  PRECISIONS,
 )
 from .utils import mkpath, load_result
-from .typings import AnalysisResult, PathLike
+from .typings import AnalysisResult, PathLike, TASKS
 
 
 def analyze(
@@ -23,15 +29,42 @@ def analyze(
   out_dir: PathLike = None,
   visualize: Union[bool, PathLike] = False,
   sonify: Union[bool, PathLike] = False,
-  model: str = 'harmonix-all',
+  model: Union[str, torch.nn.Module] = 'harmonix-all',
   device: str = 'cuda' if torch.cuda.is_available() else 'cpu',
   include_activations: bool = False,
   include_embeddings: bool = False,
+  tasks: Optional[List[str]] = None,
   demix_dir: PathLike = './demix',
+  demix_segment: Optional[float] = None,
+  demix_overlap: float = 0.25,
+  demix_shifts: int = 1,
+  demix_threads: Optional[int] = None,
+  demix_chunk_duration: Optional[float] = None,
+  stem_format: str = 'wav',
   spec_dir: PathLike = './spec',
+  logits_dir: Optional[PathLike] = None,
+  artifact_dir: Optional[PathLike] = None,
+  artifact_budget: Optional[float] = None,
   keep_byproducts: bool = False,
   overwrite: bool = False,
   multiprocess: bool = True,
+  ensemble_mode: str = 'serial',
+  ensemble_tolerance: float = 0.01,
+  quantize: Optional[str] = None,
+  attention_backend: Optional[str] = None,
+  compile_mode: Optional[str] = None,
+  compile_cache_dir: Optional[PathLike] = None,
+  fused: bool = False,
+  precision: Optional[str] = None,
+  backend: str = 'torch',
+  onnx_dir: Optional[PathLike] = None,
+  intra_op_threads: Optional[int] = None,
+  inter_op_threads: Optional[int] = None,
+  chunk_duration: Optional[float] = None,
+  chunk_overlap: Optional[float] = None,
+  chunk_batch_size: int = 1,
+  skip_silence: bool = False,
+  batch_size: int = 1,
 ) -> Union[AnalysisResult, List[AnalysisResult]]:
   """
   Analyzes the provided audio files and returns the analysis results.
@@ -48,25 +81,124 @@ def analyze(
   sonify : Union[bool, PathLike], optional
       Whether to sonify the analysis results or not. If a path is provided, the sonifications will be saved in that
       directory. Default is False. If True, the sonifications will be saved in './sonif'.
-  model : str, optional
+  model : Union[str, torch.nn.Module], optional
       Name of the pre-trained model to be used for the analysis. Default is 'harmonix-all'. Please refer to the
-      documentation for the available models.
+      documentation for the available models. An already-loaded model (e.g. from `load_pretrained_model`) can be
+      passed instead to skip loading the checkpoints on every call; it is used as is, so the options that choose how
+      to load a model (`ensemble_mode`, `quantize`, `attention_backend`, `compile_mode`, `fused` and `backend`)
+      must be left at their defaults and given to the loader instead.
   device : str, optional
       Device to be used for computation. Default is 'cuda' if available, otherwise 'cpu'.
   include_activations : bool, optional
       Whether to include activations in the analysis results or not.
   include_embeddings : bool, optional
       Whether to include embeddings in the analysis results or not.
+  tasks : Optional[List[str]], optional
+      Subset of 'beats' (beats, downbeats and BPM) and 'segments' (segment boundaries and labels) to compute. The
+      heads, activations and postprocessing of the other task are skipped and its fields left empty. Cannot be
+      combined with `visualize` or `sonify`. Default is None (all tasks).
   demix_dir : PathLike, optional
-      Path to the directory where the source-separated audio will be saved. Default is './demix'.
+      Path to the directory where the source-separated audio will be saved. HTDemucs runs in-process and is loaded
+      only once per process and device, so repeated calls reuse it. Default is './demix'.
+  demix_segment : Optional[float], optional
+      Length in seconds of the windows HTDemucs separates one at a time, at most 7.8. Default is None (7.8).
+  demix_overlap : float, optional
+      Overlap between the HTDemucs windows as a fraction of their length. Default is 0.25.
+  demix_shifts : int, optional
+      Number of randomly shifted separations HTDemucs averages (the "shift trick"); slower, slightly better. 0
+      separates once, without a shift. Default is 1, as in the demucs CLI.
+  demix_threads : Optional[int], optional
+      Number of torch threads used for source separation. torch's thread count is process-global, so this also
+      applies to any inference running concurrently in the same process (e.g. other threads of a server); only set
+      it when source separation has the process to itself. Default is None (torch's default).
+  demix_chunk_duration : Optional[float], optional
+      If given, tracks are decoded and separated in chunks of this many seconds, cross-faded over 2 seconds at
+      their boundaries, and the stems are passed on to the spectrograms (and written, with `keep_byproducts`) piece
+      by piece, so that memory no longer grows with the length of a track. Meant for very long inputs such as DJ
+      sets; the stems differ from whole-track separation only around the chunk boundaries. Default is None.
+  stem_format : str, optional
+      On-disk format of the stems kept with `keep_byproducts`: 'wav' (16-bit PCM), 'flac' (the same samples,
+      losslessly compressed to about half the size) or 'f16' (raw float16 with a JSON header; same size as 'wav'
+      but faster to read, and within a relative 2**-11 of the separated stems, where 'wav' is within 2**-16).
+      Results from 'wav' and 'flac' stems are identical; 'f16' only changes the spectrograms by the difference
+      between the two roundings. Default is 'wav'.
   spec_dir : PathLike, optional
       Path to the directory where the spectrograms will be saved. Default is './spec'.
+  logits_dir : Optional[PathLike], optional
+      If given, the logits of every analyzed track are saved there with the model config, so that the results can
+      be recomputed with different postprocessing settings by `allin1.reprocess` without running the model again.
+      Default is None.
+  artifact_dir : Optional[PathLike], optional
+      If given, spectrograms (and stems with `keep_byproducts`) are kept in a content-addressed store there, keyed by
+      the hash of the audio file and the demix and spectrogram settings, and reused by any later call, also for
+      copies of the same file under other names. The store can be shared by concurrent workers, and
+      `demix_dir`/`spec_dir` are not used. Default is None.
+  artifact_budget : Optional[float], optional
+      Disk budget of the artifact store in GB; the least recently used entries are evicted beyond it. Default is
+      None (unbounded).
   keep_byproducts : bool, optional
-      Whether to keep the source-separated audio and spectrograms or not. Default is False.
+      Whether to keep the source-separated audio and spectrograms or not. If False, the separated stems are passed
+      to the spectrogram extraction in memory and never written to disk. Default is False.
   overwrite : bool, optional
       Whether to overwrite the existing analysis results or not. Default is False.
   multiprocess : bool, optional
       Whether to use multiprocessing for spectrogram extraction, visualization, and sonification. Default is True.
+  ensemble_mode : str, optional
+      How the folds of an ensemble model are evaluated. 'serial' runs them one after another, 'batched' stacks their
+      parameters and runs all folds in one batched forward pass (faster, but uses more memory), and 'adaptive' runs
+      them one after another but stops once the averaged beat, downbeat and section probabilities have converged.
+      Default is 'serial'.
+  ensemble_tolerance : float, optional
+      Maximum change in any frame's probability from adding one more fold for the 'adaptive' ensemble mode to stop.
+      Default is 0.01.
+  quantize : Optional[str], optional
+      Set to 'int8' to run a dynamically quantized copy of the model, which is faster on CPU at a small accuracy cost
+      (see `python -m allin1.models.quantization` for a parity report). Only supported on CPU. Default is None.
+  attention_backend : Optional[str], optional
+      Neighborhood attention implementation: 'natten' or 'torch' (pure PyTorch, no natten needed). Default is None,
+      which uses natten if it is installed and 'torch' otherwise.
+  compile_mode : Optional[str], optional
+      Set to 'inductor' (`torch.compile`) or 'torchscript' (`torch.jit.trace`) to run a compiled model. Inputs are
+      not padded, so the results match the eager model up to float rounding, and the compiled artifacts are cached
+      on disk across runs. Default is None.
+  compile_cache_dir : PathLike, optional
+      Directory for the compiled artifacts. Default is None, which uses '~/.cache/allin1/compiled'.
+  fused : bool, optional
+      Whether to run the fused inference graph converted from the checkpoints: one QKV matmul shared by both
+      dilations of a layer, padding allocated once per forward pass, and the four heads as one linear layer. The
+      outputs match up to float rounding. Not supported with `ensemble_mode='batched'`. Default is False.
+  precision : Optional[str], optional
+      Set to 'bf16' or 'fp16' to run the encoder under autocast in reduced precision, which halves its memory traffic.
+      LayerNorms and the heads stay in fp32. 'bf16' is the one to use on CPU. Default is None (fp32).
+  backend : str, optional
+      Inference backend: 'torch' or 'onnxruntime'. With 'onnxruntime', the model runs from an ONNX export in
+      `onnx_dir`, which is created on first use (see `python -m allin1.models.export`). `model` can also be a path
+      to an .onnx file. Cannot be combined with `quantize` or `compile_mode`. Default is 'torch'.
+  onnx_dir : PathLike, optional
+      Directory of the exported ONNX models. Default is None, which uses '~/.cache/allin1/onnx'.
+  intra_op_threads : Optional[int], optional
+      Number of threads onnxruntime uses within an operator. Default is None (onnxruntime's default).
+  inter_op_threads : Optional[int], optional
+      Number of threads onnxruntime uses to run independent operators in parallel. Default is None (sequential).
+  chunk_duration : Optional[float], optional
+      If given, runs the model over overlapping windows of this many seconds and takes every frame from the window
+      in which it lies furthest from an edge, which bounds peak memory for long tracks such as DJ mixes. The results
+      equal those of the whole track up to float rounding. Must be longer than the overlap (about 165 seconds for the
+      pretrained models). Default is None (the whole track at once).
+  chunk_overlap : Optional[float], optional
+      Overlap between neighboring windows in seconds, at least the model's receptive field on each side. Default is
+      None, which uses that minimum.
+  chunk_batch_size : int, optional
+      Number of windows run through the model together. Default is 1.
+  skip_silence : bool, optional
+      Whether to skip silent spans of 10 seconds or more (60 dB below the loudest part of the track, found from the
+      spectrograms) and run the model only on the rest, with 2 seconds of context on each side. Skipped frames get no
+      beats or boundaries. Cannot be combined with `batch_size`. Default is False.
+  batch_size : int, optional
+      Number of tracks run through the model together. Tracks are grouped by length and zero-padded, and padded
+      frames are masked out before postprocessing. The padding is still seen by the model: the results for the last
+      ~82 seconds (one receptive field) of every track but the longest in its group differ from batch_size=1.
+      Cannot be combined with `chunk_duration`. Default is 1.
 
   Returns
   -------
@@ -81,6 +213,47 @@ def analyze(
     paths = [paths]
   if not paths:
     raise ValueError('At least one path must be specified.')
+  if batch_size > 1 and chunk_duration is not None:
+    raise ValueError('Batched inference (batch_size > 1) cannot be combined with chunked inference.')
+  if batch_size > 1 and skip_silence:
+    raise ValueError('Batched inference (batch_size > 1) cannot be combined with skip_silence.')
+  if backend not in INFERENCE_BACKENDS:
+    raise ValueError(f'Unknown backend: {backend} (expected one of {INFERENCE_BACKENDS})')
+  if backend == 'onnxruntime' and (quantize is not None or compile_mode is not None):
+    raise ValueError('The onnxruntime backend cannot be combined with quantize or compile_mode.')
+  if not isinstance(model, str):
+    # An already-loaded model is used as is: the options that pick how to load one cannot apply to it.
+    loading_options = dict(
+      ensemble_mode=ensemble_mode != 'serial',
+      quantize=quantize is not None,
+      attention_backend=attention_backend is not None,
+      compile_mode=compile_mode is not None,
+      fused=fused,
+      backend=(backend == 'onnxruntime') != isinstance(model, OnnxModel),
+    )
+    conflicts = [name for name, conflict in loading_options.items() if conflict]
+    if conflicts:
+      raise ValueError(
+        f'{", ".join(conflicts)} cannot be combined with an already-loaded model; pass them to '
+        f'load_pretrained_model (or load_onnx_model) instead.'
+      )
+  if tasks is not None:
+    if isinstance(tasks, str):
+      tasks = [tasks]
+    unknown_tasks = set(tasks) - set(TASKS)
+    if unknown_tasks or not tasks:
+      raise ValueError(f'Unknown tasks: {sorted(unknown_tasks)} (expected a subset of {TASKS})')
+    if (visualize or sonify) and set(tasks) != set(TASKS):
+      raise ValueError('Visualization and sonification need all tasks.')
+  if precision not in [None, *PRECISIONS]:
+    raise ValueError(f'Unknown precision: {precision} (expected one of {PRECISIONS})')
+  if stem_format not in STEM_FORMATS:
+    raise ValueError(f'Unknown stem format: {stem_format} (expected one of {STEM_FORMATS})')
+  if precision not in [None, 'fp32'] and (quantize is not None or backend != 'torch'):
+    raise ValueError('Reduced precision requires the torch backend and cannot be combined with quantize.')
+  if precision not in [None, 'fp32'] and attention_backend is None and torch.device(device).type == 'cpu':
+    # natten's CPU kernels only take fp32 inputs.
+    attention_backend = 'torch'
   paths = [mkpath(p) for p in paths]
   paths = expand_paths(paths)
   check_paths(paths)
@@ -115,38 +288,130 @@ def analyze(
   # Analyze the tracks that are not analyzed yet.
   if todo_paths:
     # Run HTDemucs for source separation only for the tracks that are not analyzed yet.
-    demix_paths = demix(todo_paths, demix_dir, device)
+    demix_options = dict(segment=demix_segment, overlap=demix_overlap, shifts=demix_shifts, num_threads=demix_threads)
+    if artifact_dir is not None:
+      max_bytes = int(artifact_budget * 1e9) if artifact_budget is not None else None
+      store = ArtifactStore(artifact_dir, max_bytes=max_bytes)
+      spec_paths, demix_paths = extract_spectrograms_cached(
+        todo_paths, store, demix_dir, device,
+        keep_stems=keep_byproducts,
+        demix_options=demix_options,
+        stem_format=stem_format,
+        chunk_duration=demix_chunk_duration,
+      )
+    elif demix_chunk_duration is not None:
+      # HTDemucs runs chunk by chunk, and the stems go to the spectrograms (and to disk) piece by piece.
+      separate_stream = partial(
+        stream_stems, demix_dir=demix_dir, device=device, chunk_duration=demix_chunk_duration, **demix_options,
+      )
+      spec_paths, demix_paths = extract_spectrograms_streaming(
+        todo_paths, spec_dir, separate_stream,
+        stems_dir=demix_dir / DEMUCS_MODEL if keep_byproducts else None,
+        stem_format=stem_format,
+      )
+    elif keep_byproducts:
+      demix_paths = demix(todo_paths, demix_dir, device, stem_format=stem_format, **demix_options)
 
-    # Extract spectrograms for the tracks that are not analyzed yet.
-    spec_paths = extract_spectrograms(demix_paths, spec_dir, multiprocess)
+      # Extract spectrograms for the tracks that are not analyzed yet.
+      spec_paths = extract_spectrograms(demix_paths, spec_dir, multiprocess)
+    else:
+      # The stems are not kept, so they go straight from HTDemucs to the spectrograms without any WAV files.
+      demix_paths = []
+      spec_paths = extract_spectrograms_in_memory(
+        todo_paths, spec_dir,
+        partial(separate_stems, demix_dir=demix_dir, device=device, **demix_options),
+      )
 
-    # Load the model.
-    model = load_pretrained_model(
-      model_name=model,
-      device=device,
-    )
+    # Load the model unless an already-loaded one was given.
+    if isinstance(model, str) and backend == 'onnxruntime':
+      model = load_onnx_model(
+        model_name=model,
+        onnx_dir=onnx_dir,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+      )
+    elif isinstance(model, str):
+      model = load_pretrained_model(
+        model_name=model,
+        device=device,
+        ensemble_mode=ensemble_mode,
+        ensemble_tolerance=ensemble_tolerance,
+        quantize=quantize,
+        attention_backend=attention_backend,
+        compile_mode=compile_mode,
+        compile_cache_dir=compile_cache_dir,
+        fused=fused,
+      )
 
-    with torch.no_grad():
-      pbar = tqdm(zip(todo_paths, spec_paths), total=len(todo_paths))
-      for path, spec_path in pbar:
-        pbar.set_description(f'Analyzing {path.name}')
-
-        result = run_inference(
-          path=path,
-          spec_path=spec_path,
-          model=model,
-          device=device,
-          include_activations=include_activations,
-          include_embeddings=include_embeddings,
+    fps = model.cfg.fps
+    chunk_size = round(chunk_duration * fps) if chunk_duration is not None else None
+    chunk_overlap_frames = round(chunk_overlap * fps) if chunk_overlap is not None else None
+    if chunk_size is not None:
+      min_overlap = min_chunk_overlap(model.cfg)
+      if not min_overlap <= (chunk_overlap_frames or min_overlap) < chunk_size:
+        raise ValueError(
+          f'chunk_overlap must be at least {min_overlap / fps:.2f} seconds (the receptive field on each side) and '
+          f'chunk_duration longer than the overlap.'
         )
 
+    # Group tracks of similar length so that little padding is needed.
+    if batch_size > 1:
+      lengths = [np.load(spec_path, mmap_mode='r').shape[1] for spec_path in spec_paths]
+      order = sorted(range(len(todo_paths)), key=lambda i: lengths[i])
+      groups = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    else:
+      groups = [[i] for i in range(len(todo_paths))]
+
+    with torch.no_grad():
+      pbar = tqdm(groups)
+      for group in pbar:
+        pbar.set_description(f'Analyzing {", ".join(todo_paths[i].name for i in group)}')
+
+        if batch_size > 1:
+          group_results = run_batch_inference(
+            paths=[todo_paths[i] for i in group],
+            spec_paths=[spec_paths[i] for i in group],
+            model=model,
+            device=device,
+            include_activations=include_activations,
+            include_embeddings=include_embeddings,
+            precision=precision,
+            tasks=tasks,
+            logits_dir=logits_dir,
+          )
+        else:
+          group_results = [
+            run_inference(
+              path=todo_paths[i],
+              spec_path=spec_paths[i],
+              model=model,
+              device=device,
+              include_activations=include_activations,
+              include_embeddings=include_embeddings,
+              chunk_size=chunk_size,
+              chunk_overlap=chunk_overlap_frames,
+              chunk_batch_size=chunk_batch_size,
+              precision=precision,
+              tasks=tasks,
+              skip_silence=skip_silence,
+              logits_dir=logits_dir,
+            )
+            for i in group
+          ]
+
         # Save the result right after the inference.
         # Checkpointing is always important for this kind of long-running tasks...
         # for my mental health...
         if out_dir is not None:
-          save_results(result, out_dir)
+          save_results(group_results, out_dir)
+
+        results += group_results
+        if artifact_dir is not None:
+          for i in group:
+            store.unpin(spec_paths[i].parent)
 
-        results.append(result)
+    if artifact_dir is not None:
+      store.evict()
 
   # Sort the results by the original order of the tracks.
   results = sorted(results, key=lambda result: paths.index(result.path))
@@ -163,10 +428,10 @@ def analyze(
     _sonify(results, out_dir=sonify, multiprocess=multiprocess)
     print(f'=> Sonified tracks are successfully saved to {sonify}')
 
-  if not keep_byproducts:
+  # Files in the artifact store are left to its eviction policy.
+  if not keep_byproducts and artifact_dir is None:
     for path in demix_paths:
-      for stem in ['bass', 'drums', 'other', 'vocals']:
-        (path / f'{stem}.wav').unlink(missing_ok=True)
+      delete_stems(path)
       rmdir_if_empty(path)
     rmdir_if_empty(demix_dir / 'htdemucs')
     rmdir_if_empty(demix_dir)
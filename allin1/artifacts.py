@@ -0,0 +1,275 @@
+"""Content-addressed store for demixed stems and spectrograms.
+
+Artifacts are keyed by the SHA-256 of the audio file's bytes and the config of the stage that produced them (the
+demucs model and settings for stems; those plus the frontend parameters for spectrograms), so tracks with the same
+name in different folders no longer collide, identical files are computed once, and changing a frontend parameter
+never returns a stale spectrogram. Each entry is a directory:
+
+  <root>/<stage>/<key[:2]>/<key>/{files, meta.json}
+
+Entries are written into a temporary directory and renamed into place, so concurrent workers sharing the store
+never see partial entries; if two workers compute the same entry, the first rename wins. Keys hash the bytes of the
+audio file, so a re-encoded or retagged copy of a track is a different entry.
+
+`get` and `put` touch the entry directory, so its modification time records its last use (atime is not relied on:
+noatime and relatime mounts do not keep it), and the least recently used entries are evicted once the store exceeds
+its disk budget. The sizes and last uses of the entries are read from disk once and then kept in memory, re-read
+every `EVICTION_GRACE` seconds to pick up what other processes stored or removed. Entries pinned by this store
+(those a later step of the run still needs, see `pin`) and entries used by any process within the last
+`EVICTION_GRACE` seconds are never evicted. Nothing else protects entries other processes are reading: a process
+that holds on to an entry for longer than the grace period without getting it again may see it removed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import torch
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from tqdm import tqdm
+from .demix import DEMUCS_MODEL, StemWriter, save_stems, separate_stems, stream_stems
+from .spectrogram import SPECTROGRAM_CONFIG, make_processor, spectrogram_from_files, spectrogram_from_stems
+from .spectrogram import spectrogram_from_stream
+from .typings import PathLike
+from .utils import mkpath
+
+DEFAULT_ARTIFACT_DIR = '~/.cache/allin1/artifacts'
+META_FILE = 'meta.json'
+STAGES = ['demix', 'spec']
+EVICTION_GRACE = 600.  # seconds
+
+_AUDIO_HASHES = {}
+
+
+def read_size(entry_dir: Path) -> Optional[int]:
+  """Size of an entry's files as recorded in its meta file, or None if the entry is gone or incomplete."""
+  try:
+    return json.loads((entry_dir / META_FILE).read_text())['size']
+  except (FileNotFoundError, json.JSONDecodeError, KeyError):
+    return None
+
+
+def hash_audio(path: Path) -> str:
+  """SHA-256 of the file's bytes, cached per (path, size, mtime) within the process."""
+  stat = path.stat()
+  cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+  if cache_key not in _AUDIO_HASHES:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+    _AUDIO_HASHES[cache_key] = h.hexdigest()
+  return _AUDIO_HASHES[cache_key]
+
+
+class ArtifactStore:
+  def __init__(self, root: Optional[PathLike] = None, max_bytes: Optional[int] = None):
+    self.root = mkpath(root or DEFAULT_ARTIFACT_DIR)
+    self.max_bytes = max_bytes
+    self.pinned = set()
+    self.tmp_dir = self.root / 'tmp'
+    self.tmp_dir.mkdir(parents=True, exist_ok=True)
+    # Entry directory -> (last use, size), least recently used first, and the sum of the sizes.
+    self._index: Optional[OrderedDict] = None
+    self._total = 0
+    self._scanned = 0.
+
+  @staticmethod
+  def key(audio_hash: str, stage: str, config: Dict) -> str:
+    assert stage in STAGES, f'Unknown stage: {stage} (expected one of {STAGES})'
+    payload = json.dumps({'audio': audio_hash, 'stage': stage, 'config': config}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+  def entry_dir(self, stage: str, key: str) -> Path:
+    return self.root / stage / key[:2] / key
+
+  def get(self, stage: str, key: str) -> Optional[Path]:
+    """Returns the entry directory if it exists, marking it as recently used."""
+    entry_dir = self.entry_dir(stage, key)
+    if not (entry_dir / META_FILE).is_file():
+      return None
+    now = time.time()
+    try:
+      os.utime(entry_dir, (now, now))
+    except FileNotFoundError:  # evicted by another worker in the meantime
+      return None
+    self._record(entry_dir, now)
+    return entry_dir
+
+  def pin(self, entry_dir: Path):
+    """Protects an entry from eviction by this store until it is unpinned."""
+    self.pinned.add(entry_dir)
+
+  def unpin(self, entry_dir: Path):
+    self.pinned.discard(entry_dir)
+
+  def put(self, stage: str, key: str, write: Callable[[Path], None], meta: Optional[Dict] = None) -> Path:
+    """Creates an entry by calling `write(directory)` on a temporary directory, then moves it into place."""
+    entry_dir = self.entry_dir(stage, key)
+    tmp_dir = self.tmp_dir / f'{key}-{uuid.uuid4().hex}'
+    tmp_dir.mkdir(parents=True)
+    try:
+      write(tmp_dir)
+      size = sum(f.stat().st_size for f in tmp_dir.iterdir())
+      meta = dict(meta or {}, stage=stage, key=key, size=size, created=time.time())
+      (tmp_dir / META_FILE).write_text(json.dumps(meta, indent=2))
+      entry_dir.parent.mkdir(parents=True, exist_ok=True)
+      try:
+        os.rename(tmp_dir, entry_dir)
+      except OSError:
+        if not (entry_dir / META_FILE).is_file():
+          raise
+        # Another worker stored the same entry first; keep theirs.
+    finally:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    now = time.time()
+    os.utime(entry_dir, (now, now))
+    self._record(entry_dir, now, size)
+    if self.max_bytes is not None:
+      self.evict()
+    return entry_dir
+
+  def entries(self) -> List[Tuple[float, int, Path]]:
+    """(last use, size, directory) of every entry, read from disk."""
+    entries = []
+    for stage in STAGES:
+      for meta_path in (self.root / stage).glob(f'*/*/{META_FILE}'):
+        entry_dir = meta_path.parent
+        size = read_size(entry_dir)
+        try:
+          last_use = entry_dir.stat().st_mtime
+        except FileNotFoundError:
+          continue
+        if size is not None:
+          entries.append((last_use, size, entry_dir))
+    return entries
+
+  def _record(self, entry_dir: Path, last_use: float, size: Optional[int] = None):
+    """Moves an entry to the most recently used end of the index."""
+    if self._index is None:
+      return
+    if entry_dir in self._index:
+      old_size = self._index.pop(entry_dir)[1]
+      self._total -= old_size
+      size = old_size if size is None else size
+    elif size is None:
+      # Stored by another process since the index was read.
+      size = read_size(entry_dir)
+      if size is None:
+        return
+    self._index[entry_dir] = (last_use, size)
+    self._total += size
+
+  def evict(self) -> int:
+    """Removes the least recently used entries until the store fits its budget. Returns the bytes freed."""
+    if self.max_bytes is None:
+      return 0
+    now = time.time()
+    if self._index is None or now - self._scanned > EVICTION_GRACE:
+      self._index = OrderedDict((entry_dir, (last_use, size)) for last_use, size, entry_dir in sorted(self.entries()))
+      self._total = sum(size for _, size in self._index.values())
+      self._scanned = now
+
+    freed = 0
+    for entry_dir, (last_use, size) in list(self._index.items()):
+      if self._total <= self.max_bytes or last_use >= now - EVICTION_GRACE:
+        break
+      if entry_dir in self.pinned:
+        continue
+      try:
+        last_use = entry_dir.stat().st_mtime
+      except FileNotFoundError:  # evicted by another worker
+        last_use = None
+      if last_use is not None and last_use >= now - EVICTION_GRACE:
+        # Used by another process since the index was read.
+        self._record(entry_dir, last_use)
+        continue
+      if last_use is not None:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        freed += size
+      del self._index[entry_dir]
+      self._total -= size
+    return freed
+
+
+def extract_spectrograms_cached(
+  paths: List[Path],
+  store: ArtifactStore,
+  demix_dir: Path,
+  device: Union[str, torch.device],
+  keep_stems: bool = False,
+  demix_options: Optional[Dict] = None,
+  stem_format: str = 'wav',
+  chunk_duration: Optional[float] = None,
+) -> Tuple[List[Path], List[Path]]:
+  """
+  Returns the spectrogram file of every track, and the directory of its stems (saved in `stem_format`) if
+  `keep_stems`, demixing and extracting only what the store does not hold yet. Without `keep_stems`, the stems stay
+  in memory. With `chunk_duration`, tracks are separated in chunks of that many seconds and their stems streamed
+  to the spectrogram and the stem files (see `DemixEngine.separate_stream`). The spectrogram entries are pinned in
+  the store until the caller unpins them, and the stems only until their track's spectrogram is stored.
+  """
+  demix_options = demix_options or {}
+  # The thread count does not change the stems.
+  demix_config = dict(model=DEMUCS_MODEL, **{k: v for k, v in demix_options.items() if k != 'num_threads'})
+  if chunk_duration is not None:
+    demix_config['chunk_duration'] = chunk_duration
+  if keep_stems:
+    demix_config['stem_format'] = stem_format
+  spec_config = dict(demix=demix_config, frontend=SPECTROGRAM_CONFIG)
+  processor = None
+
+  spec_paths, demix_paths = [], []
+  for path in tqdm(paths, desc='Demixing and extracting spectrograms'):
+    audio_hash = hash_audio(path)
+    meta = dict(source=str(path), audio_sha256=audio_hash)
+
+    stems_dir, streamed_spec = None, None
+    if keep_stems:
+      demix_key = store.key(audio_hash, 'demix', demix_config)
+      stems_dir = store.get('demix', demix_key)
+      if stems_dir is None:
+        def write_stems(directory: Path):
+          nonlocal streamed_spec
+          if chunk_duration is not None:
+            # The spectrogram is computed on the way, so that the stems are never read back whole.
+            pieces, sample_rate = stream_stems(path, demix_dir, device, chunk_duration, **demix_options)
+            writer = StemWriter(directory, sample_rate, stem_format)
+            streamed_spec = spectrogram_from_stream(pieces, sample_rate, writer)
+          else:
+            stems, sample_rate = separate_stems(path, demix_dir, device, **demix_options)
+            save_stems(stems, directory, sample_rate, stem_format)
+        stems_dir = store.put('demix', demix_key, write_stems, dict(meta, config=demix_config))
+      store.pin(stems_dir)
+      demix_paths.append(stems_dir)
+
+    spec_key = store.key(audio_hash, 'spec', spec_config)
+    entry_dir = store.get('spec', spec_key)
+    if entry_dir is None:
+      processor = processor or make_processor()
+
+      def write_spec(directory: Path):
+        if streamed_spec is not None:
+          spec = streamed_spec
+        elif stems_dir is not None:
+          spec = spectrogram_from_files(stems_dir, processor)
+        elif chunk_duration is not None:
+          spec = spectrogram_from_stream(*stream_stems(path, demix_dir, device, chunk_duration, **demix_options))
+        else:
+          stems, sample_rate = separate_stems(path, demix_dir, device, **demix_options)
+          spec = spectrogram_from_stems(stems, sample_rate, processor)
+        np.save(str(directory / 'spec.npy'), spec)
+      entry_dir = store.put('spec', spec_key, write_spec, dict(meta, config=spec_config))
+    store.pin(entry_dir)
+    if stems_dir is not None:
+      store.unpin(stems_dir)
+    spec_paths.append(entry_dir / 'spec.npy')
+
+  return spec_paths, demix_paths
@@ -3,6 +3,7 @@ import torch
 
 from pathlib import Path
 from .analyze import analyze
+from .demix import STEM_FORMATS
 
 
 def make_parser():
@@ -23,16 +24,71 @@ def make_parser():
                       help='Save frame-level raw activations from sigmoid and softmax (default: False)')
   parser.add_argument('-e', '--embed', action='store_true',
                       help='Save frame-level embeddings (default: False)')
+  parser.add_argument('--tasks', type=str, nargs='+', default=None, choices=['beats', 'segments'],
+                      help='Tasks to compute; the others are skipped (default: all)')
   parser.add_argument('-m', '--model', type=str, default='harmonix-all',
                       help='Name of the pretrained model to use (default: harmonix-all)')
+  parser.add_argument('--ensemble-mode', type=str, default='serial', choices=['serial', 'batched', 'adaptive'],
+                      help='How to evaluate the folds of an ensemble model (default: serial)')
+  parser.add_argument('--ensemble-tolerance', type=float, default=0.01,
+                      help='Probability tolerance at which the adaptive ensemble mode stops adding folds (default: 0.01)')
+  parser.add_argument('--quantize', type=str, default=None, choices=['int8'],
+                      help='Run a dynamically quantized model on CPU (default: None)')
+  parser.add_argument('--attention-backend', type=str, default=None, choices=['natten', 'torch'],
+                      help='Neighborhood attention implementation (default: natten if installed else torch)')
+  parser.add_argument('--compile', type=str, default=None, choices=['inductor', 'torchscript'],
+                      help='Run a compiled model, cached on disk (default: off)')
+  parser.add_argument('--compile-cache-dir', type=Path, default=None,
+                      help='Directory for compiled artifacts (default: ~/.cache/allin1/compiled)')
+  parser.add_argument('--fused', action='store_true', default=False,
+                      help='Run the fused inference graph (default: False)')
+  parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'bf16', 'fp16'],
+                      help='Run the encoder under reduced-precision autocast (default: fp32)')
+  parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'],
+                      help='Inference backend (default: torch)')
+  parser.add_argument('--onnx-dir', type=Path, default=None,
+                      help='Directory of exported ONNX models (default: ~/.cache/allin1/onnx)')
+  parser.add_argument('--intra-op-threads', type=int, default=None,
+                      help='onnxruntime threads within an operator (default: onnxruntime default)')
+  parser.add_argument('--inter-op-threads', type=int, default=None,
+                      help='onnxruntime threads across independent operators (default: sequential)')
+  parser.add_argument('--chunk-duration', type=float, default=None,
+                      help='Run the model over overlapping windows of this many seconds to bound memory (default: off)')
+  parser.add_argument('--chunk-overlap', type=float, default=None,
+                      help='Window overlap in seconds, at least one receptive field per side (default: that minimum)')
+  parser.add_argument('--chunk-batch-size', type=int, default=1,
+                      help='Number of windows run through the model together (default: 1)')
+  parser.add_argument('--skip-silence', action='store_true',
+                      help='Run the model only on the non-silent parts of each track (default: False)')
+  parser.add_argument('-b', '--batch-size', type=int, default=1,
+                      help='Number of tracks run through the model together; zero-padding changes the results '
+                           'for the last ~82 s of all but the longest track in a batch (default: 1)')
   parser.add_argument('-d', '--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
                       help='Device to use (default: cuda if available else cpu)')
   parser.add_argument('-k', '--keep-byproducts', action='store_true',
                       help='Keep demixed audio files and spectrograms (default: False)')
   parser.add_argument('--demix-dir', type=Path, default=cwd / 'demix',
                       help='Path to a directory to store demixed tracks (default: ./demix)')
+  parser.add_argument('--demix-segment', type=float, default=None,
+                      help='Length of the windows HTDemucs separates, in seconds, at most 7.8 (default: 7.8)')
+  parser.add_argument('--demix-overlap', type=float, default=0.25,
+                      help='Overlap between the HTDemucs windows as a fraction of their length (default: 0.25)')
+  parser.add_argument('--demix-shifts', type=int, default=1,
+                      help='Number of random shifts HTDemucs averages over (default: 1)')
+  parser.add_argument('--demix-threads', type=int, default=None,
+                      help='Number of torch threads (process-wide) while separating sources (default: torch default)')
+  parser.add_argument('--demix-chunk-duration', type=float, default=None,
+                      help='Separate and stream long tracks in chunks of this many seconds (default: whole tracks)')
+  parser.add_argument('--stem-format', type=str, default='wav', choices=STEM_FORMATS,
+                      help='Format of kept stems: 16-bit wav, lossless flac or raw float16 f16 (default: wav)')
   parser.add_argument('--spec-dir', type=Path, default=cwd / 'spec',
                       help='Path to a directory to store spectrograms (default: ./spec)')
+  parser.add_argument('--artifact-dir', type=Path, default=None,
+                      help='Path to a content-addressed store of stems and spectrograms to reuse (default: None)')
+  parser.add_argument('--artifact-budget', type=float, default=None,
+                      help='Disk budget of the artifact store in GB (default: unbounded)')
+  parser.add_argument('--logits-dir', type=Path, default=None,
+                      help='Path to a directory to cache logits for `python -m allin1.reprocess` (default: None)')
   parser.add_argument('--overwrite', action='store_true', default=False,
                       help='Overwrite existing files (default: False)')
   parser.add_argument('--no-multiprocess', action='store_true', default=False,
@@ -59,11 +115,38 @@ def main():
     device=args.device,
     include_activations=args.activ,
     include_embeddings=args.embed,
+    tasks=args.tasks,
     demix_dir=args.demix_dir,
+    demix_segment=args.demix_segment,
+    demix_overlap=args.demix_overlap,
+    demix_shifts=args.demix_shifts,
+    demix_threads=args.demix_threads,
+    demix_chunk_duration=args.demix_chunk_duration,
+    stem_format=args.stem_format,
     spec_dir=args.spec_dir,
+    logits_dir=args.logits_dir,
+    artifact_dir=args.artifact_dir,
+    artifact_budget=args.artifact_budget,
     keep_byproducts=args.keep_byproducts,
     overwrite=args.overwrite,
     multiprocess=not args.no_multiprocess,
+    ensemble_mode=args.ensemble_mode,
+    ensemble_tolerance=args.ensemble_tolerance,
+    quantize=args.quantize,
+    attention_backend=args.attention_backend,
+    compile_mode=args.compile,
+    compile_cache_dir=args.compile_cache_dir,
+    fused=args.fused,
+    precision=args.precision,
+    backend=args.backend,
+    onnx_dir=args.onnx_dir,
+    intra_op_threads=args.intra_op_threads,
+    inter_op_threads=args.inter_op_threads,
+    chunk_duration=args.chunk_duration,
+    chunk_overlap=args.chunk_overlap,
+    chunk_batch_size=args.chunk_batch_size,
+    skip_silence=args.skip_silence,
+    batch_size=args.batch_size,
   )
 
   print(f'=> Analysis results are successfully saved to {args.out_dir}')
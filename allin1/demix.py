@@ -1,49 +1,400 @@
-import sys
+import json
 import subprocess
+import threading
+import wave
+import numpy as np
 import torch
 
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from tqdm import tqdm
 
+DEMUCS_MODEL = 'htdemucs'
+STEMS = ['bass', 'drums', 'other', 'vocals']
+# On-disk formats of kept stems, as file extensions:
+#   'wav'  16-bit PCM, what `python -m demucs.separate` writes.
+#   'flac' the same 16-bit samples, losslessly compressed to about half the size; spectrograms are identical to 'wav'.
+#   'f16'  raw little-endian float16 samples (channels, samples) with a JSON header `<stem>.f16.json`. Same size as
+#          'wav' but read with a single memory copy instead of a decoder, and not quantized to 16-bit integers: each
+#          sample is within a relative 2**-11 (2**-24 absolute near silence) of the separated float stem, where 'wav'
+#          is within 2**-16 absolute. Spectrograms differ from those of 'wav' by the difference of the two roundings.
+STEM_FORMATS = ['wav', 'flac', 'f16']
+# Chunk and cross-fade lengths in seconds of the streaming separation (`DemixEngine.separate_stream`).
+DEMIX_CHUNK_DURATION = 60.
+DEMIX_CROSSFADE = 2.
 
-def demix(paths: List[Path], demix_dir: Path, device: Union[str, torch.device]):
-  """Demixes the audio file into its sources."""
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+class DemixEngine:
+  """
+  Keeps a demucs model loaded and separates tracks in-process, with the same normalization and output as
+  `python -m demucs.separate`. Use `get_demix_engine` to share one engine per model, repo and device.
+  """
+
+  def __init__(
+    self,
+    model_name: str = DEMUCS_MODEL,
+    repo: Optional[Path] = None,
+    device: Union[str, torch.device] = 'cpu',
+  ):
+    from demucs.pretrained import get_model
+
+    self.model_name = model_name
+    self.device = torch.device(device)
+    self.model = get_model(model_name, repo=repo).to(self.device).eval()
+    self.samplerate = self.model.samplerate
+    self.lock = threading.Lock()
+
+  def separate(
+    self,
+    path: Path,
+    segment: Optional[float] = None,
+    overlap: float = 0.25,
+    shifts: int = 1,
+    num_threads: Optional[int] = None,
+  ) -> Dict[str, torch.Tensor]:
+    """
+    Returns the stems of an audio file as (channels, samples) float tensors at `samplerate`. `segment` (seconds,
+    at most the model's training segment), `overlap` and `shifts` are those of demucs; `num_threads` sets the torch
+    threads for this call. torch's thread count is process-global, so it also applies to any other inference running
+    in the process meanwhile: only set it when nothing else runs concurrently.
+    """
+    from demucs.separate import load_track
+
+    wav = load_track(path, self.model.audio_channels, self.samplerate)
+    ref = wav.mean(0)
+    mean, std = ref.mean(), ref.std()
+    sources = self._apply((wav - mean) / std, segment, overlap, shifts, num_threads) * std + mean
+    return {name: source for name, source in zip(self.model.sources, sources) if name in STEMS}
+
+  def separate_stream(
+    self,
+    path: Path,
+    chunk_duration: float = DEMIX_CHUNK_DURATION,
+    crossfade: float = DEMIX_CROSSFADE,
+    segment: Optional[float] = None,
+    overlap: float = 0.25,
+    shifts: int = 1,
+    num_threads: Optional[int] = None,
+  ) -> Iterator[Dict[str, torch.Tensor]]:
+    """
+    Like `separate`, but decodes and separates the track in chunks of `chunk_duration` seconds overlapping by
+    `crossfade` seconds, and yields the stems in consecutive pieces as soon as they are final, so that memory is
+    bounded by the chunk length instead of the track length. The overlaps of consecutive chunks are blended with a
+    linear cross-fade. The track is normalized like in `separate`, with statistics gathered in a first decoding pass.
+    A track no longer than one chunk gives the stems of `separate` (up to float rounding) in a single piece.
+    """
+    chunk_size = int(chunk_duration * self.samplerate)
+    fade_size = int(crossfade * self.samplerate)
+    if not 0 < fade_size < chunk_size:
+      raise ValueError(f'The crossfade ({crossfade}s) must be positive and shorter than a chunk ({chunk_duration}s).')
+    hop_size = chunk_size - fade_size
+
+    # Mean and std of the mono mix over the whole track, accumulated in float64 over hours of audio.
+    total, total_sq, count = 0., 0., 0
+    for block in _read_blocks(path, self.model.audio_channels, self.samplerate, chunk_size):
+      ref = block.mean(0).double()
+      total, total_sq, count = total + ref.sum().item(), total_sq + ref.square().sum().item(), count + len(ref)
+    mean = total / count
+    std = ((total_sq - count * mean ** 2) / max(count - 1, 1)) ** 0.5
+
+    fade_in = (torch.arange(fade_size) + 0.5) / fade_size
+    blocks = _read_blocks(path, self.model.audio_channels, self.samplerate, hop_size)
+    buffer = torch.zeros(self.model.audio_channels, 0)
+    tail, eof = None, False
+    while True:
+      while not eof and buffer.shape[-1] < chunk_size:
+        block = next(blocks, None)
+        eof = block is None
+        if not eof:
+          buffer = torch.cat([buffer, block], dim=-1)
+      last = eof and buffer.shape[-1] <= chunk_size
+
+      sources = self._apply((buffer[:, :chunk_size] - mean) / std, segment, overlap, shifts, num_threads) * std + mean
+      if tail is not None:
+        sources[..., :fade_size] = tail * (1 - fade_in) + sources[..., :fade_size] * fade_in
+      if not last:
+        sources, tail = sources[..., :-fade_size], sources[..., -fade_size:]
+      yield {name: source for name, source in zip(self.model.sources, sources) if name in STEMS}
+
+      if last:
+        break
+      buffer = buffer[:, hop_size:]
+
+  def _apply(
+    self,
+    wav: torch.Tensor,
+    segment: Optional[float],
+    overlap: float,
+    shifts: int,
+    num_threads: Optional[int],
+  ) -> torch.Tensor:
+    from demucs.apply import apply_model
+
+    # One separation at a time: the model is shared, and the thread count is process-wide.
+    with self.lock, _num_threads(num_threads), torch.no_grad():
+      sources = apply_model(
+        self.model, wav[None],
+        device=self.device,
+        shifts=shifts,
+        split=True,
+        overlap=overlap,
+        segment=segment,
+        progress=False,
+      )[0]
+    return sources.cpu()
+
+
+def _read_blocks(path: Path, audio_channels: int, samplerate: int, block_size: int) -> Iterator[torch.Tensor]:
+  """
+  Decodes an audio file with ffmpeg into consecutive (channels, block_size) float tensors (the last one shorter),
+  holding one block at a time. The samples are those `demucs.separate.load_track` returns for the whole file.
+  """
+  from demucs.audio import AudioFile, convert_audio_channels
+
+  channels = AudioFile(path).channels()
+  command = [
+    'ffmpeg', '-loglevel', 'panic', '-i', str(path),
+    '-map', '0:a:0', '-threads', '1', '-f', 'f32le', '-ar', str(samplerate), '-',
+  ]
+  process = subprocess.Popen(command, stdout=subprocess.PIPE)
+  try:
+    while True:
+      data = process.stdout.read(block_size * channels * 4)
+      if not data:
+        break
+      block = np.frombuffer(data, dtype=np.float32)
+      block = block[:len(block) // channels * channels].reshape(-1, channels).T
+      yield convert_audio_channels(torch.from_numpy(block.copy()), audio_channels)
+  except GeneratorExit:  # closed early by the consumer
+    process.kill()
+    raise
+  finally:
+    process.stdout.close()
+    returncode = process.wait()
+  if returncode != 0:
+    raise subprocess.CalledProcessError(returncode, command)
+
+
+@contextmanager
+def _num_threads(num_threads: Optional[int]):
+  # torch.set_num_threads is process-global: it throttles (or oversubscribes) every other thread running torch ops.
+  if num_threads is None:
+    yield
+    return
+  previous = torch.get_num_threads()
+  torch.set_num_threads(num_threads)
+  try:
+    yield
+  finally:
+    torch.set_num_threads(previous)
+
+
+def get_demix_engine(
+  model_name: str = DEMUCS_MODEL,
+  repo: Optional[Path] = None,
+  device: Union[str, torch.device] = 'cpu',
+) -> DemixEngine:
+  """Returns the engine for the given model, repo and device, loading it on first use only."""
+  key = (model_name, str(repo), str(torch.device(device)))
+  with _ENGINES_LOCK:
+    if key not in _ENGINES:
+      _ENGINES[key] = DemixEngine(model_name, repo, device)
+    return _ENGINES[key]
+
+
+def default_repo(demix_dir: Path) -> Optional[Path]:
+  """The local demucs repo (`static_models` next to the demix directory), or None to download the weights."""
+  static_models_dir = (demix_dir.parent / 'static_models').resolve()
+  return static_models_dir if static_models_dir.is_dir() else None
+
+
+def demix(
+  paths: List[Path],
+  demix_dir: Path,
+  device: Union[str, torch.device],
+  segment: Optional[float] = None,
+  overlap: float = 0.25,
+  shifts: int = 1,
+  num_threads: Optional[int] = None,
+  stem_format: str = 'wav',
+):
+  """Demixes the audio file into its sources, saved in `stem_format` (see `STEM_FORMATS`)."""
   todos = []
   demix_paths = []
   for path in paths:
-    out_dir = demix_dir / 'htdemucs' / path.stem
+    out_dir = demix_dir / DEMUCS_MODEL / path.stem
     demix_paths.append(out_dir)
     if out_dir.is_dir():
-      if (
-        (out_dir / 'bass.wav').is_file() and
-        (out_dir / 'drums.wav').is_file() and
-        (out_dir / 'other.wav').is_file() and
-        (out_dir / 'vocals.wav').is_file()
-      ):
+      if all((out_dir / f'{stem}.{stem_format}').is_file() for stem in STEMS):
         continue
     todos.append(path)
 
   existing = len(paths) - len(todos)
   print(f'=> Found {existing} tracks already demixed, {len(todos)} to demix.')
 
-  static_models_dir = demix_dir.parent / 'static_models'
-  
-  # Convert to absolute path to avoid any relative path issues
-  absolute_static_models_dir = static_models_dir.resolve()
-
   if todos:
-    subprocess.run(
-      [
-        sys.executable, '-m', 'demucs.separate',
-        '--out', demix_dir.as_posix(),
-        '--name', 'htdemucs',
-        '--device', str(device),
-        # one folder up inside static_models
-        "--repo", absolute_static_models_dir.as_posix(),
-        "-n", "htdemucs", # ADDED PRECISA ter o YAML senão  n funciona: https://raw.githubusercontent.com/TRvlvr/application_data/main/filelists/download_checks.json
-        *[path.as_posix() for path in todos],
-      ],
-      check=True,
-    )
+    engine = get_demix_engine(DEMUCS_MODEL, default_repo(demix_dir), device)
+    for path in tqdm(todos, desc='Demixing'):
+      stems = engine.separate(path, segment, overlap, shifts, num_threads)
+      save_stems(stems, demix_dir / DEMUCS_MODEL / path.stem, engine.samplerate, stem_format)
 
   return demix_paths
+
+
+def save_stems(stems: Dict[str, torch.Tensor], out_dir: Path, samplerate: int, stem_format: str = 'wav'):
+  """Writes stems as `<stem>.<stem_format>` files into `out_dir`."""
+  from demucs.audio import prevent_clip, save_audio
+
+  assert stem_format in STEM_FORMATS, f'Unknown stem format: {stem_format} (expected one of {STEM_FORMATS})'
+  out_dir.mkdir(parents=True, exist_ok=True)
+  for stem, source in stems.items():
+    path = out_dir / f'{stem}.{stem_format}'
+    if stem_format == 'f16':
+      # Rescaled on clipping like the 16-bit formats, so that all formats give the same spectrograms.
+      source = prevent_clip(source.float(), mode='rescale')
+      header = dict(samplerate=samplerate, channels=source.shape[0], samples=source.shape[1], dtype='<f2')
+      source.numpy().astype('<f2').tofile(path)
+      _header_path(path).write_text(json.dumps(header))
+    else:
+      # 16-bit PCM with rescaling on clipping, the defaults of `python -m demucs.separate`.
+      save_audio(source, path, samplerate=samplerate)
+
+
+class StemWriter:
+  """
+  Saves stems that arrive in consecutive pieces, e.g. from `DemixEngine.separate_stream`, to the same files
+  `save_stems` writes for whole stems. As the rescaling on clipping needs the peak of the whole stem, the pieces are
+  spooled to float32 files in `out_dir` and converted block by block on `close`.
+  """
+
+  def __init__(self, out_dir: Path, samplerate: int, stem_format: str = 'wav'):
+    assert stem_format in STEM_FORMATS, f'Unknown stem format: {stem_format} (expected one of {STEM_FORMATS})'
+    self.out_dir = out_dir
+    self.samplerate = samplerate
+    self.stem_format = stem_format
+    self.spools, self.channels, self.peaks = {}, {}, {}
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+  def write(self, stems: Dict[str, torch.Tensor]):
+    for stem, source in stems.items():
+      if stem not in self.spools:
+        self.spools[stem] = open(self._spool_path(stem), 'wb')
+        self.channels[stem], self.peaks[stem] = source.shape[0], 0.
+      self.peaks[stem] = max(self.peaks[stem], source.abs().max().item())
+      source.float().t().contiguous().numpy().tofile(self.spools[stem])  # interleaved samples
+
+  def close(self, block_size: int = 1 << 20):
+    from demucs.audio import i16_pcm
+
+    for stem, spool in self.spools.items():
+      spool.close()
+      spool_path = self._spool_path(stem)
+      data = np.memmap(spool_path, dtype=np.float32, mode='r').reshape(-1, self.channels[stem])
+      scale = max(1.01 * self.peaks[stem], 1)  # as `demucs.audio.prevent_clip(..., mode='rescale')`
+      path = self.out_dir / f'{stem}.{self.stem_format}'
+      if self.stem_format == 'f16':
+        # Channels first, like `save_stems`.
+        with open(path, 'wb') as f:
+          for channel in range(data.shape[1]):
+            for i in range(0, len(data), block_size):
+              (data[i:i + block_size, channel] / scale).astype('<f2').tofile(f)
+        header = dict(samplerate=self.samplerate, channels=data.shape[1], samples=len(data), dtype='<f2')
+        _header_path(path).write_text(json.dumps(header))
+      else:
+        with _pcm16_sink(path, self.samplerate, data.shape[1]) as write:
+          for i in range(0, len(data), block_size):
+            write(i16_pcm(torch.from_numpy(data[i:i + block_size] / scale)).numpy().tobytes())
+      del data
+      spool_path.unlink()
+    self.spools = {}
+
+  def _spool_path(self, stem: str) -> Path:
+    return self.out_dir / f'.{stem}.f32.part'
+
+
+@contextmanager
+def _pcm16_sink(path: Path, samplerate: int, channels: int):
+  """Yields a function writing interleaved 16-bit samples to a WAV file, or to a FLAC file through ffmpeg."""
+  if path.suffix == '.wav':
+    with wave.open(str(path), 'wb') as f:
+      f.setnchannels(channels)
+      f.setsampwidth(2)
+      f.setframerate(samplerate)
+      yield f.writeframes
+    return
+
+  command = [
+    'ffmpeg', '-y', '-loglevel', 'panic',
+    '-f', 's16le', '-ar', str(samplerate), '-ac', str(channels), '-i', '-', str(path),
+  ]
+  process = subprocess.Popen(command, stdin=subprocess.PIPE)
+  try:
+    yield process.stdin.write
+  finally:
+    process.stdin.close()
+    if process.wait() != 0:
+      raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def find_stem(out_dir: Path, stem: str) -> Path:
+  """The file of `stem` in `out_dir`, in whichever of `STEM_FORMATS` it was saved."""
+  for stem_format in STEM_FORMATS:
+    path = out_dir / f'{stem}.{stem_format}'
+    if path.is_file():
+      return path
+  raise FileNotFoundError(f'No {stem} stem found in {out_dir} (looked for {STEM_FORMATS})')
+
+
+def read_f16(path: Path) -> Tuple[np.ndarray, int]:
+  """Reads a raw float16 stem as a (channels, samples) float32 array, and its sample rate."""
+  header = json.loads(_header_path(path).read_text())
+  data = np.fromfile(path, dtype=header['dtype']).reshape(header['channels'], header['samples'])
+  return data.astype(np.float32), header['samplerate']
+
+
+def delete_stems(out_dir: Path):
+  """Removes the stem files of every format from `out_dir`."""
+  for stem in STEMS:
+    for stem_format in STEM_FORMATS:
+      path = out_dir / f'{stem}.{stem_format}'
+      path.unlink(missing_ok=True)
+      if stem_format == 'f16':
+        _header_path(path).unlink(missing_ok=True)
+
+
+def _header_path(path: Path) -> Path:
+  return path.with_name(path.name + '.json')
+
+
+def separate_stems(
+  path: Path,
+  demix_dir: Path,
+  device: Union[str, torch.device],
+  segment: Optional[float] = None,
+  overlap: float = 0.25,
+  shifts: int = 1,
+  num_threads: Optional[int] = None,
+) -> Tuple[Dict[str, torch.Tensor], int]:
+  """Demixes one audio file in memory and returns its stems and their sample rate, without writing any files."""
+  engine = get_demix_engine(DEMUCS_MODEL, default_repo(demix_dir), device)
+  return engine.separate(path, segment, overlap, shifts, num_threads), engine.samplerate
+
+
+def stream_stems(
+  path: Path,
+  demix_dir: Path,
+  device: Union[str, torch.device],
+  chunk_duration: float = DEMIX_CHUNK_DURATION,
+  segment: Optional[float] = None,
+  overlap: float = 0.25,
+  shifts: int = 1,
+  num_threads: Optional[int] = None,
+) -> Tuple[Iterator[Dict[str, torch.Tensor]], int]:
+  """Like `separate_stems`, but the stems come in consecutive pieces (see `DemixEngine.separate_stream`)."""
+  engine = get_demix_engine(DEMUCS_MODEL, default_repo(demix_dir), device)
+  pieces = engine.separate_stream(path, chunk_duration, DEMIX_CROSSFADE, segment, overlap, shifts, num_threads)
+  return pieces, engine.samplerate
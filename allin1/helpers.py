@@ -1,12 +1,16 @@
 import numpy as np
 import json
+import os
 import torch
 
+from contextlib import nullcontext
 from dataclasses import asdict
 from pathlib import Path
 from glob import glob
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
+from omegaconf import OmegaConf
 from .utils import mkpath, compact_json_number_array
+from .config import Config
 from .typings import AllInOneOutput, AnalysisResult, PathLike
 from .postprocessing import (
   postprocess_metrical_structure,
@@ -14,6 +18,29 @@ from .postprocessing import (
   estimate_tempo_from_beats,
 )
 
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+PRECISION_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+SILENCE_THRESHOLD_DB = -60.0  # relative to the loudest bin of the track
+MIN_SILENCE_DURATION = 10.0  # seconds
+SILENCE_MARGIN = 2.0  # seconds of silence kept as context next to the non-silent regions
+NEUTRAL_LOGIT = -20.0  # beat, downbeat and boundary probability of ~2e-9 in skipped regions
+
+LOGIT_KEYS = ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function']
+ACTIVATION_KEYS = {'logits_beat': 'beat', 'logits_downbeat': 'downbeat', 'logits_section': 'segment'}
+
+
+def autocast(device: str, precision: Optional[str] = None):
+  """
+  Returns an autocast context that runs the encoder in reduced precision (bf16 or fp16), or a no-op for fp32. The
+  models keep their LayerNorms, final norm and heads in fp32 under autocast, so logits are always fp32.
+  """
+  if precision is None or precision == 'fp32':
+    return nullcontext()
+  if precision not in PRECISION_DTYPES:
+    raise ValueError(f'Unknown precision: {precision} (expected one of {PRECISIONS})')
+  return torch.autocast(device_type=torch.device(device).type, dtype=PRECISION_DTYPES[precision])
+
 
 def run_inference(
   path: Path,
@@ -22,20 +49,123 @@ def run_inference(
   device: str,
   include_activations: bool,
   include_embeddings: bool,
+  chunk_size: Optional[int] = None,
+  chunk_overlap: Optional[int] = None,
+  chunk_batch_size: int = 1,
+  precision: Optional[str] = None,
+  tasks: Optional[List[str]] = None,
+  skip_silence: bool = False,
+  logits_dir: Optional[PathLike] = None,
 ) -> AnalysisResult:
   spec = np.load(spec_path)
+  regions = find_active_regions(spec, model.cfg.fps) if skip_silence else None
   spec = torch.from_numpy(spec).unsqueeze(0).to(device)
 
-  logits = model(spec)
+  with autocast(device, precision):
+    if regions is not None and regions != [(0, spec.shape[2])]:
+      logits = run_model_sparse(
+        model, spec, regions,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        batch_size=chunk_batch_size,
+        include_embeddings=include_embeddings,
+        tasks=tasks,
+      )
+    elif chunk_size is not None:
+      logits = run_model_chunked(
+        model, spec,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        batch_size=chunk_batch_size,
+        include_embeddings=include_embeddings,
+        tasks=tasks,
+      )
+    else:
+      logits = model(spec, tasks=tasks, include_embeddings=include_embeddings)
+
+  return make_result(path, logits, model.cfg, include_activations, include_embeddings, tasks, logits_dir)
+
+
+def run_batch_inference(
+  paths: List[Path],
+  spec_paths: List[Path],
+  model: torch.nn.Module,
+  device: str,
+  include_activations: bool,
+  include_embeddings: bool,
+  precision: Optional[str] = None,
+  tasks: Optional[List[str]] = None,
+  logits_dir: Optional[PathLike] = None,
+) -> List[AnalysisResult]:
+  """
+  Runs several tracks through the model in one batch. Shorter spectrograms are zero-padded at the end (as in
+  training), and a padding mask selects each track's own frames from the outputs before postprocessing. The padded
+  frames are not masked inside the model, so the outputs of a padded track's frames within `receptive_field` of its
+  end (8212 frames, about 82 seconds, for the pretrained models) differ from running the track alone. The longest
+  track of the batch is unaffected.
+  """
+  specs = [np.load(spec_path) for spec_path in spec_paths]
+  lengths = [spec.shape[1] for spec in specs]
+  max_T = max(lengths)
+  batch = np.stack([np.pad(spec, ((0, 0), (0, max_T - spec.shape[1]), (0, 0))) for spec in specs])
+  batch = torch.from_numpy(batch).to(device)
+  mask = torch.arange(max_T, device=device)[None, :] < torch.tensor(lengths, device=device)[:, None]
+
+  with autocast(device, precision):
+    logits = model(batch, tasks=tasks, include_embeddings=include_embeddings)
 
-  metrical_structure = postprocess_metrical_structure(logits, model.cfg)
-  functional_structure = postprocess_functional_structure(logits, model.cfg)
-  bpm = estimate_tempo_from_beats(metrical_structure['beats'])
+  def select(value, i, time_dim):
+    if value is None:
+      return None
+    index = (slice(i, i + 1),) + (slice(None),) * (time_dim - 1) + (mask[i],)
+    return value[index]
+
+  results = []
+  for i, path in enumerate(paths):
+    track_logits = AllInOneOutput(
+      logits_beat=select(logits.logits_beat, i, 1),
+      logits_downbeat=select(logits.logits_downbeat, i, 1),
+      logits_section=select(logits.logits_section, i, 1),
+      logits_function=select(logits.logits_function, i, 2),
+      embeddings=select(logits.embeddings, i, 2) if include_embeddings else None,
+      num_models=logits.num_models,
+    )
+    results.append(make_result(
+      path, track_logits, model.cfg, include_activations, include_embeddings, tasks, logits_dir
+    ))
+  return results
+
+
+def make_result(
+  path: Path,
+  logits: AllInOneOutput,
+  cfg: Config,
+  include_activations: bool,
+  include_embeddings: bool,
+  tasks: Optional[List[str]] = None,
+  logits_dir: Optional[PathLike] = None,
+) -> AnalysisResult:
+  if logits_dir is not None:
+    save_logits(path, logits, cfg, logits_dir)
+
+  # Tasks that were not requested are left empty; the DBN of the metrical structure is by far the most expensive.
+  if tasks is None or 'beats' in tasks:
+    metrical_structure = postprocess_metrical_structure(logits, cfg)
+    bpm = estimate_tempo_from_beats(metrical_structure['beats'])
+  else:
+    metrical_structure = dict(beats=[], downbeats=[], beat_positions=[])
+    bpm = None
+
+  if tasks is None or 'segments' in tasks:
+    functional_structure = postprocess_functional_structure(logits, cfg)
+  else:
+    functional_structure = []
 
   result = AnalysisResult(
     path=path,
     bpm=bpm,
     segments=functional_structure,
+    num_models=logits.num_models,
     **metrical_structure,
   )
 
@@ -49,17 +179,231 @@ def run_inference(
   return result
 
 
-def compute_activations(logits: AllInOneOutput):
-  activations_beat = torch.sigmoid(logits.logits_beat[0]).cpu().numpy()
-  activations_downbeat = torch.sigmoid(logits.logits_downbeat[0]).cpu().numpy()
-  activations_segment = torch.sigmoid(logits.logits_section[0]).cpu().numpy()
-  activations_label = torch.softmax(logits.logits_function[0], dim=0).cpu().numpy()
-  return {
-    'beat': activations_beat,
-    'downbeat': activations_downbeat,
-    'segment': activations_segment,
-    'label': activations_label,
+def save_logits(path: Path, logits: AllInOneOutput, cfg: Config, logits_dir: PathLike) -> Path:
+  """
+  Saves a track's logits with the config of the model to `<logits_dir>/<track>.logits.npz`, so that the
+  postprocessing can be re-run from them with `reprocess`.
+  """
+  logits_dir = mkpath(logits_dir)
+  logits_dir.mkdir(parents=True, exist_ok=True)
+  out_path = logits_dir / path.with_suffix('.logits.npz').name
+  arrays = {
+    key: getattr(logits, key)[0].float().cpu().numpy()
+    for key in LOGIT_KEYS
+    if getattr(logits, key) is not None
   }
+  tmp_path = out_path.with_name(f'.{out_path.name}.tmp')
+  with open(tmp_path, 'wb') as f:
+    np.savez(
+      f,
+      path=str(path),
+      config=OmegaConf.to_yaml(cfg),
+      num_models=logits.num_models or 0,
+      **arrays,
+    )
+  os.replace(tmp_path, out_path)
+  return out_path
+
+
+def load_logits(path: PathLike) -> Tuple[Path, AllInOneOutput, Optional[Config]]:
+  """
+  Loads a logits cache written by `save_logits` and returns the track path, the logits and the model config.
+  Activations saved by `save_results` (`.activ.npz`) are turned back into logits too; they hold no config, so None
+  is returned for it, and the track path is read from the result JSON next to them if there is one.
+  """
+  path = mkpath(path)
+  with np.load(path) as data:
+    if 'config' in data.files:
+      logits = AllInOneOutput(
+        **{key: torch.from_numpy(data[key]).unsqueeze(0) for key in LOGIT_KEYS if key in data.files},
+        num_models=int(data['num_models']) or None,
+      )
+      return mkpath(str(data['path'])), logits, OmegaConf.create(str(data['config']))
+
+    logits = AllInOneOutput()
+    for key, name in ACTIVATION_KEYS.items():
+      if name in data.files:
+        setattr(logits, key, torch.logit(torch.from_numpy(data[name]).float(), eps=1e-7).unsqueeze(0))
+    if 'label' in data.files:
+      logits.logits_function = torch.from_numpy(data['label']).float().clamp(min=1e-12).log().unsqueeze(0)
+
+  json_path = path.with_suffix('').with_suffix('.json')
+  track_path = path
+  if json_path.is_file():
+    result = json.loads(json_path.read_text())
+    track_path = mkpath(result['path'])
+    logits.num_models = result.get('num_models')
+  return track_path, logits, None
+
+
+def receptive_field(cfg: Config) -> int:
+  """Number of frames on each side of a frame that the model's stacked (dilated) attention layers can see."""
+  reach = 2  # two convolutions with a kernel size of 3 in time in the embeddings
+  for i in range(cfg.depth):
+    dilation = min(cfg.dilation_factor ** i, cfg.dilation_max)
+    max_dilation = dilation * 2 if cfg.double_attention else dilation
+    reach += (cfg.kernel_size // 2) * max_dilation
+    reach += 5 // 2  # the instrument attention, with a kernel size of 5 and no dilation
+  return reach
+
+
+def min_chunk_overlap(cfg: Config) -> int:
+  """Shortest overlap between chunks that makes `run_model_chunked` exact: a receptive field on each side."""
+  return 2 * receptive_field(cfg)
+
+
+def run_model_chunked(
+  model: torch.nn.Module,
+  spec: torch.Tensor,
+  chunk_size: int,
+  chunk_overlap: Optional[int] = None,
+  batch_size: int = 1,
+  include_embeddings: bool = False,
+  tasks: Optional[List[str]] = None,
+) -> AllInOneOutput:
+  """
+  Runs the model over overlapping windows of `chunk_size` frames, so that peak memory depends on the chunk size rather
+  than the track length, and takes every frame from the window in which it lies furthest from an edge. With an
+  overlap of at least `min_chunk_overlap` (the default), every frame then sees its whole receptive field and the
+  outputs equal those of the whole track up to float rounding. Up to `batch_size` chunks are run through the model
+  together.
+  """
+  N, K, T, F = spec.shape
+  assert N == 1, 'Chunked inference expects a single track'
+  if T <= chunk_size:
+    return model(spec, tasks=tasks, include_embeddings=include_embeddings)
+
+  min_overlap = min_chunk_overlap(model.cfg)
+  if chunk_overlap is None:
+    chunk_overlap = min_overlap
+  assert min_overlap <= chunk_overlap < chunk_size, \
+    f'The chunk overlap must be at least {min_overlap} frames (a receptive field per side) and below the chunk size'
+
+  hop = chunk_size - chunk_overlap
+  starts = list(range(0, T - chunk_size, hop)) + [T - chunk_size]
+  # Chunk i provides frames cuts[i]:cuts[i + 1], split at the middle of its overlaps with its neighbors.
+  cuts = [0] + [(start + prev_start + chunk_size) // 2 for prev_start, start in zip(starts, starts[1:])] + [T]
+
+  keys = ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function']
+  if include_embeddings:
+    keys.append('embeddings')
+  stitched = {}
+  num_models = None
+  for i in range(0, len(starts), batch_size):
+    batch_starts = starts[i:i + batch_size]
+    chunks = torch.cat([spec[:, :, start:start + chunk_size] for start in batch_starts])
+    output = model(chunks, tasks=tasks, include_embeddings=include_embeddings)
+    num_models = output.num_models
+
+    for j, start in enumerate(batch_starts):
+      lo, hi = cuts[i + j], cuts[i + j + 1]
+      for key in keys:
+        if getattr(output, key) is None:
+          continue
+        # Move the time axis last: logits are (N, [class,] T) and embeddings (N, K, T, C[, E]).
+        value = getattr(output, key)[j:j + 1]
+        if key == 'embeddings':
+          value = value.movedim(2, -1)
+        if key not in stitched:
+          stitched[key] = value.new_zeros(value.shape[:-1] + (T,))
+        stitched[key][..., lo:hi] = value[..., lo - start:hi - start]
+
+  if include_embeddings:
+    stitched['embeddings'] = stitched['embeddings'].movedim(-1, 2)
+  return AllInOneOutput(**stitched, num_models=num_models)
+
+
+def find_active_regions(
+  spec: np.ndarray,
+  fps: int,
+  threshold_db: float = SILENCE_THRESHOLD_DB,
+  min_silence: float = MIN_SILENCE_DURATION,
+  margin: float = SILENCE_MARGIN,
+) -> List[Tuple[int, int]]:
+  """
+  Returns the (start, end) frame ranges to run the model on: the whole track except silent spans of at least
+  `min_silence` seconds, less `margin` seconds of context next to the music. A frame is silent when its loudest bin
+  over all stems is `threshold_db` or more below the loudest bin of the track.
+  """
+  # spec has shape of: K, T, F and holds log10(1 + magnitude), madmom's LogarithmicSpectrogram.
+  T = spec.shape[1]
+  level = np.power(10., spec.max(axis=(0, 2))) - 1
+  peak = level.max()
+  if peak <= 0:
+    return [(0, T)]
+  silent = np.concatenate([[0], level <= peak * 10 ** (threshold_db / 20), [0]]).astype(np.int8)
+  edges = np.flatnonzero(np.diff(silent))
+  min_frames, margin_frames = round(min_silence * fps), round(margin * fps)
+
+  regions = []
+  position = 0
+  for start, end in zip(edges[::2], edges[1::2]):
+    if end - start < min_frames:
+      continue
+    # Silence at the start or end of the track needs no context on its outer side.
+    skip_start = start + margin_frames if start > 0 else 0
+    skip_end = end - margin_frames if end < T else T
+    if skip_start >= skip_end:
+      continue
+    if skip_start > position:
+      regions.append((position, int(skip_start)))
+    position = int(skip_end)
+  if position < T:
+    regions.append((position, T))
+  return regions
+
+
+def run_model_sparse(
+  model: torch.nn.Module,
+  spec: torch.Tensor,
+  regions: List[Tuple[int, int]],
+  chunk_size: Optional[int] = None,
+  chunk_overlap: Optional[int] = None,
+  batch_size: int = 1,
+  include_embeddings: bool = False,
+  tasks: Optional[List[str]] = None,
+) -> AllInOneOutput:
+  """
+  Runs the model on the given frame ranges only (see `find_active_regions`), each on its own or chunked, and fills
+  the skipped frames with neutral outputs: no beats, downbeats or boundaries, uniform labels and zero embeddings.
+  """
+  T = spec.shape[2]
+  keys = ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function', 'embeddings']
+  outputs = {}
+  num_models = None
+  for start, end in regions:
+    region = spec[:, :, start:end]
+    if chunk_size is not None:
+      output = run_model_chunked(model, region, chunk_size, chunk_overlap, batch_size, include_embeddings, tasks)
+    else:
+      output = model(region, tasks=tasks, include_embeddings=include_embeddings)
+    num_models = output.num_models
+
+    for key in keys:
+      value = getattr(output, key)
+      if value is None:
+        continue
+      # logits_beat, logits_downbeat and logits_section are (N, T), logits_function (N, class, T) and embeddings
+      # (N, K, T, C[, E]).
+      time_dim = 2 if key in ['logits_function', 'embeddings'] else 1
+      if key not in outputs:
+        shape = value.shape[:time_dim] + (T,) + value.shape[time_dim + 1:]
+        fill = 0. if key in ['logits_function', 'embeddings'] else NEUTRAL_LOGIT
+        outputs[key] = value.new_full(shape, fill)
+      outputs[key][(slice(None),) * time_dim + (slice(start, end),)] = value
+
+  return AllInOneOutput(**outputs, num_models=num_models)
+
+
+def compute_activations(logits: AllInOneOutput):
+  activations = {}
+  if logits.logits_beat is not None:
+    activations['beat'] = torch.sigmoid(logits.logits_beat[0]).cpu().numpy()
+    activations['downbeat'] = torch.sigmoid(logits.logits_downbeat[0]).cpu().numpy()
+  if logits.logits_section is not None:
+    activations['segment'] = torch.sigmoid(logits.logits_section[0]).cpu().numpy()
+    activations['label'] = torch.softmax(logits.logits_function[0], dim=0).cpu().numpy()
+  return activations
 
 
 def expand_paths(paths: List[Path]):
@@ -1,2 +1,6 @@
 from .allinone import AllInOne
-from .loaders import load_pretrained_model
+from .loaders import load_pretrained_model, register_ensemble, register_ensembles, MODEL_REGISTRY, ModelRegistry
+from .dinat import set_attention_backend, set_dense_instruments, ATTENTION_BACKENDS
+from .compiled import CompiledModel, COMPILE_MODES
+from .fused import fuse_model, FusedAllInOne
+from .export import export_onnx, load_onnx_model, OnnxModel, INFERENCE_BACKENDS
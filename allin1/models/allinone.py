@@ -1,9 +1,9 @@
 import torch
 import torch.nn as nn
 
-from typing import Optional
+from typing import List, Optional
 from .dinat import DinatLayer1d, DinatLayer2d
-from .utils import get_activation_function
+from .utils import get_activation_function, FP32LayerNorm
 from ..config import Config
 from ..typings import AllInOneOutput
 
@@ -36,6 +36,9 @@ class AllInOne(nn.Module):
     self,
     inputs: torch.FloatTensor,
     output_attentions: Optional[bool] = None,
+    tasks: Optional[List[str]] = None,
+    include_embeddings: bool = True,
+    output_levels: Optional[List[int]] = None,
   ):
     # N: batch size
     # K: instrument
@@ -43,32 +46,52 @@ class AllInOne(nn.Module):
     # T: time
     # F: frequency
     # x has shape of: N, K, T, F
+    # tasks: heads to compute ('beats', 'segments'); the logits of the others are None. All by default.
+    # include_embeddings: if False, the embeddings are None and the hidden states are freed after the heads.
+    # output_levels: encoder layers (e.g. [-1] or [4, 8]) whose outputs are returned as `hidden_state_levels`.
+    #   Only the last layer is kept otherwise.
     N, K, T, F = inputs.shape
 
     inputs = inputs.reshape(-1, 1, T, F)  # N x K, C=1, T, F=81
     frame_embed = self.embeddings(inputs)  # NK, T, C=16
 
+    levels = sorted({level % self.num_levels for level in output_levels or []} | {self.num_levels - 1})
     encoder_outputs = self.encoder(
       frame_embed,
       output_attentions=output_attentions,
+      output_levels=levels,
     )
     hidden_state_levels = encoder_outputs[0]
 
     hidden_states = hidden_state_levels[-1].reshape(N, K, T, -1)  # N, K, T, C=16
-    hidden_states = self.norm(hidden_states)
-    hidden_states = self.dropout(hidden_states)
+    if output_levels is not None:
+      hidden_state_levels = [
+        hidden_state_levels[levels.index(level % self.num_levels)].reshape(N, K, T, -1)
+        for level in output_levels
+      ]
+    else:
+      hidden_state_levels = None
+
+    # The final norm and the heads always run in fp32, also under reduced-precision autocast.
+    with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+      hidden_states = self.norm(hidden_states.float())
+      hidden_states = self.dropout(hidden_states)
 
-    logits_beat = self.beat_classifier(hidden_states)
-    logits_downbeat = self.downbeat_classifier(hidden_states)
-    logits_section = self.section_classifier(hidden_states)
-    logits_function = self.function_classifier(hidden_states)
+      logits_beat = logits_downbeat = logits_section = logits_function = None
+      if tasks is None or 'beats' in tasks:
+        logits_beat = self.beat_classifier(hidden_states)
+        logits_downbeat = self.downbeat_classifier(hidden_states)
+      if tasks is None or 'segments' in tasks:
+        logits_section = self.section_classifier(hidden_states)
+        logits_function = self.function_classifier(hidden_states)
 
     return AllInOneOutput(
       logits_beat=logits_beat,
       logits_downbeat=logits_downbeat,
       logits_section=logits_section,
       logits_function=logits_function,
-      embeddings=hidden_states,
+      embeddings=hidden_states if include_embeddings else None,
+      hidden_state_levels=hidden_state_levels,
     )
 
 
@@ -97,19 +120,23 @@ class AllInOneEncoder(nn.Module):
     self,
     frame_embed: torch.FloatTensor,
     output_attentions: Optional[bool] = None,
+    output_levels: Optional[List[int]] = None,
   ):
     # N: batch size
     # K: instrument
     # T: time
     # C: channel
     # x has shape of: NK, T, C=16
+    # output_levels: indices of the layers whose outputs are kept (all by default). Dropping the others lets each
+    #   layer's output be freed as soon as the next layer has consumed it.
 
     hidden_state_levels = []
     hidden_states = frame_embed
     for i, layer in enumerate(self.layers):
       layer_outputs = layer(hidden_states, output_attentions)
       hidden_states = layer_outputs[0]
-      hidden_state_levels.append(hidden_states)
+      if output_levels is None or i in output_levels:
+        hidden_state_levels.append(hidden_states)
 
     outputs = (hidden_state_levels,)
     if output_attentions:
@@ -207,7 +234,7 @@ class AllInOneEmbeddings(nn.Module):
     self.conv2 = nn.Conv2d(hidden_size, hidden_size, kernel_size=(3, 3), stride=(1, 1), padding=(1, 0))
     self.pool2 = nn.MaxPool2d(kernel_size=(1, 3), stride=(1, 3), padding=(0, 0))
 
-    self.norm = nn.LayerNorm(cfg.dim_embed)
+    self.norm = FP32LayerNorm(cfg.dim_embed)
     self.dropout = nn.Dropout(cfg.drop_conv)
 
   def forward(self, x: torch.FloatTensor):
@@ -0,0 +1,322 @@
+"""Vectorized execution of an ensemble of AllInOne folds.
+
+The parameters of all folds are stacked along a leading fold axis E, so that each linear layer of the ensemble
+becomes a single batched matmul, the convolutional embeddings become grouped convolutions, and the neighborhood
+attention of all folds is a single natten call in which the folds act as extra attention heads. This module is
+meant for inference only: dropout and drop path are not applied.
+"""
+
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from typing import List, Optional
+from .allinone import AllInOne, AllInOneBlock, AllInOneEmbeddings, Head
+from .dinat import DinatLayer2d, _DinatLayerNd, _NeighborhoodAttentionModuleNd
+from .ensemble import make_ensemble_config
+from .neighborhood import instrument_av, instrument_qk_rpb
+from ..typings import AllInOneOutput
+
+
+def _stack(tensors: List[torch.Tensor]) -> nn.Parameter:
+  return nn.Parameter(torch.stack([t.detach() for t in tensors]), requires_grad=False)
+
+
+class StackedLinear(nn.Module):
+  def __init__(self, linears: List[nn.Linear]):
+    super().__init__()
+    self.weight = _stack([linear.weight.t() for linear in linears])  # E, C_in, C_out
+    if linears[0].bias is not None:
+      self.bias = _stack([linear.bias for linear in linears])  # E, C_out
+    else:
+      self.bias = None
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    # x has shape of: E, ..., C_in
+    E, *dims, C_in = x.shape
+    x = x.reshape(E, -1, C_in)
+    if self.bias is None:
+      x = torch.bmm(x, self.weight)
+    else:
+      x = torch.baddbmm(self.bias.unsqueeze(1), x, self.weight)
+    return x.reshape(E, *dims, -1)
+
+
+class StackedLayerNorm(nn.Module):
+  def __init__(self, norms: List[nn.LayerNorm]):
+    super().__init__()
+    self.normalized_shape = norms[0].normalized_shape
+    self.eps = norms[0].eps
+    self.weight = _stack([norm.weight for norm in norms])  # E, C
+    self.bias = _stack([norm.bias for norm in norms])  # E, C
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    # x has shape of: E, ..., C
+    dtype = x.dtype
+    x = F.layer_norm(x.float(), self.normalized_shape, eps=self.eps)
+    shape = (x.shape[0],) + (1,) * (x.ndim - 2) + (x.shape[-1],)
+    return (x * self.weight.view(shape) + self.bias.view(shape)).to(dtype)
+
+
+class StackedConv2d(nn.Module):
+  def __init__(self, convs: List[nn.Conv2d], shared_input: bool = False):
+    super().__init__()
+    # When all folds see the same input, a plain convolution with the folds' filters concatenated is enough.
+    # Otherwise, the input channels are grouped by fold.
+    self.groups = 1 if shared_input else len(convs)
+    self.stride = convs[0].stride
+    self.padding = convs[0].padding
+    self.weight = nn.Parameter(torch.cat([conv.weight.detach() for conv in convs]), requires_grad=False)
+    self.bias = nn.Parameter(torch.cat([conv.bias.detach() for conv in convs]), requires_grad=False)
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, groups=self.groups)
+
+
+class StackedEmbeddings(nn.Module):
+  def __init__(self, embeddings: List[AllInOneEmbeddings]):
+    super().__init__()
+    first = embeddings[0]
+    self.num_models = len(embeddings)
+    self.act_fn = first.act_fn
+
+    self.conv0 = StackedConv2d([e.conv0 for e in embeddings], shared_input=True)
+    self.pool0 = first.pool0
+    self.conv1 = StackedConv2d([e.conv1 for e in embeddings])
+    self.pool1 = first.pool1
+    self.conv2 = StackedConv2d([e.conv2 for e in embeddings])
+    self.pool2 = first.pool2
+    self.norm = StackedLayerNorm([e.norm for e in embeddings])
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    # x has shape of: NK, C=1, T, F
+    x = self.act_fn(self.pool0(self.conv0(x)))  # NK, E x C, T, F=26
+    x = self.act_fn(self.pool1(self.conv1(x)))  # NK, E x C, T, F=5
+    x = self.act_fn(self.pool2(self.conv2(x)))  # NK, E x C, T, F=1
+
+    NK, EC, T, _ = x.shape
+    x = x.reshape(NK, self.num_models, EC // self.num_models, T)  # NK, E, C, T
+    x = x.permute(1, 0, 3, 2)  # E, NK, T, C
+    return self.norm(x)
+
+
+class StackedNeighborhoodAttention(nn.Module):
+  def __init__(self, modules: List[_NeighborhoodAttentionModuleNd]):
+    super().__init__()
+    attentions = [module.self for module in modules]
+    first = attentions[0]
+    self.num_models = len(modules)
+    self.num_attention_heads = first.num_attention_heads
+    self.attention_head_size = first.attention_head_size
+    self.kernel_size = first.kernel_size
+    self.dilation = first.dilation
+    self.attention_ndim = first.attention_ndim
+    self.backend = first.backend
+    self.nattendqkrpb = first.nattendqkrpb
+    self.nattendav = first.nattendav
+
+    self.query = StackedLinear([a.query for a in attentions])
+    self.key = StackedLinear([a.key for a in attentions])
+    self.value = StackedLinear([a.value for a in attentions])
+    self.rpb = _stack([a.rpb for a in attentions])  # E, H, (2k-1)[, (2k-1)]
+    self.output = StackedLinear([module.output.dense for module in modules])
+
+  def forward(self, hidden_states: torch.Tensor, dense: bool = False) -> torch.Tensor:
+    # hidden_states has shape of: E, B, *S, C where S is (T,) for 1D and (K, T) for 2D.
+    # dense: attend densely over K instead of padding it (see `DinatLayer2d.dense_instruments`).
+    query_layer = self.split_heads(self.query(hidden_states))
+    key_layer = self.split_heads(self.key(hidden_states))
+    value_layer = self.split_heads(self.value(hidden_states))
+    query_layer = query_layer / math.sqrt(self.attention_head_size)
+
+    # The folds become extra heads, so their relative positional biases are concatenated along the head axis.
+    rpb = self.rpb.reshape(-1, *self.rpb.shape[2:])
+    if dense:
+      key_bias = value_bias = None
+      if self.key.bias is not None:
+        key_bias = self.key.bias.reshape(-1, self.attention_head_size)  # E x H, D
+        value_bias = self.value.bias.reshape(-1, self.attention_head_size)
+      attention_scores = instrument_qk_rpb(query_layer, key_layer, rpb, self.kernel_size, key_bias)
+      attention_probs = nn.functional.softmax(attention_scores, dim=-1)
+      context_layer = instrument_av(attention_probs, value_layer, self.kernel_size, value_bias)
+    else:
+      attention_scores = self.nattendqkrpb(query_layer, key_layer, rpb, self.kernel_size, self.dilation)
+      attention_probs = nn.functional.softmax(attention_scores, dim=-1)
+      context_layer = self.nattendav(attention_probs, value_layer, self.kernel_size, self.dilation)
+
+    return self.output(self.merge_heads(context_layer))
+
+  def split_heads(self, x: torch.Tensor) -> torch.Tensor:
+    # E, B, *S, C -> B, E x H, *S, D
+    E, B, *S, _ = x.shape
+    s = len(S)
+    x = x.reshape(E, B, *S, self.num_attention_heads, self.attention_head_size)
+    x = x.permute(1, 0, 2 + s, *range(2, 2 + s), 3 + s)
+    return x.reshape(B, E * self.num_attention_heads, *S, self.attention_head_size)
+
+  def merge_heads(self, x: torch.Tensor) -> torch.Tensor:
+    # B, E x H, *S, D -> E, B, *S, C
+    B, _, *S, D = x.shape
+    s = len(S)
+    x = x.reshape(B, self.num_models, self.num_attention_heads, *S, D)
+    x = x.permute(1, 0, *range(3, 3 + s), 2, 3 + s)
+    return x.reshape(self.num_models, B, *S, self.num_attention_heads * D)
+
+
+class StackedDinatLayer(nn.Module):
+  def __init__(self, layers: List[_DinatLayerNd]):
+    super().__init__()
+    first = layers[0]
+    self.is_2d = isinstance(first, DinatLayer2d)
+    self.kernel_size = first.kernel_size
+    self.dilation = first.dilation
+    self.dense_instruments = self.is_2d and first.dense_instruments
+    self.window_size = first.window_size
+    self.double_attention = first.double_attention
+
+    self.layernorm_before = StackedLayerNorm([layer.layernorm_before for layer in layers])
+    self.attention = StackedNeighborhoodAttention([layer.attention for layer in layers])
+    if first.attention2 is not None:
+      self.attention2 = StackedNeighborhoodAttention([layer.attention2 for layer in layers])
+    else:
+      self.attention2 = None
+    self.layernorm_after = StackedLayerNorm([layer.layernorm_after for layer in layers])
+    self.intermediate = StackedLinear([layer.intermediate.dense for layer in layers])
+    self.intermediate_act_fn = first.intermediate.intermediate_act_fn
+    self.output = StackedLinear([layer.output.dense for layer in layers])
+
+  def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+    # hidden_states has shape of: E, N, T, C for 1D and E, N, K, T, C for 2D.
+    shortcut = hidden_states
+    hidden_states = self.layernorm_before(hidden_states)
+
+    # pad hidden_states if they are smaller than kernel size x dilation
+    T = hidden_states.shape[-2]
+    pad_r = max(0, self.window_size - T)
+    dense = False
+    if self.is_2d:
+      K = hidden_states.shape[-3]
+      dense = self.dense_instruments and self.dilation == 1 and K <= self.kernel_size <= T
+      pad_b = 0 if dense else max(0, self.window_size - K)
+      if pad_r > 0 or pad_b > 0:
+        hidden_states = F.pad(hidden_states, (0, 0, 0, pad_r, 0, pad_b))
+    elif pad_r > 0:
+      hidden_states = F.pad(hidden_states, (0, 0, 0, pad_r))
+
+    hidden_states_list = []
+    for attention in [self.attention, self.attention2]:
+      if attention is None:
+        continue
+      attention_output = attention(hidden_states, dense)
+      if self.is_2d:
+        attention_output = attention_output[..., :K, :T, :]
+      else:
+        attention_output = attention_output[..., :T, :]
+      hidden_states_list.append(shortcut + attention_output)
+
+    if self.double_attention:
+      hidden_states = torch.cat(hidden_states_list, dim=-1)
+      shortcut = torch.stack(hidden_states_list).sum(dim=0) / 2.
+    else:
+      hidden_states = hidden_states_list[0]
+      shortcut = hidden_states
+    layer_output = self.layernorm_after(hidden_states)
+    layer_output = self.output(self.intermediate_act_fn(self.intermediate(layer_output)))
+
+    return shortcut + layer_output
+
+
+class StackedBlock(nn.Module):
+  def __init__(self, blocks: List[AllInOneBlock]):
+    super().__init__()
+    cfg = blocks[0].cfg
+    self.num_instruments = cfg.data.num_instruments
+    self.instrument_attention = cfg.instrument_attention
+    self.timelayer = StackedDinatLayer([block.timelayer for block in blocks])
+    self.instlayer = StackedDinatLayer([block.instlayer for block in blocks])
+
+  def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+    # hidden_states has shape of: E, NK, T, C
+    E, NK, T, C = hidden_states.shape
+    hidden_states = self.timelayer(hidden_states)
+    if self.instrument_attention:
+      K = self.num_instruments
+      hidden_states = hidden_states.reshape(E, NK // K, K, T, C)
+      hidden_states = self.instlayer(hidden_states)
+      hidden_states = hidden_states.reshape(E, NK, T, C)
+    else:
+      hidden_states = self.instlayer(hidden_states)
+    return hidden_states
+
+
+class StackedHead(nn.Module):
+  def __init__(self, heads: List[Head]):
+    super().__init__()
+    self.classifier = StackedLinear([head.classifier for head in heads])
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    # x has shape of: E, N, K, T, C
+    E, N, K, T, C = x.shape
+    x = x.permute(0, 1, 3, 2, 4).reshape(E, N, T, K * C)
+    logits = self.classifier(x)  # E, N, T, class
+    logits = logits.permute(0, 1, 3, 2)  # E, N, class, T
+    if logits.shape[2] == 1:
+      logits = logits.squeeze(2)
+    return logits
+
+
+class BatchedEnsemble(nn.Module):
+  """
+  Drop-in replacement for `Ensemble` that evaluates all folds in one batched forward pass and returns the same
+  averaged `AllInOneOutput`. It trades E times the activation memory of a single fold for far fewer Python calls
+  and kernel launches.
+  """
+
+  def __init__(self, models: List[AllInOne]):
+    super().__init__()
+
+    self.cfg = make_ensemble_config(models)
+    self.num_models = len(models)
+
+    self.embeddings = StackedEmbeddings([model.embeddings for model in models])
+    self.layers = nn.ModuleList([
+      StackedBlock([model.encoder.layers[i] for model in models])
+      for i in range(len(models[0].encoder.layers))
+    ])
+    self.norm = StackedLayerNorm([model.norm for model in models])
+
+    self.beat_classifier = StackedHead([model.beat_classifier for model in models])
+    self.downbeat_classifier = StackedHead([model.downbeat_classifier for model in models])
+    self.section_classifier = StackedHead([model.section_classifier for model in models])
+    self.function_classifier = StackedHead([model.function_classifier for model in models])
+
+  def forward(
+    self,
+    inputs: torch.FloatTensor,
+    tasks: Optional[List[str]] = None,
+    include_embeddings: bool = True,
+  ) -> AllInOneOutput:
+    # x has shape of: N, K, T, F
+    N, K, T, F = inputs.shape
+    beats = tasks is None or 'beats' in tasks
+    segments = tasks is None or 'segments' in tasks
+
+    hidden_states = self.embeddings(inputs.reshape(-1, 1, T, F))  # E, NK, T, C
+    for layer in self.layers:
+      hidden_states = layer(hidden_states)
+
+    hidden_states = hidden_states.reshape(self.num_models, N, K, T, -1)  # E, N, K, T, C
+
+    # As in AllInOne, the final norm and the heads always run in fp32.
+    with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+      hidden_states = self.norm(hidden_states.float())
+
+      return AllInOneOutput(
+        logits_beat=self.beat_classifier(hidden_states).mean(dim=0) if beats else None,
+        logits_downbeat=self.downbeat_classifier(hidden_states).mean(dim=0) if beats else None,
+        logits_section=self.section_classifier(hidden_states).mean(dim=0) if segments else None,
+        logits_function=self.function_classifier(hidden_states).mean(dim=0) if segments else None,
+        embeddings=hidden_states.permute(1, 2, 3, 4, 0) if include_embeddings else None,  # N, K, T, C, E
+        num_models=self.num_models,
+      )
@@ -0,0 +1,142 @@
+"""Compiled inference that matches eager mode up to float rounding.
+
+Inputs are not padded: every layer zero-pads the time axis to its dilated window inside the compiled graph, exactly
+as in eager mode, so the outputs of a compiled model equal those of the model it wraps up to float rounding. Two
+compilers are supported:
+
+- 'inductor': `torch.compile` with a dynamic time axis. Dynamo guards on which layers' windows are longer than the
+  input, so at most one graph per distinct window is compiled (`warmup` compiles them all up front). Inductor's FX
+  graph cache is kept under the cache directory so that compiled kernels survive process restarts. natten kernels
+  cause graph breaks; the 'torch' attention backend compiles end to end.
+- 'torchscript': `torch.jit.trace` of a copy of the model on the 'torch' attention backend, once per set of layers
+  whose windows are longer than the input (the same partition as inductor's guards), so that padding decisions made
+  in Python stay valid for every length a graph serves. Graphs are saved to and reloaded from the cache directory.
+  The model given is not modified, and the adaptive ensemble is not supported.
+
+Inputs shorter than the attention kernel (a few frames) run eagerly.
+"""
+
+import hashlib
+import os
+import torch
+import torch.nn as nn
+
+from typing import List, Optional
+from .dinat import set_attention_backend
+from .ensemble import AdaptiveEnsemble
+from .utils import copy_sharing_weights
+from ..typings import AllInOneOutput, PathLike
+from ..utils import mkpath
+
+COMPILE_MODES = ['inductor', 'torchscript']
+DEFAULT_CACHE_DIR = '~/.cache/allin1/compiled'
+
+
+class _TupleOutput(nn.Module):
+  """Returns the outputs as a tuple, which torch.jit.trace can handle unlike dataclasses."""
+
+  def __init__(self, model: nn.Module):
+    super().__init__()
+    self.model = model
+
+  def forward(self, x):
+    output = self.model(x)
+    return output.logits_beat, output.logits_downbeat, output.logits_section, output.logits_function, output.embeddings
+
+
+class CompiledModel(nn.Module):
+  def __init__(
+    self,
+    model: nn.Module,
+    mode: str = 'inductor',
+    cache_dir: Optional[PathLike] = None,
+  ):
+    super().__init__()
+    assert mode in COMPILE_MODES, f'Unknown compile mode: {mode} (expected one of {COMPILE_MODES})'
+
+    self.model = model
+    self.cfg = model.cfg
+    self.mode = mode
+    self.cache_dir = mkpath(cache_dir or DEFAULT_CACHE_DIR)
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    # Shorter inputs take other Python branches (e.g. no dense instrument attention) and run eagerly.
+    self.min_frames = max(module.kernel_size for module in model.modules() if hasattr(module, 'attention_ndim'))
+    windows = {module.window_size for module in model.modules() if hasattr(module, 'window_size')}
+    self.windows = sorted(window for window in windows if window > self.min_frames)
+    # The shortest length of each set of padded layers, which `warmup` compiles.
+    self.warmup_lengths = [self.min_frames] + self.windows
+
+    if mode == 'inductor':
+      import torch._inductor.config
+
+      os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(self.cache_dir / 'inductor'))
+      torch._inductor.config.fx_graph_cache = True
+      self.compiled = torch.compile(model, dynamic=True)
+    else:
+      if isinstance(model, AdaptiveEnsemble):
+        raise ValueError('The adaptive ensemble cannot be traced; use the inductor compile mode instead.')
+      if hasattr(model, 'num_models'):
+        self.num_models = model.num_models
+      elif hasattr(model, 'models'):
+        self.num_models = len(model.models)
+      else:
+        self.num_models = None
+      self.traced = {}
+
+  def forward(
+    self,
+    x: torch.FloatTensor,
+    tasks: Optional[List[str]] = None,
+    include_embeddings: bool = True,
+  ) -> AllInOneOutput:
+    # x has shape of: N, K, T, F
+    # tasks is accepted for interface compatibility; the compiled graphs always compute every head.
+    if x.shape[2] < self.min_frames:
+      return self.model(x, tasks=tasks, include_embeddings=include_embeddings)
+
+    if self.mode == 'inductor':
+      output = self.compiled(x)
+    else:
+      output = self.run_traced(x)
+    if not include_embeddings:
+      output.embeddings = None
+    return output
+
+  def run_traced(self, x: torch.FloatTensor) -> AllInOneOutput:
+    padded = sum(window > x.shape[2] for window in self.windows)
+    key = f'{self.fingerprint(x)}-{padded}'
+    if key not in self.traced:
+      path = self.cache_dir / f'{key}.pt'
+      if path.is_file():
+        traced = torch.jit.load(str(path), map_location=x.device)
+      else:
+        # Trace a copy, as the model given is usually shared (e.g. cached by `load_pretrained_model`).
+        model = set_attention_backend(copy_sharing_weights(self.model), 'torch')
+        traced = torch.jit.trace(_TupleOutput(model), x, check_trace=False)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        torch.jit.save(traced, str(tmp_path))
+        os.replace(tmp_path, path)
+      self.traced[key] = traced
+
+    outputs = self.traced[key](x)
+    return AllInOneOutput(*outputs, num_models=self.num_models)
+
+  def fingerprint(self, x: torch.FloatTensor) -> str:
+    """Identifies a traced graph: the model weights, the input batch/instrument/bin sizes, device and torch version."""
+    if not hasattr(self, '_weights_hash'):
+      h = hashlib.sha1()
+      for name, tensor in self.model.state_dict().items():
+        h.update(name.encode())
+        if torch.is_tensor(tensor):
+          h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+      self._weights_hash = h.hexdigest()[:16]
+    N, K, _, n_bins = x.shape
+    return f'{self._weights_hash}-{N}x{K}x{n_bins}-{x.device.type}-torch{torch.__version__}'
+
+  def warmup(self, device=None, batch_size: int = 1):
+    """Compiles (or loads) every graph up front, so no request pays for compilation."""
+    device = device or next(self.model.parameters()).device
+    with torch.no_grad():
+      for num_frames in self.warmup_lengths:
+        x = torch.zeros(batch_size, self.cfg.data.num_instruments, num_frames, self.cfg.dim_input, device=device)
+        self(x)
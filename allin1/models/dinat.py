@@ -7,10 +7,42 @@ import math
 import torch
 from abc import ABC,  abstractmethod
 from typing import Optional, Tuple, Callable
-from natten.functional import natten1dav, natten1dqkrpb, natten2dav, natten2dqkrpb
 from ..config import Config
+from .neighborhood import na1d_av, na1d_qk_rpb, na2d_av, na2d_qk_rpb, instrument_av, instrument_qk_rpb, _length
 from .utils import *
 
+try:
+  from natten.functional import natten1dav, natten1dqkrpb, natten2dav, natten2dqkrpb
+  NATTEN_AVAILABLE = True
+except ImportError:
+  NATTEN_AVAILABLE = False
+
+# natten: natten's custom kernels.
+# torch: pure-PyTorch gather-based implementation with the same semantics (see neighborhood.py).
+ATTENTION_BACKENDS = ['natten', 'torch']
+DEFAULT_ATTENTION_BACKEND = 'natten' if NATTEN_AVAILABLE else 'torch'
+
+
+def get_attention_functions(backend: Optional[str], ndim: int) -> Tuple[Callable, Callable]:
+  """Returns the (qkrpb, av) neighborhood attention functions of the given backend for 1D or 2D inputs."""
+  backend = backend or DEFAULT_ATTENTION_BACKEND
+  if backend not in ATTENTION_BACKENDS:
+    raise ValueError(f'Unknown attention backend: {backend} (expected one of {ATTENTION_BACKENDS})')
+  if backend == 'natten':
+    if not NATTEN_AVAILABLE:
+      raise ImportError('natten is not installed; use the "torch" attention backend instead.')
+    return (natten1dqkrpb, natten1dav) if ndim == 1 else (natten2dqkrpb, natten2dav)
+  return (na1d_qk_rpb, na1d_av) if ndim == 1 else (na2d_qk_rpb, na2d_av)
+
+
+def set_attention_backend(model: nn.Module, backend: Optional[str]) -> nn.Module:
+  """Switches every neighborhood attention in the model to the given backend in place."""
+  for module in model.modules():
+    if hasattr(module, 'attention_ndim'):
+      module.backend = backend or DEFAULT_ATTENTION_BACKEND
+      module.nattendqkrpb, module.nattendav = get_attention_functions(backend, module.attention_ndim)
+  return model
+
 
 # Copied from transformers.models.beit.modeling_beit.drop_path
 def drop_path(input, drop_prob=0.0, training=False, scale_by_keep=True):
@@ -53,6 +85,7 @@ class _NeighborhoodAttentionNd(ABC, nn.Module):
   rpb: nn.Parameter
   nattendqkrpb: Callable
   nattendav: Callable
+  attention_ndim: int
   
   def __init__(
     self,
@@ -60,9 +93,12 @@ class _NeighborhoodAttentionNd(ABC, nn.Module):
     dim: int,
     num_heads: int,
     kernel_size: int,
-    dilation: int
+    dilation: int,
+    backend: Optional[str] = None,
   ):
     super().__init__()
+    self.backend = backend or DEFAULT_ATTENTION_BACKEND
+    self.nattendqkrpb, self.nattendav = get_attention_functions(self.backend, self.attention_ndim)
     if dim % num_heads != 0:
       raise ValueError(
         f"The hidden size ({dim}) is not a multiple of the number of attention heads ({num_heads})"
@@ -128,39 +164,60 @@ class _NeighborhoodAttentionNd(ABC, nn.Module):
 
 
 class NeighborhoodAttention1d(_NeighborhoodAttentionNd):
+  attention_ndim = 1
+
   def __init__(
     self,
     cfg: Config,
     dim: int,
     num_heads: int,
     kernel_size: int,
-    dilation: int
+    dilation: int,
+    backend: Optional[str] = None,
   ):
-    super().__init__(cfg, dim, num_heads, kernel_size, dilation)
+    super().__init__(cfg, dim, num_heads, kernel_size, dilation, backend)
     self.rpb = nn.Parameter(
       torch.zeros(num_heads, (2 * self.kernel_size - 1)),
       requires_grad=True,
     )
-    self.nattendqkrpb = natten1dqkrpb
-    self.nattendav = natten1dav
 
 
 class NeighborhoodAttention2d(_NeighborhoodAttentionNd):
+  attention_ndim = 2
+
   def __init__(
     self,
     cfg: Config,
     dim: int,
     num_heads: int,
     kernel_size: int,
-    dilation: int
+    dilation: int,
+    backend: Optional[str] = None,
   ):
-    super().__init__(cfg, dim, num_heads, kernel_size, dilation)
+    super().__init__(cfg, dim, num_heads, kernel_size, dilation, backend)
     self.rpb = nn.Parameter(
       torch.zeros(num_heads, (2 * self.kernel_size - 1), (2 * self.kernel_size - 1)),
       requires_grad=True,
     )
-    self.nattendqkrpb = natten2dqkrpb
-    self.nattendav = natten2dav
+
+  def forward_dense(self, hidden_states: torch.Tensor) -> torch.Tensor:
+    """
+    Same as `forward` on the input zero-padded to kernel_size along the first axis, for inputs no longer than the
+    kernel along it and with dilation 1 (see `instrument_qk_rpb`). Works with both backends.
+    """
+    query_layer = self.transpose_for_scores(self.query(hidden_states)) / math.sqrt(self.attention_head_size)
+    key_layer = self.transpose_for_scores(self.key(hidden_states))
+    value_layer = self.transpose_for_scores(self.value(hidden_states))
+    key_bias, value_bias = linear_bias(self.key), linear_bias(self.value)
+    if key_bias is not None:
+      key_bias = key_bias.view(self.num_attention_heads, self.attention_head_size)
+      value_bias = value_bias.view(self.num_attention_heads, self.attention_head_size)
+
+    attention_scores = instrument_qk_rpb(query_layer, key_layer, self.rpb, self.kernel_size, key_bias)
+    attention_probs = self.dropout(nn.functional.softmax(attention_scores, dim=-1))
+    context_layer = instrument_av(attention_probs, value_layer, self.kernel_size, value_bias)
+    context_layer = context_layer.permute(0, 2, 3, 1, 4).contiguous()
+    return context_layer.view(context_layer.size()[:-2] + (self.all_head_size,))
 
 
 # Copied from transformers.models.nat.modeling_nat.NeighborhoodAttentionOutput
@@ -257,10 +314,10 @@ class _DinatLayerNd(ABC, nn.Module):
     self.window_size = self.kernel_size * self.dilation
     if double_attention:
       self.window_size *= 2
-    self.layernorm_before = nn.LayerNorm(dim, eps=cfg.layer_norm_eps)
+    self.layernorm_before = FP32LayerNorm(dim, eps=cfg.layer_norm_eps)
     self.drop_path = DinatDropPath(drop_path_rate) if drop_path_rate > 0.0 else nn.Identity()
     dim_after = dim * 2 if double_attention else dim
-    self.layernorm_after = nn.LayerNorm(dim_after, eps=cfg.layer_norm_eps)
+    self.layernorm_after = FP32LayerNorm(dim_after, eps=cfg.layer_norm_eps)
     self.intermediate = DinatIntermediate(cfg, dim_after, int(dim_after * cfg.mlp_ratio))
     self.output = DinatOutput(cfg, int(dim_after * cfg.mlp_ratio), dim)
   
@@ -301,11 +358,11 @@ class _DinatLayerNd(ABC, nn.Module):
       if is_2d:
         was_padded = pad_values[3] > 0 or pad_values[5] > 0
         if was_padded:
-          attention_output = attention_output[:, :K, :T, :].contiguous()
+          attention_output = _crop_time(attention_output[:, :K], _length(shortcut, 2)).contiguous()
       else:
         was_padded = pad_values[3] > 0
         if was_padded:
-          attention_output = attention_output[:, :T, :].contiguous()
+          attention_output = _crop_time(attention_output, _length(shortcut, 1)).contiguous()
       
       hidden_states = shortcut + self.drop_path(attention_output)
       hidden_states_list.append(hidden_states)
@@ -325,6 +382,22 @@ class _DinatLayerNd(ABC, nn.Module):
     return layer_outputs
 
 
+def _pad_time(hidden_states: torch.Tensor, window_size: int) -> torch.Tensor:
+  """
+  Zero-pads the time axis (-2) to `window_size` if it is shorter, like `maybe_pad`, but without branching on the
+  length, so that a traced graph pads every input the way eager mode does.
+  """
+  length = torch.clamp(_length(hidden_states, -2), min=window_size)
+  padded = nn.functional.pad(hidden_states, (0, 0, 0, window_size))
+  return padded.index_select(-2, torch.arange(length, device=hidden_states.device))
+
+
+def _crop_time(hidden_states: torch.Tensor, length) -> torch.Tensor:
+  if torch.jit.is_tracing():
+    return hidden_states.index_select(-2, torch.arange(length, device=hidden_states.device))
+  return hidden_states[..., :length, :]
+
+
 class DinatLayer1d(_DinatLayerNd):
   def __init__(
     self,
@@ -346,6 +419,8 @@ class DinatLayer1d(_DinatLayerNd):
   def maybe_pad(self, hidden_states, frames):
     window_size = self.window_size
     pad_values = (0, 0, 0, 0)
+    if torch.jit.is_tracing():
+      return _pad_time(hidden_states, window_size), (0, 0, 0, window_size)
     if frames < window_size:
       pad_l = 0
       pad_r = max(0, window_size - frames)
@@ -355,6 +430,9 @@ class DinatLayer1d(_DinatLayerNd):
 
 
 class DinatLayer2d(_DinatLayerNd):
+  # Attend densely over the instrument axis instead of padding it to the kernel size (see `forward_dense`).
+  dense_instruments: bool = True
+
   def __init__(
     self,
     cfg: Config,
@@ -371,6 +449,10 @@ class DinatLayer2d(_DinatLayerNd):
   def maybe_pad(self, hidden_states, height, width):
     window_size = self.window_size
     pad_values = (0, 0, 0, 0, 0, 0)
+    if torch.jit.is_tracing():
+      pad_b = max(0, window_size - height)  # the instrument axis has a static size
+      hidden_states = nn.functional.pad(hidden_states, (0, 0, 0, 0, 0, pad_b))
+      return _pad_time(hidden_states, window_size), (0, 0, 0, window_size, 0, pad_b)
     if height < window_size or width < window_size:
       pad_l = pad_t = 0
       pad_r = max(0, window_size - width)
@@ -378,3 +460,32 @@ class DinatLayer2d(_DinatLayerNd):
       pad_values = (0, 0, pad_l, pad_r, pad_t, pad_b)
       hidden_states = nn.functional.pad(hidden_states, pad_values)
     return hidden_states, pad_values
+
+  def can_use_dense(self, height: int, width: int) -> bool:
+    return self.dense_instruments and self.dilation == 1 and height <= self.kernel_size <= width
+
+  def forward(
+    self,
+    hidden_states: torch.Tensor,
+    output_attentions: Optional[bool] = False,
+  ) -> Tuple[torch.Tensor, torch.Tensor]:
+    N, K, T, C = hidden_states.shape
+    if not self.can_use_dense(K, T):
+      return super().forward(hidden_states, output_attentions)
+
+    shortcut = hidden_states
+    hidden_states = self.layernorm_before(hidden_states)
+    attention_output = self.attention.output(self.attention.self.forward_dense(hidden_states))
+    hidden_states = shortcut + self.drop_path(attention_output)
+
+    layer_output = self.layernorm_after(hidden_states)
+    layer_output = self.output(self.intermediate(layer_output))
+    return (hidden_states + self.drop_path(layer_output),)
+
+
+def set_dense_instruments(model: nn.Module, enabled: bool) -> nn.Module:
+  """Switches the dense instrument attention of every 2D layer in the model on or off in place."""
+  for module in model.modules():
+    if hasattr(module, 'dense_instruments'):
+      module.dense_instruments = enabled
+  return model
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 
-from typing import List
+from typing import List, Optional
 from .allinone import AllInOne
 from ..typings import AllInOneOutput
 
@@ -10,21 +10,79 @@ class Ensemble(nn.Module):
   def __init__(self, models: List[AllInOne]):
     super().__init__()
 
-    cfg = models[0].cfg.copy()
-    cfg.best_threshold_beat = sum([model.cfg.best_threshold_beat for model in models]) / len(models)
-    cfg.best_threshold_downbeat = sum([model.cfg.best_threshold_downbeat for model in models]) / len(models)
+    self.cfg = make_ensemble_config(models)
+    # ModuleList so parameters are visible to .to(), .eval() and memory accounting; the fold modules themselves
+    # are not copied and may be shared with other models.
+    self.models = nn.ModuleList(models)
 
-    self.cfg = cfg
-    self.models = models
+  def forward(self, x, tasks: Optional[List[str]] = None, include_embeddings: bool = True):
+    outputs: List[AllInOneOutput] = [
+      model(x, tasks=tasks, include_embeddings=include_embeddings)
+      for model in self.models
+    ]
+    return average_outputs(outputs)
 
-  def forward(self, x):
-    outputs: List[AllInOneOutput] = [model(x) for model in self.models]
-    avg = AllInOneOutput(
-      logits_beat=torch.stack([output.logits_beat for output in outputs], dim=0).mean(dim=0),
-      logits_downbeat=torch.stack([output.logits_downbeat for output in outputs], dim=0).mean(dim=0),
-      logits_section=torch.stack([output.logits_section for output in outputs], dim=0).mean(dim=0),
-      logits_function=torch.stack([output.logits_function for output in outputs], dim=0).mean(dim=0),
-      embeddings=torch.stack([output.embeddings for output in outputs], dim=-1),
-    )
 
-    return avg
+class AdaptiveEnsemble(Ensemble):
+  """
+  Evaluates the folds one at a time and stops early once the running mean of the beat, downbeat and section logits
+  has converged: i.e., adding the last fold moved no frame's sigmoid probability by `tolerance` or more. At least
+  `min_models` folds are always evaluated. The number of folds used is reported in `AllInOneOutput.num_models`.
+  """
+
+  def __init__(self, models: List[AllInOne], tolerance: float = 0.01, min_models: int = 2):
+    super().__init__(models)
+    self.tolerance = tolerance
+    self.min_models = min_models
+
+  def forward(self, x, tasks: Optional[List[str]] = None, include_embeddings: bool = True):
+    keys = ['logits_beat', 'logits_downbeat', 'logits_section']
+    outputs: List[AllInOneOutput] = []
+    sums = None
+    prev_probs = None
+    for model in self.models:
+      output = model(x, tasks=tasks, include_embeddings=include_embeddings)
+      outputs.append(output)
+
+      if sums is None:
+        keys = [key for key in keys if getattr(output, key) is not None]
+        sums = {key: getattr(output, key).clone() for key in keys}
+      else:
+        for key in keys:
+          sums[key] += getattr(output, key)
+      probs = {key: torch.sigmoid(sums[key] / len(outputs)) for key in keys}
+
+      if prev_probs is not None and len(outputs) >= self.min_models:
+        delta = max((probs[key] - prev_probs[key]).abs().max().item() for key in keys)
+        if delta < self.tolerance:
+          break
+      prev_probs = probs
+
+    return average_outputs(outputs)
+
+
+def average_outputs(outputs: List[AllInOneOutput]) -> AllInOneOutput:
+  def mean(key):
+    # Logits of heads that were skipped (see `tasks` in AllInOne.forward) stay None.
+    if getattr(outputs[0], key) is None:
+      return None
+    return torch.stack([getattr(output, key) for output in outputs], dim=0).mean(dim=0)
+
+  return AllInOneOutput(
+    logits_beat=mean('logits_beat'),
+    logits_downbeat=mean('logits_downbeat'),
+    logits_section=mean('logits_section'),
+    logits_function=mean('logits_function'),
+    embeddings=(
+      torch.stack([output.embeddings for output in outputs], dim=-1)
+      if outputs[0].embeddings is not None else None
+    ),
+    num_models=len(outputs),
+  )
+
+
+def make_ensemble_config(models: List[AllInOne]):
+  cfg = models[0].cfg.copy()
+  cfg.best_threshold_beat = sum([model.cfg.best_threshold_beat for model in models]) / len(models)
+  cfg.best_threshold_downbeat = sum([model.cfg.best_threshold_downbeat for model in models]) / len(models)
+  return cfg
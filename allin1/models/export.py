@@ -0,0 +1,256 @@
+"""ONNX export of AllInOne models and onnxruntime inference.
+
+A fold or a (serial) `Ensemble` is traced with the pure-PyTorch neighborhood attention, which exports to plain
+Gather/Einsum ops, with dynamic batch and time axes. Layers whose dilated window is longer than the input zero-pad
+it to the window inside the graph, as in eager mode (see `dinat._pad_time`), so the logits of short tracks match
+those of the PyTorch model. Only inputs shorter than `min_frames` (the instrument attention's kernel, a few frames)
+are zero-padded by `OnnxModel` before the graph. The model config is stored in the ONNX metadata, so the exported
+file is all that inference needs.
+
+Run `python -m allin1.models.export -m harmonix-all -o harmonix-all.onnx` to export a model, or add `--per-fold`
+to export every fold of an ensemble to its own file.
+"""
+
+import argparse
+import inspect
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+
+from typing import List, Optional, Union
+from omegaconf import OmegaConf
+from .batched import BatchedEnsemble
+from .compiled import _TupleOutput
+from .dinat import DinatLayer2d, set_attention_backend
+from .ensemble import Ensemble, AdaptiveEnsemble, make_ensemble_config
+from .loaders import ENSEMBLE_MODELS, load_pretrained_model
+from .utils import copy_sharing_weights
+from ..typings import AllInOneOutput, PathLike
+from ..utils import mkpath
+
+INFERENCE_BACKENDS = ['torch', 'onnxruntime']
+# Bumped when exported graphs change; files from other versions are exported again by `load_onnx_model`.
+EXPORT_VERSION = 2
+DEFAULT_ONNX_DIR = '~/.cache/allin1/onnx'
+OUTPUT_NAMES = ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function', 'embeddings']
+
+_ONNX_MODELS = {}
+
+
+def min_frames(model: nn.Module) -> int:
+  """Shortest input the exported graph supports: the widest window of the 2D (instrument) attention."""
+  return max(module.window_size for module in model.modules() if isinstance(module, DinatLayer2d))
+
+
+def _trace_frames(model: nn.Module) -> int:
+  return max(module.window_size for module in model.modules() if hasattr(module, 'window_size'))
+
+
+def export_onnx(model: nn.Module, path: PathLike, opset_version: int = 17):
+  """Exports a fold or a serial `Ensemble` to ONNX. The model given is not modified."""
+  if isinstance(model, (AdaptiveEnsemble, BatchedEnsemble)):
+    raise ValueError('Only single folds and serial ensembles can be exported to ONNX.')
+
+  path = mkpath(path)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  num_models = len(model.models) if isinstance(model, Ensemble) else None
+
+  # Trace a copy on the 'torch' backend, as the model given is usually shared (e.g. by `load_pretrained_model`).
+  traced_model = set_attention_backend(copy_sharing_weights(model), 'torch')
+  x = torch.zeros(
+    1, model.cfg.data.num_instruments, _trace_frames(model), model.cfg.dim_input,
+    device=next(model.parameters()).device,
+  )
+  kwargs = {}
+  if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+    kwargs['dynamo'] = False  # the TorchScript exporter, which handles the dynamic axes below
+  tmp_path = path.with_name(f'.{path.name}.tmp')
+  with torch.no_grad():
+    torch.onnx.export(
+      _TupleOutput(traced_model).eval(),
+      (x,),
+      str(tmp_path),
+      input_names=['spec'],
+      output_names=OUTPUT_NAMES,
+      dynamic_axes={
+        'spec': {0: 'batch', 2: 'time'},
+        'logits_beat': {0: 'batch', 1: 'time'},
+        'logits_downbeat': {0: 'batch', 1: 'time'},
+        'logits_section': {0: 'batch', 1: 'time'},
+        'logits_function': {0: 'batch', 2: 'time'},
+        'embeddings': {0: 'batch', 2: 'time'},
+      },
+      opset_version=opset_version,
+      **kwargs,
+    )
+
+  import onnx
+
+  onnx_model = onnx.load(str(tmp_path))
+  metadata = {
+    'allin1_config': OmegaConf.to_yaml(model.cfg),
+    'allin1_min_frames': str(min_frames(model)),
+    'allin1_export_version': str(EXPORT_VERSION),
+    'allin1_num_models': str(num_models or ''),
+  }
+  for key, value in metadata.items():
+    entry = onnx_model.metadata_props.add()
+    entry.key, entry.value = key, value
+  onnx.save(onnx_model, str(tmp_path))
+  os.replace(tmp_path, path)
+  return path
+
+
+class _OnnxFold:
+  def __init__(self, session):
+    self.session = session
+    metadata = session.get_modelmeta().custom_metadata_map
+    self.cfg = OmegaConf.create(metadata['allin1_config'])
+    self.min_frames = int(metadata['allin1_min_frames'])
+    self.num_models = int(metadata['allin1_num_models']) if metadata['allin1_num_models'] else None
+
+
+class OnnxModel:
+  """
+  Runs exported AllInOne models with onnxruntime and returns `AllInOneOutput`s like the PyTorch models do. Given
+  several files (e.g. one per fold), their outputs are averaged like an `Ensemble`.
+  """
+
+  def __init__(
+    self,
+    paths: Union[PathLike, List[PathLike]],
+    intra_op_threads: Optional[int] = None,
+    inter_op_threads: Optional[int] = None,
+    providers: Optional[List[str]] = None,
+  ):
+    import onnxruntime as ort
+
+    if not isinstance(paths, (list, tuple)):
+      paths = [paths]
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads is not None:
+      options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads is not None:
+      options.inter_op_num_threads = inter_op_threads
+      if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    providers = providers or ['CPUExecutionProvider']
+
+    self.folds = [
+      _OnnxFold(ort.InferenceSession(str(mkpath(path)), options, providers=providers))
+      for path in paths
+    ]
+    self.cfg = self.folds[0].cfg if len(self.folds) == 1 else make_ensemble_config(self.folds)
+    self.min_frames = max(fold.min_frames for fold in self.folds)
+
+  def __call__(
+    self,
+    spec: torch.Tensor,
+    tasks: Optional[List[str]] = None,
+    include_embeddings: bool = True,
+  ) -> AllInOneOutput:
+    # spec has shape of: N, K, T, F
+    # tasks is accepted for interface compatibility; the exported graphs always compute every head.
+    x = spec.detach().cpu().float().numpy()
+    T = x.shape[2]
+    if T < self.min_frames:
+      # Shorter than the graph supports (graphs of older exports need their widest window); the last frames differ
+      # from eager mode, which pads every layer instead.
+      x = np.pad(x, ((0, 0), (0, 0), (0, self.min_frames - T), (0, 0)))
+
+    names = OUTPUT_NAMES if include_embeddings else OUTPUT_NAMES[:-1]
+    outputs = [dict(zip(names, fold.session.run(names, {'spec': x}))) for fold in self.folds]
+    if len(outputs) == 1:
+      output, num_models = outputs[0], self.folds[0].num_models
+    else:
+      # Weigh each file by its number of folds, so ensemble and per-fold files can be mixed.
+      weights = [fold.num_models or 1 for fold in self.folds]
+      num_models = sum(weights)
+      output = {
+        key: sum(o[key] * w for o, w in zip(outputs, weights)) / num_models
+        for key in OUTPUT_NAMES[:-1]
+      }
+      if include_embeddings:
+        output['embeddings'] = np.concatenate([
+          o['embeddings'] if fold.num_models else o['embeddings'][..., None]
+          for o, fold in zip(outputs, self.folds)
+        ], axis=-1)
+
+    return AllInOneOutput(
+      logits_beat=torch.from_numpy(output['logits_beat'][..., :T]),
+      logits_downbeat=torch.from_numpy(output['logits_downbeat'][..., :T]),
+      logits_section=torch.from_numpy(output['logits_section'][..., :T]),
+      logits_function=torch.from_numpy(output['logits_function'][..., :T]),
+      embeddings=(
+        torch.from_numpy(np.ascontiguousarray(output['embeddings'][:, :, :T]))
+        if include_embeddings else None
+      ),
+      num_models=num_models,
+    )
+
+
+def load_onnx_model(
+  model_name: str = 'harmonix-all',
+  onnx_dir: Optional[PathLike] = None,
+  intra_op_threads: Optional[int] = None,
+  inter_op_threads: Optional[int] = None,
+  cache_dir: Optional[PathLike] = None,
+  cached: bool = True,
+) -> OnnxModel:
+  """
+  Loads `<onnx_dir>/<model_name>.onnx` (or `model_name` itself if it is a path to an .onnx file), exporting the
+  pretrained model there first if the file does not exist yet or comes from an older export. Sessions are reused
+  across calls when `cached`.
+  """
+  exported = str(model_name).endswith('.onnx')
+  path = mkpath(model_name) if exported else mkpath(onnx_dir or DEFAULT_ONNX_DIR) / f'{model_name}.onnx'
+  key = (str(path), intra_op_threads, inter_op_threads)
+  if cached and key in _ONNX_MODELS:
+    return _ONNX_MODELS[key]
+
+  if not exported and (not path.is_file() or _export_version(path) != EXPORT_VERSION):
+    print(f'=> Exporting {model_name} to {path}...')
+    export_onnx(load_pretrained_model(model_name, cache_dir=cache_dir, device='cpu'), path)
+  model = OnnxModel(path, intra_op_threads, inter_op_threads)
+  if cached:
+    _ONNX_MODELS[key] = model
+  return model
+
+
+def _export_version(path) -> Optional[int]:
+  import onnx
+
+  metadata = {entry.key: entry.value for entry in onnx.load(str(path), load_external_data=False).metadata_props}
+  return int(metadata['allin1_export_version']) if 'allin1_export_version' in metadata else None
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='Export a pretrained AllInOne model to ONNX.')
+  parser.add_argument('-m', '--model', type=str, default='harmonix-all',
+                      help='Name of the pretrained model to export (default: harmonix-all)')
+  parser.add_argument('-o', '--out', type=str, default=None,
+                      help='Output .onnx file, or directory with --per-fold (default: <model>.onnx)')
+  parser.add_argument('--per-fold', action='store_true',
+                      help='Export every fold of an ensemble to its own file (default: False)')
+  parser.add_argument('--opset', type=int, default=17, help='ONNX opset version (default: 17)')
+  return parser
+
+
+def main():
+  args = make_parser().parse_args()
+  model = load_pretrained_model(args.model, device='cpu')
+  if args.per_fold:
+    assert args.model in ENSEMBLE_MODELS, f'{args.model} is not an ensemble'
+    out_dir = mkpath(args.out or '.')
+    for fold_name, fold in zip(ENSEMBLE_MODELS[args.model], model.models):
+      path = export_onnx(fold, out_dir / f'{fold_name}.onnx', args.opset)
+      print(f'=> Exported {fold_name} to {path}')
+  else:
+    path = export_onnx(model, args.out or f'{args.model}.onnx', args.opset)
+    print(f'=> Exported {args.model} to {path}')
+
+
+if __name__ == '__main__':
+  main()
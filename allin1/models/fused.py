@@ -0,0 +1,236 @@
+"""Inference-only fused graph of AllInOne, converted from a loaded model.
+
+- The query, key and value projections of a neighborhood attention are one matmul, and the two attentions
+  (dilations d and 2d) of a double-attention layer share that matmul, as they project the same input. The
+  1/sqrt(head_dim) query scaling is folded into the weights.
+- Their output projections are one block-diagonal matmul over the concatenated contexts.
+- Inputs shorter than a layer's attention window are zero-padded into one buffer allocated per forward pass and
+  shared by all layers, instead of a fresh `F.pad` in every layer. Only the first T frames of the buffer are ever
+  written, so the padding stays zero as in the original. The instrument layers attend densely over the instruments
+  when the original does (see `DinatLayer2d.dense_instruments`), and need no padding then.
+- The four classifier heads are one linear layer.
+
+The outputs match the original model up to float rounding. Dropout and drop path are left out, so the fused model
+cannot be trained.
+"""
+
+import math
+import torch
+import torch.nn as nn
+
+from typing import List, Optional
+from .allinone import AllInOne, Head
+from .dinat import _DinatLayerNd, get_attention_functions
+from .neighborhood import instrument_av, instrument_qk_rpb
+from .ensemble import Ensemble, AdaptiveEnsemble
+from .batched import BatchedEnsemble
+from .utils import linear_bias
+from ..typings import AllInOneOutput
+
+
+def _fused_linear(linears: List[nn.Linear], scales: Optional[List[float]] = None) -> nn.Linear:
+  """Concatenates the outputs of linear layers over the same input into one linear layer."""
+  scales = scales or [1.0] * len(linears)
+  weight = torch.cat([linear.weight * scale for linear, scale in zip(linears, scales)])
+  bias = torch.cat([
+    linear.bias * scale if linear.bias is not None else linear.weight.new_zeros(linear.out_features)
+    for linear, scale in zip(linears, scales)
+  ])
+  fused = nn.Linear(weight.shape[1], weight.shape[0]).to(weight.device)
+  fused.weight.data.copy_(weight)
+  fused.bias.data.copy_(bias)
+  return fused
+
+
+def _block_diagonal_linear(linears: List[nn.Linear]) -> nn.Linear:
+  """Applies each linear layer to its own slice of the input and concatenates the outputs."""
+  weight = torch.block_diag(*[linear.weight for linear in linears])
+  bias = torch.cat([linear.bias for linear in linears])
+  fused = nn.Linear(weight.shape[1], weight.shape[0]).to(weight.device)
+  fused.weight.data.copy_(weight)
+  fused.bias.data.copy_(bias)
+  return fused
+
+
+class FusedDinatLayer(nn.Module):
+  def __init__(self, layer: _DinatLayerNd):
+    super().__init__()
+    modules = [layer.attention] + ([layer.attention2] if layer.double_attention else [])
+    attentions = [module.self for module in modules]
+    first = attentions[0]
+    self.attention_ndim = first.attention_ndim
+    self.backend = first.backend
+    self.nattendqkrpb, self.nattendav = get_attention_functions(self.backend, self.attention_ndim)
+    self.num_heads = first.num_attention_heads
+    self.head_dim = first.attention_head_size
+    self.kernel_size = first.kernel_size
+    self.dilations = [attention.dilation for attention in attentions]
+    self.window_size = layer.window_size
+    self.dense_instruments = self.attention_ndim == 2 and layer.dense_instruments
+
+    scale = 1 / math.sqrt(self.head_dim)
+    self.qkv = _fused_linear(
+      [linear for attention in attentions for linear in [attention.query, attention.key, attention.value]],
+      [s for _ in attentions for s in [scale, 1.0, 1.0]],
+    )
+    self.rpbs = nn.ParameterList([attention.rpb for attention in attentions])
+    self.proj = _block_diagonal_linear([module.output.dense for module in modules])
+
+    self.layernorm_before = layer.layernorm_before
+    self.layernorm_after = layer.layernorm_after
+    self.intermediate = layer.intermediate
+    self.output = layer.output
+
+  def can_use_dense(self, lengths) -> bool:
+    return self.dense_instruments and self.dilations == [1] and lengths[0] <= self.kernel_size <= lengths[-1]
+
+  def needs_padding(self, lengths) -> bool:
+    return not self.can_use_dense(lengths) and any(length < self.window_size for length in lengths)
+
+  def forward(self, hidden_states: torch.Tensor, pad_buffer: Optional[torch.Tensor] = None) -> torch.Tensor:
+    # hidden_states has shape of: B, T, C for 1D and B, K, T, C for 2D.
+    # pad_buffer: zeros of shape B, [K', ]T', C with K' and T' at least the window size, if any axis needs padding.
+    shortcut = hidden_states
+    hidden_states = self.layernorm_before(hidden_states)
+
+    lengths = hidden_states.shape[1:-1]
+    crop = (slice(None),) + tuple(slice(0, length) for length in lengths)
+    dense = self.can_use_dense(lengths)
+    needs_padding = self.needs_padding(lengths)
+    if needs_padding:
+      pad_buffer[crop] = hidden_states
+      hidden_states = pad_buffer[(slice(None),) + tuple(
+        slice(0, max(length, self.window_size)) for length in lengths
+      )]
+
+    # B, *S, A x 3 x heads x D -> A, 3, B, heads, *S, D
+    s = len(lengths)
+    qkv = self.qkv(hidden_states).unflatten(-1, (len(self.dilations), 3, self.num_heads, self.head_dim))
+    qkv = qkv.permute(1 + s, 2 + s, 0, 3 + s, *range(1, 1 + s), 4 + s)
+
+    contexts = []
+    if dense:
+      query, key, value = qkv[0]
+      bias = linear_bias(self.qkv).view(3, self.num_heads, self.head_dim)  # the key and value biases, per head
+      attention_probs = instrument_qk_rpb(query, key, self.rpbs[0], self.kernel_size, bias[1]).softmax(dim=-1)
+      contexts.append(instrument_av(attention_probs, value, self.kernel_size, bias[2]))
+    else:
+      for i, dilation in enumerate(self.dilations):
+        query, key, value = qkv[i]
+        attention_probs = self.nattendqkrpb(query, key, self.rpbs[i], self.kernel_size, dilation).softmax(dim=-1)
+        contexts.append(self.nattendav(attention_probs, value, self.kernel_size, dilation))
+    context = torch.cat(contexts, dim=1)  # B, A x heads, *S, D
+    context = context.permute(0, *range(2, 2 + s), 1, 2 + s).flatten(-2)  # B, *S, A x C
+    if needs_padding:
+      context = context[crop]
+
+    attention_output = self.proj(context)  # B, *S, A x C
+    if len(self.dilations) > 1:
+      hidden_states = torch.cat([shortcut] * len(self.dilations), dim=-1) + attention_output
+      shortcut = hidden_states.unflatten(-1, (len(self.dilations), -1)).sum(dim=-2) / 2.
+    else:
+      hidden_states = shortcut + attention_output
+      shortcut = hidden_states
+
+    layer_output = self.layernorm_after(hidden_states)
+    layer_output = self.output(self.intermediate(layer_output))
+    return shortcut + layer_output
+
+
+class FusedHeads(nn.Module):
+  def __init__(self, heads: List[Head]):
+    super().__init__()
+    self.num_classes = [head.classifier.out_features for head in heads]
+    self.classifier = _fused_linear([head.classifier for head in heads])
+
+  def forward(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
+    # x has shape of: N, K, T, C
+    N, K, T, C = x.shape
+    logits = self.classifier(x.permute(0, 2, 1, 3).reshape(N, T, K * C))  # N, T, classes of all heads
+    logits = logits.permute(0, 2, 1)  # N, classes of all heads, T
+    return [
+      logits_head.squeeze(1) if logits_head.shape[1] == 1 else logits_head
+      for logits_head in logits.split(self.num_classes, dim=1)
+    ]
+
+
+class FusedAllInOne(nn.Module):
+  def __init__(self, model: AllInOne):
+    super().__init__()
+    self.cfg = model.cfg
+    self.num_levels = model.num_levels
+    self.instrument_attention = model.cfg.instrument_attention
+
+    self.embeddings = model.embeddings
+    self.timelayers = nn.ModuleList([FusedDinatLayer(block.timelayer) for block in model.encoder.layers])
+    self.instlayers = nn.ModuleList([FusedDinatLayer(block.instlayer) for block in model.encoder.layers])
+    self.norm = model.norm
+    self.heads = FusedHeads([
+      model.beat_classifier,
+      model.downbeat_classifier,
+      model.section_classifier,
+      model.function_classifier,
+    ])
+
+  def forward(
+    self,
+    inputs: torch.FloatTensor,
+    output_attentions: Optional[bool] = None,
+    tasks: Optional[List[str]] = None,
+    include_embeddings: bool = True,
+    output_levels: Optional[List[int]] = None,
+  ) -> AllInOneOutput:
+    # x has shape of: N, K, T, F
+    # The arguments are the same as for AllInOne.forward; attentions cannot be returned.
+    N, K, T, F = inputs.shape
+    hidden_states = self.embeddings(inputs.reshape(-1, 1, T, F))  # NK, T, C
+
+    time_window = max(layer.window_size for layer in self.timelayers)
+    time_buffer = inst_buffer = None
+    if T < time_window:
+      time_buffer = hidden_states.new_zeros(N * K, time_window, hidden_states.shape[-1])
+    if self.instrument_attention:
+      inst_window = max(layer.window_size for layer in self.instlayers)
+      if any(layer.needs_padding((K, T)) for layer in self.instlayers):
+        inst_buffer = hidden_states.new_zeros(N, max(K, inst_window), max(T, inst_window), hidden_states.shape[-1])
+    elif T < max(layer.window_size for layer in self.instlayers):
+      inst_buffer = time_buffer
+
+    levels = [level % self.num_levels for level in output_levels or []]
+    hidden_state_levels = {}
+    for i, (timelayer, instlayer) in enumerate(zip(self.timelayers, self.instlayers)):
+      hidden_states = timelayer(hidden_states, time_buffer)
+      if self.instrument_attention:
+        hidden_states = instlayer(hidden_states.reshape(N, K, T, -1), inst_buffer).reshape(N * K, T, -1)
+      else:
+        hidden_states = instlayer(hidden_states, inst_buffer)
+      if i in levels:
+        hidden_state_levels[i] = hidden_states.reshape(N, K, T, -1)
+
+    hidden_states = hidden_states.reshape(N, K, T, -1)
+    with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+      hidden_states = self.norm(hidden_states.float())
+      logits_beat, logits_downbeat, logits_section, logits_function = self.heads(hidden_states)
+
+    beats = tasks is None or 'beats' in tasks
+    segments = tasks is None or 'segments' in tasks
+    return AllInOneOutput(
+      logits_beat=logits_beat if beats else None,
+      logits_downbeat=logits_downbeat if beats else None,
+      logits_section=logits_section if segments else None,
+      logits_function=logits_function if segments else None,
+      embeddings=hidden_states if include_embeddings else None,
+      hidden_state_levels=[hidden_state_levels[level] for level in levels] if output_levels is not None else None,
+    )
+
+
+def fuse_model(model: nn.Module) -> nn.Module:
+  """Returns the fused inference graph of a fold, serial ensemble or adaptive ensemble. The weights are shared."""
+  if isinstance(model, BatchedEnsemble):
+    raise ValueError('The batched ensemble cannot be fused; use the serial or adaptive ensemble mode.')
+  if isinstance(model, AdaptiveEnsemble):
+    return AdaptiveEnsemble([fuse_model(fold) for fold in model.models], model.tolerance, model.min_models).eval()
+  if isinstance(model, Ensemble):
+    return Ensemble([fuse_model(fold) for fold in model.models]).eval()
+  with torch.no_grad():
+    return FusedAllInOne(model).eval()
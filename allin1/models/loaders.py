@@ -1,10 +1,22 @@
+import json
+import threading
+import time
 import torch
 
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from omegaconf import OmegaConf
 from huggingface_hub import hf_hub_download
 from .allinone import AllInOne
-from .ensemble import Ensemble
+from .ensemble import Ensemble, AdaptiveEnsemble
+from .batched import BatchedEnsemble
+from .compiled import CompiledModel
+from .dinat import DEFAULT_ATTENTION_BACKEND, set_attention_backend
+from .fused import fuse_model
+from .quantization import quantize_model
+from .store import get_store_dir, has_model, load_from_store
+from .utils import copy_sharing_weights
 from ..typings import PathLike
 
 NAME_TO_FILE = {
@@ -31,33 +43,167 @@ ENSEMBLE_MODELS = {
   ],
 }
 
+# serial: evaluates the folds one after another.
+# batched: stacks the fold parameters and evaluates all folds in one batched forward pass.
+# adaptive: evaluates the folds one after another and stops once their running mean has converged.
+ENSEMBLE_MODES = ['serial', 'batched', 'adaptive']
+
+
+class ModelRegistry:
+  """
+  Process-wide LRU cache of loaded models keyed by (model name, device).
+
+  Ensembles are assembled from the cached fold models, so a fold shared between an ensemble and a single-fold
+  request is only held once. Memory is accounted per unique tensor storage, and the least recently used entries are
+  evicted once the total exceeds `max_memory` bytes. Entries that share storages (an ensemble and its folds, or a
+  model and its copies on other attention backends) are evicted together, as evicting only some of them frees
+  nothing, and are as recent as their most recently used entry.
+  """
+
+  def __init__(self, max_memory: Optional[int] = 1024 ** 3):
+    self.max_memory = max_memory
+    self._models: 'OrderedDict[Tuple[str, str], torch.nn.Module]' = OrderedDict()
+    self._lock = threading.RLock()
+
+  def get(self, model_name: str, device) -> Optional[torch.nn.Module]:
+    key = (model_name, _device_key(device))
+    with self._lock:
+      model = self._models.get(key)
+      if model is not None:
+        self._models.move_to_end(key)
+      return model
+
+  def put(self, model_name: str, device, model: torch.nn.Module):
+    key = (model_name, _device_key(device))
+    with self._lock:
+      self._models[key] = model
+      self._models.move_to_end(key)
+      self._evict()
+
+  def memory_usage(self) -> int:
+    with self._lock:
+      return _unique_nbytes(self._models.values())
+
+  def keys(self):
+    with self._lock:
+      return list(self._models.keys())
+
+  def clear(self):
+    with self._lock:
+      self._models.clear()
+
+  def _evict(self):
+    if self.max_memory is None:
+      return
+    while self.memory_usage() > self.max_memory:
+      storages = {key: _storage_ptrs(model) for key, model in self._models.items()}
+      # Groups of entries sharing storages, most recently used first.
+      groups = []
+      for key in reversed(storages):
+        if not any(key in group for group in groups):
+          groups.append(_sharing_group(key, storages))
+      # Never evict the most recent entry, even if it alone exceeds the budget.
+      if len(groups) < 2:
+        return
+      for key in groups[-1]:
+        del self._models[key]
+
+
+MODEL_REGISTRY = ModelRegistry()
+
 
 def load_pretrained_model(
   model_name: Optional[str] = None,
   cache_dir: Optional[PathLike] = None,
   device=None,
+  cached: bool = True,
+  store_dir: Optional[PathLike] = None,
+  ensemble_mode: str = 'serial',
+  ensemble_tolerance: float = 0.01,
+  quantize: Optional[str] = None,
+  attention_backend: Optional[str] = None,
+  compile_mode: Optional[str] = None,
+  compile_cache_dir: Optional[PathLike] = None,
+  fused: bool = False,
 ):
-  if model_name in ENSEMBLE_MODELS:
-    return load_ensemble_model(model_name, cache_dir, device)
-
-  model_name = model_name or list(NAME_TO_FILE.keys())[0]
-  assert model_name in NAME_TO_FILE, f'Unknown model name: {model_name} (expected one of {list(NAME_TO_FILE.keys())})'
+  if model_name not in ENSEMBLE_MODELS:
+    model_name = model_name or list(NAME_TO_FILE.keys())[0]
+    assert model_name in NAME_TO_FILE, f'Unknown model name: {model_name} (expected one of {list(NAME_TO_FILE.keys())})'
 
   if device is None:
-    if torch.cuda.device_count():
-      device = 'cuda'
-    else:
-      device = 'cpu'
+    device = _default_device()
+  if attention_backend == DEFAULT_ATTENTION_BACKEND:
+    attention_backend = None
 
-  filename = NAME_TO_FILE[model_name]
-  checkpoint_path = hf_hub_download(repo_id='taejunkim/allinone', filename=filename, cache_dir=cache_dir)
+  registry_key = model_name
+  if model_name in ENSEMBLE_MODELS and ensemble_mode == 'adaptive':
+    registry_key = f'{model_name}:{ensemble_mode}:{ensemble_tolerance}'
+  elif model_name in ENSEMBLE_MODELS and ensemble_mode != 'serial':
+    registry_key = f'{model_name}:{ensemble_mode}'
+  if fused:
+    registry_key = f'{registry_key}:fused'
+  if quantize is not None:
+    assert torch.device(device).type == 'cpu', f'Quantized models can only run on CPU, not on {device}'
+    registry_key = f'{registry_key}:{quantize}'
+  if attention_backend is not None:
+    registry_key = f'{registry_key}:{attention_backend}'
+  if compile_mode is not None:
+    registry_key = f'{registry_key}:{compile_mode}'
 
-  checkpoint = torch.load(checkpoint_path, map_location=device)
-  config = OmegaConf.create(checkpoint['config'])
+  if cached:
+    model = MODEL_REGISTRY.get(registry_key, device)
+    if model is not None:
+      return model
 
-  model = AllInOne(config).to(device)
-  model.load_state_dict(checkpoint['state_dict'])
-  model.eval()
+  if compile_mode is not None:
+    # Wrap the eager model, which is itself cached and shared as usual.
+    model = load_pretrained_model(
+      model_name, cache_dir, device, cached, store_dir,
+      ensemble_mode=ensemble_mode,
+      ensemble_tolerance=ensemble_tolerance,
+      quantize=quantize,
+      attention_backend=attention_backend,
+      fused=fused,
+    )
+    model = CompiledModel(model, compile_mode, compile_cache_dir)
+  elif attention_backend is not None:
+    # Switch a copy of the model, which is itself cached and shared as usual; the copy shares its weights.
+    model = load_pretrained_model(
+      model_name, cache_dir, device, cached, store_dir,
+      ensemble_mode=ensemble_mode,
+      ensemble_tolerance=ensemble_tolerance,
+      quantize=quantize,
+      fused=fused,
+    )
+    model = set_attention_backend(copy_sharing_weights(model), attention_backend)
+  elif quantize is not None:
+    # Quantize a copy of the fp32 model, which is itself cached and shared as usual.
+    model = load_pretrained_model(
+      model_name, cache_dir, device, cached, store_dir,
+      ensemble_mode=ensemble_mode,
+      ensemble_tolerance=ensemble_tolerance,
+      fused=fused,
+    )
+    model = quantize_model(model, quantize)
+  elif fused:
+    # Fuse the eager model, which is itself cached; the fused graph shares its norms, MLPs and embeddings.
+    model = load_pretrained_model(
+      model_name, cache_dir, device, cached, store_dir,
+      ensemble_mode=ensemble_mode,
+      ensemble_tolerance=ensemble_tolerance,
+    )
+    model = fuse_model(model)
+  elif model_name in ENSEMBLE_MODELS:
+    model = load_ensemble_model(
+      model_name, cache_dir, device, cached, store_dir,
+      ensemble_mode=ensemble_mode,
+      ensemble_tolerance=ensemble_tolerance,
+    )
+  else:
+    model = _load_single_model(model_name, cache_dir, device, store_dir)
+
+  if cached:
+    MODEL_REGISTRY.put(registry_key, device, model)
 
   return model
 
@@ -66,13 +212,148 @@ def load_ensemble_model(
   model_name: Optional[str] = None,
   cache_dir: Optional[PathLike] = None,
   device=None,
+  cached: bool = True,
+  store_dir: Optional[PathLike] = None,
+  max_workers: Optional[int] = None,
+  ensemble_mode: str = 'serial',
+  ensemble_tolerance: float = 0.01,
 ):
-  models = []
-  for model_name in ENSEMBLE_MODELS[model_name]:
-    model = load_pretrained_model(model_name, cache_dir, device)
-    models.append(model)
+  """
+  Loads the folds of an ensemble concurrently, so cold start is bounded by the slowest checkpoint rather than the
+  sum of all of them. The folds keep the order of `ENSEMBLE_MODELS`. The per-fold timing breakdown (in seconds) is
+  attached to the ensemble as `load_timings`, and the wall-clock time of the whole load as `load_time`.
+  """
+  assert ensemble_mode in ENSEMBLE_MODES, f'Unknown ensemble mode: {ensemble_mode} (expected one of {ENSEMBLE_MODES})'
+  fold_names = ENSEMBLE_MODELS[model_name]
+  if device is None:
+    device = _default_device()
 
-  ensemble = Ensemble(models).to(device)
+  def load_fold(fold_name: str):
+    timings = {}
+    start = time.perf_counter()
+    # Folds come from the registry when cached, so they are shared with single-fold requests.
+    model = MODEL_REGISTRY.get(fold_name, device) if cached else None
+    if model is None:
+      model = _load_single_model(fold_name, cache_dir, device, store_dir, timings)
+      if cached:
+        MODEL_REGISTRY.put(fold_name, device, model)
+    else:
+      timings['cached'] = True
+    timings['total'] = time.perf_counter() - start
+    return model, timings
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=max_workers or len(fold_names)) as executor:
+    outputs = list(executor.map(load_fold, fold_names))
+  elapsed = time.perf_counter() - start
+
+  models = [model for model, _ in outputs]
+  if ensemble_mode == 'batched':
+    ensemble = BatchedEnsemble(models).to(device)
+  elif ensemble_mode == 'adaptive':
+    ensemble = AdaptiveEnsemble(models, tolerance=ensemble_tolerance).to(device)
+  else:
+    ensemble = Ensemble(models).to(device)
   ensemble.eval()
 
+  ensemble.load_timings = {fold_name: timings for fold_name, (_, timings) in zip(fold_names, outputs)}
+  ensemble.load_time = elapsed
+
   return ensemble
+
+
+def register_ensemble(model_name: str, fold_names: List[str]):
+  """Registers a named ensemble of pretrained folds, e.g. a subset picked by `allin1.training.select_ensemble`."""
+  unknown = [fold_name for fold_name in fold_names if fold_name not in NAME_TO_FILE]
+  assert not unknown, f'Unknown model names: {unknown} (expected one of {list(NAME_TO_FILE.keys())})'
+  ENSEMBLE_MODELS[model_name] = list(fold_names)
+
+
+def register_ensembles(path: PathLike) -> List[str]:
+  """Registers all ensembles in a JSON file written by `allin1.training.select_ensemble`."""
+  with open(path) as f:
+    ensembles = json.load(f)
+  for model_name, ensemble in ensembles.items():
+    register_ensemble(model_name, ensemble['models'])
+  return list(ensembles.keys())
+
+
+def _load_single_model(
+  model_name: str,
+  cache_dir: Optional[PathLike],
+  device,
+  store_dir: Optional[PathLike] = None,
+  timings: Optional[Dict[str, float]] = None,
+):
+  if timings is None:
+    timings = {}
+
+  # Prefer the local model store, which needs no network and memory-maps the weights.
+  store_dir = get_store_dir(store_dir)
+  if store_dir is not None and has_model(store_dir, model_name):
+    return load_from_store(store_dir, model_name, device, timings)
+
+  start = time.perf_counter()
+  checkpoint_path = download_checkpoint(model_name, cache_dir)
+  timings['resolve'] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  checkpoint = torch.load(checkpoint_path, map_location=device)
+  config = OmegaConf.create(checkpoint['config'])
+  timings['read'] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  model = AllInOne(config).to(device)
+  timings['build'] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  model.load_state_dict(checkpoint['state_dict'])
+  model.eval()
+  timings['load_state_dict'] = time.perf_counter() - start
+
+  return model
+
+
+def download_checkpoint(model_name: str, cache_dir: Optional[PathLike] = None) -> str:
+  filename = NAME_TO_FILE[model_name]
+  return hf_hub_download(repo_id='taejunkim/allinone', filename=filename, cache_dir=cache_dir)
+
+
+def _default_device() -> str:
+  if torch.cuda.device_count():
+    return 'cuda'
+  return 'cpu'
+
+
+def _device_key(device) -> str:
+  return str(torch.device(device))
+
+
+def _storage_ptrs(model: torch.nn.Module) -> set:
+  return {tensor.untyped_storage().data_ptr() for tensor in list(model.parameters()) + list(model.buffers())}
+
+
+def _sharing_group(key, storages: Dict) -> set:
+  """The keys of the entries that share storages with `key`, directly or through other entries."""
+  group, todo = {key}, [key]
+  while todo:
+    shared = storages[todo.pop()]
+    for other, other_storages in storages.items():
+      if other not in group and shared & other_storages:
+        group.add(other)
+        todo.append(other)
+  return group
+
+
+def _unique_nbytes(models) -> int:
+  seen = set()
+  total = 0
+  for model in models:
+    for tensor in list(model.parameters()) + list(model.buffers()):
+      storage = tensor.untyped_storage()
+      ptr = storage.data_ptr()
+      if ptr in seen:
+        continue
+      seen.add(ptr)
+      total += storage.nbytes()
+  return total
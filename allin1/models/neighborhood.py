@@ -0,0 +1,265 @@
+"""Pure-PyTorch neighborhood attention with the same semantics as natten's `natten1dqkrpb`, `natten1dav`,
+`natten2dqkrpb` and `natten2dav`.
+
+Each query attends to `kernel_size` keys spaced `dilation` apart. Tokens are split into `dilation` interleaved
+groups, and within its group every query's window is centered on it and shifted inwards at the borders, so it
+always holds exactly `kernel_size` keys. The relative positional bias of a key is indexed by its offset from the
+query. The neighbor and bias index tables depend only on (length, kernel_size, dilation) and are cached. While
+tracing (e.g. for ONNX export) they are instead built from the traced input shape, so the exported graph keeps a
+dynamic length.
+
+`instrument_qk_rpb` and `instrument_av` specialize the 2D case with dilation 1 in which the first axis (the K=4
+instruments) is no longer than the kernel, so every window spans the whole axis: the attention over the instruments
+is dense, and only the time axis needs neighborhood indices. The instrument axis is not padded; the keys and values
+of the zero-padded instruments that natten would see are the projection biases, and are added analytically.
+
+Run `python -m allin1.models.neighborhood` to check this backend against natten and benchmark both on CPU, or add
+`--instruments` to benchmark the dense instrument attention against the padded 2D attention.
+"""
+
+import argparse
+import time
+import torch
+
+from functools import lru_cache
+from typing import Tuple
+
+
+def neighborhood_indices(
+  length: int,
+  kernel_size: int,
+  dilation: int,
+  device: torch.device = torch.device('cpu'),
+) -> Tuple[torch.Tensor, torch.Tensor]:
+  """
+  Returns the indices of the keys each query attends to, and the indices into the relative positional biases
+  (of size 2 * kernel_size - 1) for those keys. Both have shape of: length, kernel_size.
+  """
+  if torch.jit.is_tracing():
+    return _neighborhood_indices(length, kernel_size, dilation, device)
+  return _cached_neighborhood_indices(length, kernel_size, dilation, device)
+
+
+def _neighborhood_indices(length, kernel_size: int, dilation: int, device: torch.device):
+  # `length` is a 0-dim tensor while tracing, which skips the check below.
+  if isinstance(length, int) and length < kernel_size * dilation:
+    raise ValueError(
+      f'Input length ({length}) must be at least kernel_size x dilation ({kernel_size} x {dilation})'
+    )
+  neighborhood_size = kernel_size // 2
+  index = torch.arange(length, device=device)
+  group = index % dilation
+  index_in_group = index // dilation
+  group_length = (length - group + dilation - 1) // dilation
+
+  start = (index_in_group - neighborhood_size).clamp(min=0)
+  start = torch.minimum(start, group_length - kernel_size)
+  offsets = torch.arange(kernel_size, device=device)
+
+  key_indices = group[:, None] + (start[:, None] + offsets) * dilation
+  rpb_indices = start[:, None] + offsets - index_in_group[:, None] + kernel_size - 1
+  return key_indices, rpb_indices
+
+
+_cached_neighborhood_indices = lru_cache(maxsize=256)(_neighborhood_indices)
+
+
+def _length(x: torch.Tensor, dim: int):
+  """Size of a dimension; a traced 0-dim tensor while tracing so that the size stays dynamic."""
+  if torch.jit.is_tracing():
+    return torch._shape_as_tensor(x)[dim]
+  return x.shape[dim]
+
+
+def na1d_qk_rpb(query, key, rpb, kernel_size: int, dilation: int):
+  # query, key have shape of: B, heads, L, D
+  # rpb has shape of: heads, 2k-1
+  key_indices, rpb_indices = neighborhood_indices(_length(query, 2), kernel_size, dilation, query.device)
+  keys = key[:, :, key_indices]  # B, heads, L, k, D
+  attention = torch.einsum('bhld,bhlkd->bhlk', query, keys)
+  return attention + rpb[:, rpb_indices]
+
+
+def na1d_av(attention, value, kernel_size: int, dilation: int):
+  # attention has shape of: B, heads, L, k
+  # value has shape of: B, heads, L, D
+  key_indices, _ = neighborhood_indices(_length(value, 2), kernel_size, dilation, value.device)
+  values = value[:, :, key_indices]  # B, heads, L, k, D
+  return torch.einsum('bhlk,bhlkd->bhld', attention, values)
+
+
+def na2d_qk_rpb(query, key, rpb, kernel_size: int, dilation: int):
+  # query, key have shape of: B, heads, X, Y, D
+  # rpb has shape of: heads, 2k-1, 2k-1
+  X, Y = _length(query, 2), _length(query, 3)
+  key_x, rpb_x = neighborhood_indices(X, kernel_size, dilation, query.device)
+  key_y, rpb_y = neighborhood_indices(Y, kernel_size, dilation, query.device)
+  keys = key[:, :, key_x[:, None, :, None], key_y[None, :, None, :]]  # B, heads, X, Y, k, k, D
+  attention = torch.einsum('bhxyd,bhxyijd->bhxyij', query, keys)
+  attention = attention + rpb[:, rpb_x[:, None, :, None], rpb_y[None, :, None, :]]
+  return attention.flatten(-2)  # B, heads, X, Y, k x k
+
+
+def na2d_av(attention, value, kernel_size: int, dilation: int):
+  # attention has shape of: B, heads, X, Y, k x k
+  # value has shape of: B, heads, X, Y, D
+  X, Y = _length(value, 2), _length(value, 3)
+  key_x, _ = neighborhood_indices(X, kernel_size, dilation, value.device)
+  key_y, _ = neighborhood_indices(Y, kernel_size, dilation, value.device)
+  values = value[:, :, key_x[:, None, :, None], key_y[None, :, None, :]]  # B, heads, X, Y, k, k, D
+  attention = attention.unflatten(-1, (kernel_size, kernel_size))
+  return torch.einsum('bhxyij,bhxyijd->bhxyd', attention, values)
+
+
+def instrument_qk_rpb(query, key, rpb, kernel_size: int, key_bias=None):
+  # query, key have shape of: B, heads, K, T, D with K <= kernel_size (instruments, time)
+  # rpb has shape of: heads, 2k-1, 2k-1
+  # key_bias has shape of: heads, D
+  # Same as padding K to kernel_size with zero inputs, whose keys are the key projection's bias, and calling
+  # na2d_qk_rpb with dilation 1: every window then spans all K + padded instruments, so the instrument axis is dense.
+  K, T = query.shape[2], _length(query, 3)
+  key_t, rpb_t = neighborhood_indices(T, kernel_size, 1, query.device)
+  offsets = torch.arange(kernel_size, device=query.device)
+  rpb_k = offsets[None, :] - torch.arange(K, device=query.device)[:, None] + kernel_size - 1  # K, k
+  keys = key[:, :, :, key_t]  # B, heads, K, T, k, D
+  attention = torch.einsum('bhxyd,bhjyid->bhxyji', query, keys)  # B, heads, K, T, K, k
+  if K < kernel_size:
+    if key_bias is None:
+      padded = attention.new_zeros(attention.shape[:4])
+    else:
+      padded = torch.einsum('bhxyd,hd->bhxy', query, key_bias.to(query.dtype))
+    padded = padded[..., None, None].expand(-1, -1, -1, -1, kernel_size - K, kernel_size)
+    attention = torch.cat([attention, padded], dim=-2)
+  attention = attention + rpb[:, rpb_k[:, None, :, None], rpb_t[None, :, None, :]]
+  return attention.flatten(-2)  # B, heads, K, T, k x k
+
+
+def instrument_av(attention, value, kernel_size: int, value_bias=None):
+  # attention has shape of: B, heads, K, T, k x k
+  # value has shape of: B, heads, K, T, D
+  # value_bias has shape of: heads, D
+  K, T = value.shape[2], _length(value, 3)
+  key_t, _ = neighborhood_indices(T, kernel_size, 1, value.device)
+  values = value[:, :, :, key_t]  # B, heads, K, T, k, D
+  attention = attention.unflatten(-1, (kernel_size, kernel_size))
+  context = torch.einsum('bhxyji,bhjyid->bhxyd', attention[..., :K, :], values)
+  if K < kernel_size and value_bias is not None:
+    padded = attention[..., K:, :].sum(dim=(-2, -1))
+    context = context + padded[..., None] * value_bias.to(value.dtype)[None, :, None, None, :]
+  return context
+
+
+def benchmark(
+  length: int = 6000,
+  batch_size: int = 4,
+  num_heads: int = 2,
+  head_dim: int = 12,
+  kernel_size: int = 5,
+  dilations=(1, 4, 16, 64, 256, 1024, 2048),
+  repeats: int = 5,
+):
+  """Compares the PyTorch backend to natten on CPU: max abs difference and mean time per qk+av call."""
+  from natten.functional import natten1dav, natten1dqkrpb
+
+  def timeit(fn):
+    start = time.perf_counter()
+    for _ in range(repeats):
+      out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+  print(f'{"dilation":>8} {"max_abs_diff":>14} {"natten (ms)":>12} {"torch (ms)":>12}')
+  with torch.no_grad():
+    for dilation in dilations:
+      if length < kernel_size * dilation:
+        continue
+      query = torch.randn(batch_size, num_heads, length, head_dim)
+      key = torch.randn(batch_size, num_heads, length, head_dim)
+      value = torch.randn(batch_size, num_heads, length, head_dim)
+      rpb = torch.randn(num_heads, 2 * kernel_size - 1)
+
+      def run_natten():
+        attention = natten1dqkrpb(query, key, rpb, kernel_size, dilation).softmax(dim=-1)
+        return natten1dav(attention, value, kernel_size, dilation)
+
+      def run_torch():
+        attention = na1d_qk_rpb(query, key, rpb, kernel_size, dilation).softmax(dim=-1)
+        return na1d_av(attention, value, kernel_size, dilation)
+
+      out_natten, time_natten = timeit(run_natten)
+      out_torch, time_torch = timeit(run_torch)
+      diff = (out_natten - out_torch).abs().max().item()
+      print(f'{dilation:>8} {diff:>14.2e} {time_natten * 1e3:>12.2f} {time_torch * 1e3:>12.2f}')
+
+
+def benchmark_instruments(
+  length: int = 6000,
+  batch_size: int = 1,
+  num_instruments: int = 4,
+  num_heads: int = 2,
+  head_dim: int = 12,
+  kernel_size: int = 5,
+  repeats: int = 5,
+):
+  """
+  Compares the dense instrument attention to the padded 2D neighborhood attention of the instrument layers on CPU:
+  max abs difference and mean time per qk+av call, including the padding of the inputs.
+  """
+  try:
+    from natten.functional import natten2dav, natten2dqkrpb
+  except ImportError:
+    natten2dav = natten2dqkrpb = None
+
+  def timeit(fn):
+    start = time.perf_counter()
+    for _ in range(repeats):
+      out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+  with torch.no_grad():
+    shape = (batch_size, num_heads, num_instruments, length, head_dim)
+    query, key, value = torch.randn(shape), torch.randn(shape), torch.randn(shape)
+    key_bias, value_bias = torch.randn(num_heads, head_dim), torch.randn(num_heads, head_dim)
+    rpb = torch.randn(num_heads, 2 * kernel_size - 1, 2 * kernel_size - 1)
+
+    def pad(x, bias):
+      padded = bias[None, :, None, None, :].expand(batch_size, -1, kernel_size - num_instruments, length, -1)
+      return torch.cat([x, padded], dim=2)
+
+    def run_padded(qkrpb, av):
+      def run():
+        # The padded query rows are computed and thrown away, as in DinatLayer2d.maybe_pad.
+        padded_query = pad(query, query.new_zeros(num_heads, head_dim))
+        attention = qkrpb(padded_query, pad(key, key_bias), rpb, kernel_size, 1).softmax(dim=-1)
+        return av(attention, pad(value, value_bias), kernel_size, 1)[:, :, :num_instruments]
+      return run
+
+    def run_dense():
+      attention = instrument_qk_rpb(query, key, rpb, kernel_size, key_bias).softmax(dim=-1)
+      return instrument_av(attention, value, kernel_size, value_bias)
+
+    out_dense, time_dense = timeit(run_dense)
+    print(f'{"implementation":>16} {"max_abs_diff":>14} {"time (ms)":>10}')
+    candidates = [('torch 2D', na2d_qk_rpb, na2d_av)]
+    if natten2dqkrpb is not None:
+      candidates.insert(0, ('natten 2D', natten2dqkrpb, natten2dav))
+    for name, qkrpb, av in candidates:
+      out, elapsed = timeit(run_padded(qkrpb, av))
+      print(f'{name:>16} {(out - out_dense).abs().max().item():>14.2e} {elapsed * 1e3:>10.2f}')
+    print(f'{"dense":>16} {0:>14.2e} {time_dense * 1e3:>10.2f}')
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the PyTorch neighborhood attention against natten.')
+  parser.add_argument('--length', type=int, default=6000, help='Number of frames (default: 6000, i.e. 60 seconds)')
+  parser.add_argument('--repeats', type=int, default=5, help='Number of timed repeats (default: 5)')
+  parser.add_argument('--instruments', action='store_true',
+                      help='Benchmark the dense instrument attention against the padded 2D attention instead')
+  args = parser.parse_args()
+  if args.instruments:
+    benchmark_instruments(length=args.length, repeats=args.repeats)
+  else:
+    benchmark(length=args.length, repeats=args.repeats)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,103 @@
+"""Dynamic int8 quantization of AllInOne models for CPU inference.
+
+All `nn.Linear` layers (the Q/K/V and output projections of the neighborhood attention, `DinatIntermediate`,
+`DinatOutput` and the `Head` classifiers) are replaced with dynamically quantized int8 versions. The convolutional
+embeddings, layer norms and the natten kernels stay in fp32. Use `compare_models` to measure the drift of the
+quantized model against the fp32 one before deploying it.
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from typing import Dict, List
+from madmom.evaluation.beats import BeatEvaluation
+from madmom.evaluation.onsets import OnsetEvaluation
+from .batched import BatchedEnsemble
+from ..postprocessing import postprocess_metrical_structure, postprocess_functional_structure
+
+QUANTIZE_MODES = ['int8']
+
+
+def quantize_model(model: nn.Module, quantize: str = 'int8') -> nn.Module:
+  """Returns a dynamically quantized copy of the model. The given model is left untouched."""
+  assert quantize in QUANTIZE_MODES, f'Unknown quantization: {quantize} (expected one of {QUANTIZE_MODES})'
+  if isinstance(model, BatchedEnsemble):
+    raise ValueError('Quantization is not supported for the batched ensemble mode; use the serial or adaptive mode.')
+
+  quantized = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+  quantized.eval()
+  return quantized
+
+
+def compare_models(
+  reference: nn.Module,
+  candidate: nn.Module,
+  specs: List[np.ndarray],
+  boundary_window: float = 0.5,
+) -> Dict[str, float]:
+  """
+  Runs both models on the given spectrograms and reports, averaged over the tracks, how closely the beats,
+  downbeats and segment boundaries of the candidate match those of the reference (F-measure, with the reference as
+  ground truth), the largest absolute logit differences, and the speedup of the candidate.
+  """
+  reports = []
+  with torch.no_grad():
+    for spec in specs:
+      spec = torch.from_numpy(spec).unsqueeze(0).float()
+
+      start = time.perf_counter()
+      logits_ref = reference(spec)
+      time_ref = time.perf_counter() - start
+
+      start = time.perf_counter()
+      logits_cand = candidate(spec)
+      time_cand = time.perf_counter() - start
+
+      metrical_ref = postprocess_metrical_structure(logits_ref, reference.cfg)
+      metrical_cand = postprocess_metrical_structure(logits_cand, candidate.cfg)
+      segments_ref = postprocess_functional_structure(logits_ref, reference.cfg)
+      segments_cand = postprocess_functional_structure(logits_cand, candidate.cfg)
+
+      boundaries_ref = np.array([segment.start for segment in segments_ref[1:]])
+      boundaries_cand = np.array([segment.start for segment in segments_cand[1:]])
+
+      reports.append({
+        'beat/f1': BeatEvaluation(metrical_cand['beats'], metrical_ref['beats']).fmeasure,
+        'downbeat/f1': BeatEvaluation(metrical_cand['downbeats'], metrical_ref['downbeats']).fmeasure,
+        'segment/f1': OnsetEvaluation(boundaries_cand, boundaries_ref, window=boundary_window).fmeasure,
+        'logits_beat/max_abs_diff': (logits_ref.logits_beat - logits_cand.logits_beat).abs().max().item(),
+        'logits_downbeat/max_abs_diff': (logits_ref.logits_downbeat - logits_cand.logits_downbeat).abs().max().item(),
+        'logits_section/max_abs_diff': (logits_ref.logits_section - logits_cand.logits_section).abs().max().item(),
+        'time/reference': time_ref,
+        'time/candidate': time_cand,
+      })
+
+  report = {key: float(np.mean([r[key] for r in reports])) for key in reports[0].keys()}
+  report['speedup'] = report['time/reference'] / report['time/candidate']
+  return report
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='Report the parity of the int8 quantized model against fp32.')
+  parser.add_argument('spec_paths', nargs='+', type=str, help='Paths to spectrograms (.npy) extracted by allin1')
+  parser.add_argument('-m', '--model', type=str, default='harmonix-all',
+                      help='Name of the pretrained model to use (default: harmonix-all)')
+  return parser
+
+
+def main():
+  from .loaders import load_pretrained_model
+
+  args = make_parser().parse_args()
+  reference = load_pretrained_model(args.model, device='cpu')
+  candidate = load_pretrained_model(args.model, device='cpu', quantize='int8')
+  specs = [np.load(spec_path) for spec_path in args.spec_paths]
+  print(json.dumps(compare_models(reference, candidate, specs), indent=2))
+
+
+if __name__ == '__main__':
+  main()
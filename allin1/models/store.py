@@ -0,0 +1,163 @@
+"""Local, offline checkpoint store for the pretrained models.
+
+The pickled `.pth` checkpoints from the hub are converted once into plain tensor files that `torch.load` can
+memory-map, plus a `manifest.json` holding each model's OmegaConf config and thresholds. Loading from the store
+makes no network calls and, on CPU, assigns the memory-mapped tensors to the model without copying them. torch
+versions before 2.1 (e.g. the one pinned in cog.yaml) cannot memory-map or assign tensors and copy them instead.
+"""
+
+import argparse
+import inspect
+import json
+import os
+import time
+import torch
+
+from typing import Dict, List, Optional
+from omegaconf import OmegaConf
+from ..typings import PathLike
+from ..utils import mkpath
+
+MANIFEST_FILE = 'manifest.json'
+# Memory-mapped loading and assigning loaded tensors to a model need torch 2.1.
+MMAP_SUPPORTED = 'mmap' in inspect.signature(torch.load).parameters
+ASSIGN_SUPPORTED = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+STORE_DIR_ENV = 'ALLIN1_MODEL_STORE'
+
+
+def get_store_dir(store_dir: Optional[PathLike] = None):
+  """Returns the given store directory, or the one set in $ALLIN1_MODEL_STORE, or None."""
+  store_dir = store_dir or os.environ.get(STORE_DIR_ENV)
+  if not store_dir:
+    return None
+  return mkpath(store_dir)
+
+
+def read_manifest(store_dir: PathLike) -> Dict[str, Dict]:
+  manifest_path = mkpath(store_dir) / MANIFEST_FILE
+  if not manifest_path.is_file():
+    return {}
+  return json.loads(manifest_path.read_text())
+
+
+def has_model(store_dir: PathLike, model_name: str) -> bool:
+  return model_name in read_manifest(store_dir)
+
+
+def convert_checkpoints(
+  store_dir: PathLike,
+  model_names: Optional[List[str]] = None,
+  cache_dir: Optional[PathLike] = None,
+  overwrite: bool = False,
+) -> Dict[str, Dict]:
+  """Downloads the given pretrained checkpoints (all folds by default) and converts them into the store."""
+  from .loaders import NAME_TO_FILE, download_checkpoint
+
+  store_dir = mkpath(store_dir)
+  store_dir.mkdir(parents=True, exist_ok=True)
+  manifest = read_manifest(store_dir)
+
+  for model_name in model_names or list(NAME_TO_FILE.keys()):
+    if model_name in manifest and not overwrite:
+      continue
+
+    checkpoint_path = download_checkpoint(model_name, cache_dir)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    config = OmegaConf.to_container(OmegaConf.create(checkpoint['config']), resolve=True)
+    state_dict = {key: tensor.contiguous() for key, tensor in checkpoint['state_dict'].items()}
+
+    filename = f'{model_name}.pt'
+    _atomic_torch_save(state_dict, store_dir / filename)
+
+    manifest[model_name] = dict(
+      file=filename,
+      source=NAME_TO_FILE[model_name],
+      config=config,
+      thresholds=dict(
+        beat=config.get('best_threshold_beat'),
+        downbeat=config.get('best_threshold_downbeat'),
+      ),
+    )
+    _atomic_write_text(store_dir / MANIFEST_FILE, json.dumps(manifest, indent=2))
+    print(f'=> Converted {model_name} into {store_dir / filename}')
+
+  return manifest
+
+
+def load_from_store(
+  store_dir: PathLike,
+  model_name: str,
+  device=None,
+  timings: Optional[Dict[str, float]] = None,
+):
+  """Builds the model from the store without touching the network."""
+  from .allinone import AllInOne
+
+  if timings is None:
+    timings = {}
+
+  start = time.perf_counter()
+  store_dir = mkpath(store_dir)
+  manifest = read_manifest(store_dir)
+  if model_name not in manifest:
+    raise FileNotFoundError(f'Model {model_name} is not in the store at {store_dir}')
+  entry = manifest[model_name]
+
+  config = OmegaConf.create(entry['config'])
+  config.best_threshold_beat = entry['thresholds']['beat']
+  config.best_threshold_downbeat = entry['thresholds']['downbeat']
+
+  mmap = dict(mmap=True) if MMAP_SUPPORTED else {}
+  state_dict = torch.load(store_dir / entry['file'], map_location='cpu', weights_only=True, **mmap)
+  timings['read'] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  model = AllInOne(config)
+  is_cpu = torch.device(device or 'cpu').type == 'cpu'
+  if not is_cpu:
+    model = model.to(device)
+  timings['build'] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  if is_cpu and ASSIGN_SUPPORTED:
+    # Use the memory-mapped tensors as the parameters directly instead of copying them.
+    model.load_state_dict(state_dict, assign=True)
+  else:
+    model.load_state_dict(state_dict)
+  model.eval()
+  timings['load_state_dict'] = time.perf_counter() - start
+
+  return model
+
+
+def _atomic_torch_save(obj, path):
+  tmp_path = path.with_name(f'.{path.name}.tmp')
+  torch.save(obj, tmp_path)
+  os.replace(tmp_path, path)
+
+
+def _atomic_write_text(path, text: str):
+  tmp_path = path.with_name(f'.{path.name}.tmp')
+  tmp_path.write_text(text)
+  os.replace(tmp_path, path)
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='Convert pretrained checkpoints into a local, offline model store.')
+  parser.add_argument('store_dir', type=str, help='Directory of the model store')
+  parser.add_argument('-m', '--models', nargs='*', default=None,
+                      help='Names of the models to convert (default: all folds)')
+  parser.add_argument('--cache-dir', type=str, default=None,
+                      help='Hugging Face hub cache directory to download the checkpoints into')
+  parser.add_argument('--overwrite', action='store_true', default=False,
+                      help='Re-convert models already in the store (default: False)')
+  return parser
+
+
+def main():
+  args = make_parser().parse_args()
+  convert_checkpoints(args.store_dir, args.models, args.cache_dir, args.overwrite)
+
+
+if __name__ == '__main__':
+  main()
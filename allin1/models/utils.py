@@ -1,6 +1,26 @@
+import copy
+import itertools
 import torch.nn as nn
 
 
+class FP32LayerNorm(nn.LayerNorm):
+  """LayerNorm computed in fp32 and returned in the input dtype, so it stays exact under reduced-precision autocast."""
+
+  def forward(self, x):
+    return super().forward(x.float()).to(x.dtype)
+
+
+def copy_sharing_weights(model: nn.Module) -> nn.Module:
+  """Copies the modules of a model but not its parameters and buffers."""
+  memo = {id(tensor): tensor for tensor in itertools.chain(model.parameters(), model.buffers())}
+  return copy.deepcopy(model, memo)
+
+
+def linear_bias(linear: nn.Module):
+  """The bias of a linear layer, also of a dynamically quantized one, whose `bias` is a method."""
+  return linear.bias() if callable(linear.bias) else linear.bias
+
+
 def get_activation_function(name: str):
   activation_functions = {
     'relu': nn.ReLU(),
@@ -4,6 +4,8 @@ from ..typings import AllInOneOutput, Segment
 from ..config import Config, HARMONIX_LABELS
 from .helpers import local_maxima, peak_picking, event_frames_to_time
 
+BOUNDARY_WINDOW = 12  # seconds before and after a boundary candidate in which it must be the peak
+
 
 def postprocess_functional_structure(
   logits: AllInOneOutput,
@@ -15,10 +17,11 @@ def postprocess_functional_structure(
   prob_sections = prob_sections.cpu().numpy()
   prob_functions = raw_prob_functions.cpu().numpy()
 
+  # The windows can be overridden in the config, e.g. when reprocessing cached logits.
   boundary_candidates = peak_picking(
     boundary_activation=prob_sections,
-    window_past=12 * cfg.fps,
-    window_future=12 * cfg.fps,
+    window_past=round((getattr(cfg, 'boundary_window_past', None) or BOUNDARY_WINDOW) * cfg.fps),
+    window_future=round((getattr(cfg, 'boundary_window_future', None) or BOUNDARY_WINDOW) * cfg.fps),
   )
   boundary = boundary_candidates > 0.0
 
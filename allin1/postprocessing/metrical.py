@@ -4,13 +4,16 @@ from madmom.features.downbeats import DBNDownBeatTrackingProcessor
 from ..typings import AllInOneOutput
 from ..config import Config
 
+BEATS_PER_BAR = [3, 4]
+
 
 def postprocess_metrical_structure(
   logits: AllInOneOutput,
   cfg: Config,
 ):
+  # `beats_per_bar` can be overridden in the config, e.g. when reprocessing cached logits.
   postprocessor_downbeat = DBNDownBeatTrackingProcessor(
-    beats_per_bar=[3, 4],
+    beats_per_bar=list(getattr(cfg, 'beats_per_bar', None) or BEATS_PER_BAR),
     threshold=cfg.best_threshold_downbeat,
     fps=cfg.fps,
   )
@@ -0,0 +1,128 @@
+"""Recomputes analysis results from cached logits, without demixing or running the model.
+
+`analyze(..., logits_dir=...)` saves every track's logits with the model config to `<logits_dir>/<track>.logits.npz`.
+`reprocess` runs the postprocessing on those files again, with config fields such as `best_threshold_downbeat`,
+`beats_per_bar` or `boundary_window_past`/`boundary_window_future` (in seconds) overridden. Activations saved with
+`include_activations` (`.activ.npz`) can be reprocessed too; as they hold no config, that of `model` is used.
+
+Run `python -m allin1.reprocess ./logits -o ./struct --override best_threshold_downbeat=0.3` to reprocess a
+directory of cached logits.
+"""
+
+import argparse
+
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+from omegaconf import OmegaConf
+from tqdm import tqdm
+from .helpers import load_logits, make_result, expand_paths, check_paths, save_results
+from .typings import AnalysisResult, PathLike, TASKS
+from .utils import mkpath
+
+CACHE_SUFFIXES = ['.logits.npz', '.activ.npz']
+
+
+def _find_cache_files(paths: List[Path]) -> List[Path]:
+  files = []
+  for path in paths:
+    if path.is_dir():
+      files += sorted(p for p in path.iterdir() if any(p.name.endswith(suffix) for suffix in CACHE_SUFFIXES))
+    else:
+      files.append(path)
+  return files
+
+
+def _reprocess_one(args):
+  path, overrides, default_cfg, include_activations, tasks = args
+  track_path, logits, cfg = load_logits(path)
+  cfg = cfg if cfg is not None else default_cfg
+  if overrides:
+    cfg = OmegaConf.merge(cfg, overrides)
+
+  available = [
+    task for task, key in [('beats', 'logits_beat'), ('segments', 'logits_section')]
+    if getattr(logits, key) is not None
+  ]
+  tasks = [task for task in (tasks or TASKS) if task in available]
+  return make_result(track_path, logits, cfg, include_activations, include_embeddings=False, tasks=tasks)
+
+
+def reprocess(
+  paths: Union[PathLike, List[PathLike]],
+  out_dir: PathLike = None,
+  overrides: Optional[Dict[str, Any]] = None,
+  include_activations: bool = False,
+  tasks: Optional[List[str]] = None,
+  model: str = 'harmonix-all',
+  multiprocess: bool = True,
+) -> Union[AnalysisResult, List[AnalysisResult]]:
+  """
+  Recomputes the analysis results of cached logits (`.logits.npz`) or saved activations (`.activ.npz`), given as
+  files, glob patterns or directories holding them. `overrides` maps config fields to the values to postprocess with.
+  The config of the pretrained `model` is only loaded for activations, which are saved without one. Tracks are
+  postprocessed in parallel unless `multiprocess` is False. Results are saved to `out_dir` if given.
+  """
+  return_list = isinstance(paths, list)
+  paths = paths if return_list else [paths]
+  paths = _find_cache_files(expand_paths([mkpath(p) for p in paths]))
+  check_paths(paths)
+  if not paths:
+    raise ValueError('No cached logits or activations found.')
+
+  default_cfg = None
+  if any(path.name.endswith('.activ.npz') for path in paths):
+    from .models import load_pretrained_model
+    default_cfg = OmegaConf.create(OmegaConf.to_yaml(load_pretrained_model(model, device='cpu').cfg))
+
+  overrides = OmegaConf.create(overrides or {})
+  jobs = [(path, overrides, default_cfg, include_activations, tasks) for path in paths]
+  if multiprocess and len(jobs) > 1:
+    with Pool() as pool:
+      results = list(tqdm(pool.imap(_reprocess_one, jobs), total=len(jobs), desc='Reprocessing'))
+  else:
+    results = [_reprocess_one(job) for job in tqdm(jobs, desc='Reprocessing')]
+
+  if out_dir is not None:
+    save_results(results, out_dir)
+
+  if not return_list:
+    return results[0]
+  return results
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description='Recompute analysis results from cached logits.')
+  parser.add_argument('paths', nargs='+', type=Path,
+                      help='Cached .logits.npz or .activ.npz files, or directories holding them')
+  parser.add_argument('-o', '--out-dir', type=Path, default=Path.cwd() / 'struct',
+                      help='Path to a directory to store analysis results (default: ./struct)')
+  parser.add_argument('--override', type=str, nargs='+', default=[],
+                      help='Config fields to override, e.g. best_threshold_downbeat=0.3 beats_per_bar=[4]')
+  parser.add_argument('-a', '--activ', action='store_true',
+                      help='Save frame-level raw activations from sigmoid and softmax (default: False)')
+  parser.add_argument('--tasks', type=str, nargs='+', default=None, choices=TASKS,
+                      help='Tasks to recompute; the others are left empty (default: all)')
+  parser.add_argument('-m', '--model', type=str, default='harmonix-all',
+                      help='Pretrained model whose config is used for .activ.npz files (default: harmonix-all)')
+  parser.add_argument('--no-multiprocess', action='store_true', default=False,
+                      help='Disable multiprocessing (default: False)')
+  return parser
+
+
+def main():
+  args = make_parser().parse_args()
+  reprocess(
+    paths=args.paths,
+    out_dir=args.out_dir,
+    overrides=OmegaConf.to_container(OmegaConf.from_dotlist(args.override)),
+    include_activations=args.activ,
+    tasks=args.tasks,
+    model=args.model,
+    multiprocess=not args.no_multiprocess,
+  )
+  print(f'=> Analysis results are successfully saved to {args.out_dir}')
+
+
+if __name__ == '__main__':
+  main()
@@ -1,12 +1,27 @@
 import numpy as np
+import torch
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from tqdm import tqdm
 from multiprocessing import Pool
 from madmom.audio.signal import FramedSignalProcessor, Signal
 from madmom.audio.stft import ShortTimeFourierTransformProcessor
 from madmom.processors import SequentialProcessor
 from madmom.audio.spectrogram import FilteredSpectrogramProcessor, LogarithmicSpectrogramProcessor
+from .demix import STEMS, StemWriter, find_stem, read_f16
+
+# Parameters of the frontend; they are part of the key of cached spectrograms (see artifacts.py).
+SPECTROGRAM_CONFIG = dict(
+  sample_rate=44100,
+  hop_size=441,
+  frame_size=2048,
+  num_bands=12,
+  fmin=30,
+  fmax=17000,
+  norm_filters=True,
+  log_mul=1,
+  log_add=1,
+)
 
 
 def extract_spectrograms(demix_paths: List[Path], spec_dir: Path, multiprocess: bool = True):
@@ -23,20 +38,7 @@ def extract_spectrograms(demix_paths: List[Path], spec_dir: Path, multiprocess:
   print(f'=> Found {existing} spectrograms already extracted, {len(todos)} to extract.')
 
   if todos:
-    # Define a pre-processing chain, which is copied from madmom.
-    frames = FramedSignalProcessor(
-      frame_size=2048,
-      fps=int(44100 / 441)
-    )
-    stft = ShortTimeFourierTransformProcessor()  # caching FFT window
-    filt = FilteredSpectrogramProcessor(
-      num_bands=12,
-      fmin=30,
-      fmax=17000,
-      norm_filters=True
-    )
-    spec = LogarithmicSpectrogramProcessor(mul=1, add=1)
-    processor = SequentialProcessor([frames, stft, filt, spec])
+    processor = make_processor()
 
     # Process all tracks using multiprocessing.
     if multiprocess:
@@ -60,21 +62,193 @@ def extract_spectrograms(demix_paths: List[Path], spec_dir: Path, multiprocess:
   return spec_paths
 
 
+def make_processor(cfg: Dict = SPECTROGRAM_CONFIG) -> SequentialProcessor:
+  spec = LogarithmicSpectrogramProcessor(mul=cfg['log_mul'], add=cfg['log_add'])
+  return SequentialProcessor(_linear_processors(cfg) + [spec])
+
+
+def _linear_processors(cfg: Dict) -> List:
+  # Define a pre-processing chain, which is copied from madmom.
+  frames = FramedSignalProcessor(
+    frame_size=cfg['frame_size'],
+    fps=int(cfg['sample_rate'] / cfg['hop_size'])
+  )
+  stft = ShortTimeFourierTransformProcessor()  # caching FFT window
+  filt = FilteredSpectrogramProcessor(
+    num_bands=cfg['num_bands'],
+    fmin=cfg['fmin'],
+    fmax=cfg['fmax'],
+    norm_filters=cfg['norm_filters']
+  )
+  return [frames, stft, filt]
+
+
+def extract_spectrograms_in_memory(
+  paths: List[Path],
+  spec_dir: Path,
+  separate: Callable[[Path], Tuple[Dict[str, torch.Tensor], int]],
+):
+  """
+  Like `extract_spectrograms`, but from stems that `separate` returns in memory as (channels, samples) float
+  tensors and their sample rate, e.g. a demix engine's, instead of from demixed WAV files. Tracks whose
+  spectrogram already exists are not separated at all.
+  """
+  spec_paths = [spec_dir / f'{path.stem}.npy' for path in paths]
+  todos = [(path, dst) for path, dst in zip(paths, spec_paths) if not dst.is_file()]
+  print(f'=> Found {len(paths) - len(todos)} spectrograms already extracted, {len(todos)} to demix and extract.')
+
+  if todos:
+    processor = make_processor()
+    for src, dst in tqdm(todos, desc='Demixing and extracting spectrograms'):
+      stems, sample_rate = separate(src)
+      dst.parent.mkdir(parents=True, exist_ok=True)
+      np.save(str(dst), spectrogram_from_stems(stems, sample_rate, processor))
+
+  return spec_paths
+
+
+def spectrogram_from_stems(stems: Dict[str, torch.Tensor], sample_rate: int, processor: SequentialProcessor):
+  """
+  Spectrogram of in-memory stems, equal to that of the 16-bit WAVs the demix step would write for them up to
+  quantization: the stems are rescaled the same way if they would clip, and mixed down to mono.
+  """
+  specs = []
+  for stem in STEMS:
+    wav = stems[stem].float()
+    wav = wav / max(1.01 * wav.abs().max().item(), 1)
+    sig = Signal(wav.t().numpy(), sample_rate=sample_rate, num_channels=1)
+    specs.append(processor(sig))
+  return np.stack(specs)  # instruments, frames, bins
+
+
+def extract_spectrograms_streaming(
+  paths: List[Path],
+  spec_dir: Path,
+  separate_stream: Callable[[Path], Tuple[Iterator[Dict[str, torch.Tensor]], int]],
+  stems_dir: Optional[Path] = None,
+  stem_format: str = 'wav',
+) -> Tuple[List[Path], List[Path]]:
+  """
+  Like `extract_spectrograms_in_memory`, but `separate_stream` returns the stems in consecutive pieces (see
+  `DemixEngine.separate_stream`), so that no track is ever held in memory whole. If `stems_dir` is given, the stems
+  are also saved to `<stems_dir>/<track>` in `stem_format` as they arrive. Returns the spectrogram files and the
+  stem directories.
+  """
+  spec_paths = [spec_dir / f'{path.stem}.npy' for path in paths]
+  demix_paths = [stems_dir / path.stem for path in paths] if stems_dir is not None else []
+  todos = [
+    i for i, dst in enumerate(spec_paths)
+    if not dst.is_file() or (demix_paths and not (demix_paths[i] / f'bass.{stem_format}').is_file())
+  ]
+  print(f'=> Found {len(paths) - len(todos)} tracks already demixed, {len(todos)} to demix and extract.')
+
+  for i in tqdm(todos, desc='Demixing and extracting spectrograms'):
+    pieces, sample_rate = separate_stream(paths[i])
+    writer = StemWriter(demix_paths[i], sample_rate, stem_format) if demix_paths else None
+    spec = spectrogram_from_stream(pieces, sample_rate, writer)
+    spec_paths[i].parent.mkdir(parents=True, exist_ok=True)
+    np.save(str(spec_paths[i]), spec)
+
+  return spec_paths, demix_paths
+
+
+class SpectrogramStream:
+  """
+  Spectrogram of stems that arrive in consecutive pieces, equal to `spectrogram_from_stems` of the whole stems up to
+  float rounding while holding only the few samples the next frame still needs. As the rescaling on clipping
+  depends on the peak of the whole stem, the filtered magnitudes are kept linear, and rescaled and log-compressed
+  by `finish`.
+  """
+
+  def __init__(self, sample_rate: int, cfg: Dict = SPECTROGRAM_CONFIG):
+    self.sample_rate = sample_rate
+    self.cfg = cfg
+    self.processor = SequentialProcessor(_linear_processors(cfg))
+    fps = int(cfg['sample_rate'] / cfg['hop_size'])
+    assert sample_rate % fps == 0, f'Frames of {sample_rate} Hz audio at {fps} fps do not start on samples.'
+    self.hop_size = sample_rate // fps
+    # Frames are centered on multiples of the hop size and reach `half_frame` samples to each side.
+    self.half_frame = cfg['frame_size'] // 2
+    self.context_frames = -(-self.half_frame // self.hop_size)
+    self.buffers = {stem: np.zeros(0, dtype=np.float32) for stem in STEMS}
+    self.peaks = {stem: 0. for stem in STEMS}
+    self.frames = {stem: [] for stem in STEMS}
+    self.buffer_frame = 0  # the frame centered on the first sample of the buffers
+    self.next_frame = 0
+
+  def push(self, stems: Dict[str, torch.Tensor]):
+    for stem in STEMS:
+      wav = stems[stem].float()
+      self.peaks[stem] = max(self.peaks[stem], wav.abs().max().item())
+      self.buffers[stem] = np.concatenate([self.buffers[stem], wav.mean(0).numpy()])  # mono, like madmom's remix
+    self._process(final=False)
+
+  def finish(self) -> np.ndarray:
+    self._process(final=True)
+    specs = []
+    for stem in STEMS:
+      spec = np.concatenate(self.frames[stem]) / np.float32(max(1.01 * self.peaks[stem], 1))
+      # LogarithmicSpectrogramProcessor
+      specs.append(np.log10(spec * self.cfg['log_mul'] + self.cfg['log_add']))
+    return np.stack(specs)  # instruments, frames, bins
+
+  def _process(self, final: bool):
+    length = len(self.buffers[STEMS[0]])
+    if final:
+      # The frames past the end are zero-padded, like madmom's.
+      end = -(-length // self.hop_size)
+    else:
+      end = max((length - self.half_frame) // self.hop_size + 1, 0)
+    start = self.next_frame - self.buffer_frame
+    if end <= start:
+      return
+
+    for stem in STEMS:
+      # Frames before the start of the track are zero-padded, and so are those of the first buffer.
+      sig = Signal(self.buffers[stem], sample_rate=self.sample_rate)
+      self.frames[stem].append(np.asarray(self.processor(sig))[start:end])
+    self.next_frame = self.buffer_frame + end
+
+    # Keep the samples from the first one the next frame needs, aligned to a frame center.
+    drop_frames = max(end - self.context_frames, 0)
+    for stem in STEMS:
+      self.buffers[stem] = self.buffers[stem][drop_frames * self.hop_size:]
+    self.buffer_frame += drop_frames
+
+
+def spectrogram_from_stream(
+  pieces: Iterable[Dict[str, torch.Tensor]],
+  sample_rate: int,
+  writer: Optional[StemWriter] = None,
+) -> np.ndarray:
+  """Spectrogram of stems arriving in consecutive pieces, which `writer` also saves if given."""
+  stream = SpectrogramStream(sample_rate)
+  for stems in pieces:
+    stream.push(stems)
+    if writer is not None:
+      writer.write(stems)
+  if writer is not None:
+    writer.close()
+  return stream.finish()
+
+
 def _extract_spectrogram(args: Tuple[Path, Path, SequentialProcessor]):
   src, dst, processor = args
 
   dst.parent.mkdir(parents=True, exist_ok=True)
+  np.save(str(dst), spectrogram_from_files(src, processor))
 
-  sig_bass = Signal(src / 'bass.wav', num_channels=1)
-  sig_drums = Signal(src / 'drums.wav', num_channels=1)
-  sig_other = Signal(src / 'other.wav', num_channels=1)
-  sig_vocals = Signal(src / 'vocals.wav', num_channels=1)
 
-  spec_bass = processor(sig_bass)
-  spec_drums = processor(sig_drums)
-  spec_others = processor(sig_other)
-  spec_vocals = processor(sig_vocals)
-
-  spec = np.stack([spec_bass, spec_drums, spec_others, spec_vocals])  # instruments, frames, bins
-
-  np.save(str(dst), spec)
+def spectrogram_from_files(src: Path, processor: SequentialProcessor):
+  """Spectrogram of the demixed stem files in the directory `src`, in any of the `STEM_FORMATS`."""
+  specs = []
+  for stem in STEMS:
+    path = find_stem(src, stem)
+    if path.suffix == '.f16':
+      data, sample_rate = read_f16(path)
+      sig = Signal(data.T, sample_rate=sample_rate, num_channels=1)
+    else:
+      # madmom reads WAV and (through ffmpeg) FLAC as the same 16-bit samples.
+      sig = Signal(path, num_channels=1)
+    specs.append(processor(sig))
+  return np.stack(specs)  # instruments, frames, bins
@@ -0,0 +1,180 @@
+"""Selects subsets of the pretrained folds that trade accuracy against latency.
+
+Every fold is run once over the validation tracks of the data module to collect its logits and inference time.
+Fold subsets are then scored with `compute_postprocessed_scores` on their averaged logits, either by a greedy
+forward selection or exhaustively, and the Pareto front of score against latency is written to OUTPATH as named
+ensembles (e.g. 'harmonix-top3') that `allin1.models.loaders.register_ensembles` can load.
+
+To select on a held-out set, point `data.path_track_dir` and friends at it and run with `fold=0 total_folds=1`,
+which puts every track into the validation split.
+"""
+
+import hydra
+import itertools
+import json
+import time
+import numpy as np
+import torch
+
+from pprint import pprint
+from typing import Dict, List, Sequence, Tuple
+from tqdm import tqdm
+
+from .data import HarmonixDataModule
+from .evaluate import compute_postprocessed_scores
+from ..config import Config
+from ..models.loaders import ENSEMBLE_MODELS, load_pretrained_model
+from ..models.ensemble import make_ensemble_config
+from ..typings import AllInOneOutput
+from ..utils import mkpath
+
+SEARCH = 'greedy'  # 'greedy' or 'exhaustive'
+BASE_ENSEMBLE = 'harmonix-all'
+OBJECTIVE_KEYS = [
+  'beat/f1',
+  'downbeat/f1',
+  'segment/F-measure@0.5',
+]
+OUTPATH = 'ensembles.json'
+
+
+@hydra.main(version_base=None, config_name='config')
+def main(cfg: Config):
+  device = 'cuda' if torch.cuda.is_available() else 'cpu'
+  fold_names = ENSEMBLE_MODELS[BASE_ENSEMBLE]
+
+  print('=> Creating data module...')
+  if cfg.data.name == 'harmonix':
+    dm = HarmonixDataModule(cfg)
+  else:
+    raise ValueError(f'Unknown dataset: {cfg.data.name}')
+  dm.setup('validate')
+  batches = list(dm.val_dataloader())
+
+  print(f'=> Running {len(fold_names)} folds on {len(batches)} tracks...')
+  models = [load_pretrained_model(fold_name, device=device) for fold_name in fold_names]
+  fold_outputs, fold_latencies = collect_fold_outputs(models, batches, device)
+
+  def evaluate_subset(subset: Sequence[int]) -> Tuple[float, float, Dict[str, float]]:
+    subset_cfg = make_ensemble_config([models[i] for i in subset])
+    predict_outputs = [
+      (batch, average_logits([outputs[i] for i in subset]), None)
+      for batch, outputs in zip(batches, fold_outputs)
+    ]
+    scores = compute_postprocessed_scores(predict_outputs, subset_cfg)
+    objective = float(np.mean([scores[key] for key in OBJECTIVE_KEYS]))
+    latency = float(sum(fold_latencies[i] for i in subset))
+    return objective, latency, scores
+
+  if SEARCH == 'greedy':
+    candidates = greedy_search(evaluate_subset, len(fold_names))
+  elif SEARCH == 'exhaustive':
+    candidates = exhaustive_search(evaluate_subset, len(fold_names))
+  else:
+    raise ValueError(f'Unknown search strategy: {SEARCH}')
+
+  front = pareto_front(candidates)
+  ensembles = {}
+  for subset, objective, latency, scores in front:
+    name = f'harmonix-top{len(subset)}'
+    ensembles[name] = dict(
+      models=[fold_names[i] for i in subset],
+      objective=objective,
+      latency=latency,
+      scores=scores,
+    )
+
+  print('=> Pareto front (objective vs. latency per track):')
+  pprint({name: (e['models'], round(e['objective'], 4), round(e['latency'], 4)) for name, e in ensembles.items()})
+
+  outpath = mkpath(OUTPATH)
+  outpath.write_text(json.dumps(ensembles, indent=2))
+  print(f'=> Saved the ensembles to {outpath}')
+
+
+def collect_fold_outputs(
+  models: List[torch.nn.Module],
+  batches: List[Dict],
+  device: str,
+) -> Tuple[List[List[AllInOneOutput]], List[float]]:
+  """Returns the logits of every fold for every track, and each fold's mean inference time per track."""
+  fold_outputs = []
+  elapsed = np.zeros(len(models))
+  with torch.no_grad():
+    for batch in tqdm(batches, desc='Running folds'):
+      spec = batch['spec'].float().to(device)
+      outputs = []
+      for i, model in enumerate(models):
+        if device == 'cuda':
+          torch.cuda.synchronize()
+        start = time.perf_counter()
+        output = model(spec)
+        if device == 'cuda':
+          torch.cuda.synchronize()
+        elapsed[i] += time.perf_counter() - start
+        outputs.append(AllInOneOutput(
+          logits_beat=output.logits_beat.cpu(),
+          logits_downbeat=output.logits_downbeat.cpu(),
+          logits_section=output.logits_section.cpu(),
+          logits_function=output.logits_function.cpu(),
+        ))
+      fold_outputs.append(outputs)
+  return fold_outputs, (elapsed / len(batches)).tolist()
+
+
+def average_logits(outputs: List[AllInOneOutput]) -> AllInOneOutput:
+  return AllInOneOutput(
+    logits_beat=torch.stack([output.logits_beat for output in outputs], dim=0).mean(dim=0),
+    logits_downbeat=torch.stack([output.logits_downbeat for output in outputs], dim=0).mean(dim=0),
+    logits_section=torch.stack([output.logits_section for output in outputs], dim=0).mean(dim=0),
+    logits_function=torch.stack([output.logits_function for output in outputs], dim=0).mean(dim=0),
+    num_models=len(outputs),
+  )
+
+
+def greedy_search(evaluate_subset, num_folds: int):
+  """Forward selection: starting from no fold, repeatedly adds the fold that maximizes the objective."""
+  candidates = []
+  subset = []
+  remaining = list(range(num_folds))
+  while remaining:
+    best = None
+    for i in tqdm(remaining, desc=f'Selecting fold #{len(subset) + 1}'):
+      objective, latency, scores = evaluate_subset(subset + [i])
+      if best is None or objective > best[1]:
+        best = (subset + [i], objective, latency, scores)
+    candidates.append(best)
+    subset = best[0]
+    remaining.remove(subset[-1])
+  return candidates
+
+
+def exhaustive_search(evaluate_subset, num_folds: int):
+  candidates = []
+  subsets = [
+    list(subset)
+    for size in range(1, num_folds + 1)
+    for subset in itertools.combinations(range(num_folds), size)
+  ]
+  for subset in tqdm(subsets, desc='Evaluating subsets'):
+    candidates.append((subset, *evaluate_subset(subset)))
+  return candidates
+
+
+def pareto_front(candidates):
+  """Keeps, for each subset size, the best subset, and drops those beaten by a faster subset."""
+  best_per_size = {}
+  for candidate in candidates:
+    size = len(candidate[0])
+    if size not in best_per_size or candidate[1] > best_per_size[size][1]:
+      best_per_size[size] = candidate
+
+  front = []
+  for candidate in sorted(best_per_size.values(), key=lambda c: c[2]):
+    if not front or candidate[1] > front[-1][1]:
+      front.append(candidate)
+  return front
+
+
+if __name__ == '__main__':
+  main()
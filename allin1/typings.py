@@ -10,6 +10,10 @@ from numpy.typing import NDArray
 
 PathLike = Union[str, PathLike]
 
+# beats: beats, downbeats and BPM from the beat and downbeat heads.
+# segments: segment boundaries and labels from the section and function heads.
+TASKS = ['beats', 'segments']
+
 
 @dataclass
 class AllInOneOutput:
@@ -18,6 +22,8 @@ class AllInOneOutput:
   logits_section: torch.FloatTensor = None
   logits_function: torch.FloatTensor = None
   embeddings: torch.FloatTensor = None
+  num_models: Optional[int] = None  # Number of ensemble folds the logits were averaged over.
+  hidden_state_levels: Optional[List[torch.FloatTensor]] = None  # Outputs of the encoder layers asked for.
 
 
 @dataclass
@@ -37,6 +43,7 @@ class AnalysisResult:
   segments: List[Segment]
   activations: Optional[Dict[str, NDArray]] = None
   embeddings: Optional[NDArray] = None
+  num_models: Optional[int] = None
 
   @staticmethod
   def from_json(
@@ -57,6 +64,7 @@ class AnalysisResult:
       downbeats=data['downbeats'],
       beat_positions=data['beat_positions'],
       segments=[Segment(**seg) for seg in data['segments']],
+      num_models=data.get('num_models'),
     )
 
     if load_activations:
@@ -40,11 +40,52 @@ class Output(BaseModel):
     bpm: Optional[float]
 
 
+MODEL_CHOICES = ["harmonix-all", "harmonix-fold0", "harmonix-fold1", "harmonix-fold2", "harmonix-fold3", "harmonix-fold4", "harmonix-fold5", "harmonix-fold6", "harmonix-fold7"]
+
+# Models loaded (and warmed up) once in setup instead of on every prediction
+PRELOAD_MODELS = ["harmonix-all"]
+
+# Set to "inductor" or "torchscript" to serve compiled models; every graph is compiled (or loaded from the on-disk
+# cache) during setup, so no request pays for compilation
+COMPILE_MODE = os.environ.get("ALLIN1_COMPILE_MODE") or None
+
+# Format of the returned demucs stems; "flac" has the samples of the 16-bit "wav" at about half the size and egress
+STEM_FORMAT = os.environ.get("ALLIN1_STEM_FORMAT") or "wav"
+
+
 class Predictor(BasePredictor):
     def setup(self):
         """Load the model into memory to make running multiple predictions efficient"""
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
+        self.models = {}
+        for model_name in PRELOAD_MODELS:
+            self.get_model(model_name)
+
+        # Load HTDemucs once; analyze() reuses this engine for every request (same repo and device)
+        self.demix_engine = allin1.get_demix_engine(
+            repo=allin1.demix.default_repo(Path("demix").resolve()),
+            device=self.device,
+        )
+
+    def get_model(self, model_name):
+        # Reuse the resident model, loading and warming it up on first use only
+        if model_name not in self.models:
+            model = allin1.load_pretrained_model(model_name=model_name, device=self.device, compile_mode=COMPILE_MODE)
+            self.warmup_model(model)
+            self.models[model_name] = model
+        return self.models[model_name]
+
+    def warmup_model(self, model, num_frames=1000):
+        # One dummy forward pass so the first real request does not pay for lazy kernel/allocator init
+        if isinstance(model, allin1.models.CompiledModel):
+            model.warmup(self.device)
+            return
+        num_instruments = model.cfg.data.num_instruments
+        spec = torch.zeros(1, num_instruments, num_frames, model.cfg.dim_input, device=self.device)
+        with torch.no_grad():
+            model(spec)
+
     def predict(
         self,
         music_input: Path = Input(
@@ -70,7 +111,7 @@ class Predictor(BasePredictor):
         model: str = Input(
             description="Name of the pretrained model to use",
             default="harmonix-all",
-            choices=["harmonix-all", "harmonix-fold0", "harmonix-fold1", "harmonix-fold2", "harmonix-fold3", "harmonix-fold4", "harmonix-fold5", "harmonix-fold6", "harmonix-fold7"]
+            choices=MODEL_CHOICES
         ),
         include_activations: bool = Input(
             description="Whether to include activations in the analysis results or not.",
@@ -80,6 +121,11 @@ class Predictor(BasePredictor):
             description="Whether to include embeddings in the analysis results or not.",
             default=False,
         ),
+        tasks: str = Input(
+            description="Tasks to compute: 'beats' (beats, downbeats, BPM) or 'segments' (sections) skip the other task's heads and postprocessing",
+            default="all",
+            choices=["all", "beats", "segments"],
+        ),
         audioSeparator: bool = Input(
             description="Separate the audio into vocals and instrumental with MDX-net (best for music)",
             default=False
@@ -113,7 +159,7 @@ class Predictor(BasePredictor):
             if audioSeparator:
                 futures.append(executor.submit(self.run_separator, audioSeparatorModel, music_input))
 
-            futures.append(executor.submit(self.run_allin1_analyze, music_input, visualize, sonify, model, include_activations, include_embeddings))
+            futures.append(executor.submit(self.run_allin1_analyze, music_input, visualize, sonify, model, include_activations, include_embeddings, tasks))
 
             for future in as_completed(futures):
                 output_dir.update(future.result())
@@ -160,7 +206,7 @@ class Predictor(BasePredictor):
 
         return separator_output_dir
 
-    def run_allin1_analyze(self, music_input, visualize, sonify, model, include_activations, include_embeddings):
+    def run_allin1_analyze(self, music_input, visualize, sonify, model, include_activations, include_embeddings, tasks="all"):
         allin1_output_dir = {}
 
         # Load audio with higher sample rate for better temporal resolution
@@ -206,14 +252,14 @@ class Predictor(BasePredictor):
             
         allin1_output_dir["bpm"] = final_tempo
 
-        allin1.analyze(paths=music_input, out_dir='output', visualize=visualize, sonify=sonify, model=model, device=self.device, include_activations=include_activations, include_embeddings=include_embeddings, keep_byproducts=True, )
+        allin1.analyze(paths=music_input, out_dir='output', visualize=visualize, sonify=sonify, model=self.get_model(model), device=self.device, include_activations=include_activations, include_embeddings=include_embeddings, tasks=None if tasks == "all" else [tasks], keep_byproducts=True, stem_format=STEM_FORMAT, )
         
         music_input_name = str(music_input).rsplit('/', 1)[-1].rsplit('.', 1)[0]
 
         # add to output_dir all files in demix/htdemucs/music_input_name if folder exists
         if os.path.isdir('demix/htdemucs/'+music_input_name):
             for dirpath, dirnames, filenames in os.walk('demix/htdemucs/'+music_input_name):
-                for filename in [f for f in filenames if f.rsplit('.', 1)[-1] == "wav"]:
+                for filename in [f for f in filenames if f.rsplit('.', 1)[-1] == STEM_FORMAT]:
                     demix_dir = os.path.join(dirpath, filename)
                     print("Will add to output: ", demix_dir)
                     # get only name without file extension
@@ -0,0 +1,33 @@
+import pytest
+
+
+@pytest.fixture
+def random_model():
+    """Builds AllInOne folds with random weights on the pure-PyTorch attention, without any pretrained download."""
+    torch = pytest.importorskip("torch")
+    from allin1.config import Config, HarmonixConfig
+    from allin1.models.allinone import AllInOne
+    from allin1.models.dinat import set_attention_backend
+
+    def make(seed=0, **overrides):
+        torch.manual_seed(seed)
+        model = AllInOne(Config(data=HarmonixConfig(), **overrides)).eval()
+        # Larger than the initial weights, so that every layer visibly changes the outputs.
+        with torch.no_grad():
+            for module in model.modules():
+                if hasattr(module, "rpb") or isinstance(module, torch.nn.Linear):
+                    for param in module.parameters():
+                        param.normal_(0, 0.2)
+        return set_attention_backend(model, "torch")
+
+    return make
+
+
+def assert_outputs_close(actual, expected, rtol=1e-4, atol=1e-4, keys=None):
+    import torch
+
+    keys = keys or ["logits_beat", "logits_downbeat", "logits_section", "logits_function", "embeddings"]
+    for key in keys:
+        if getattr(expected, key) is None:
+            continue
+        torch.testing.assert_close(getattr(actual, key), getattr(expected, key), rtol=rtol, atol=atol, msg=key)
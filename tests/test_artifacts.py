@@ -0,0 +1,89 @@
+import os
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("madmom")
+
+from allin1.artifacts import EVICTION_GRACE, ArtifactStore, hash_audio
+
+
+def write_bytes(size):
+    def write(directory):
+        (directory / "data.bin").write_bytes(b"\0" * size)
+    return write
+
+
+def test_key_depends_on_audio_and_config(tmp_path):
+    a, b = tmp_path / "a" / "track.mp3", tmp_path / "b" / "track.mp3"
+    for path, content in [(a, b"one"), (b, b"two")]:
+        path.parent.mkdir()
+        path.write_bytes(content)
+
+    assert hash_audio(a) != hash_audio(b)
+    key = ArtifactStore.key(hash_audio(a), "spec", {"fps": 100})
+    assert key == ArtifactStore.key(hash_audio(a), "spec", {"fps": 100})
+    assert key != ArtifactStore.key(hash_audio(b), "spec", {"fps": 100})
+    assert key != ArtifactStore.key(hash_audio(a), "spec", {"fps": 50})
+
+
+def test_put_get_and_lru_eviction(tmp_path):
+    old = ArtifactStore(tmp_path)
+    for i in range(3):
+        old.put("spec", f"{i:032d}", write_bytes(1000))
+    # Entry 0 was used most recently by the old run, entry 1 least recently.
+    for i, age in [(0, EVICTION_GRACE + 10), (1, EVICTION_GRACE + 30), (2, EVICTION_GRACE + 20)]:
+        entry_dir = old.entry_dir("spec", f"{i:032d}")
+        os.utime(entry_dir, (entry_dir.stat().st_mtime - age,) * 2)
+
+    store = ArtifactStore(tmp_path, max_bytes=2500)
+    entry_dir = store.put("spec", f"{3:032d}", write_bytes(1000))
+    assert (entry_dir / "data.bin").is_file()
+    assert store.get("spec", f"{1:032d}") is None
+    assert store.get("spec", f"{2:032d}") is None
+    assert store.get("spec", f"{0:032d}") is not None
+    assert not any(store.tmp_dir.iterdir())
+
+
+def test_entries_used_by_other_processes_are_kept(tmp_path):
+    """Entries another process used within the grace period survive, even from before this store was opened."""
+    other = ArtifactStore(tmp_path)
+    for i, age in [(0, EVICTION_GRACE + 10), (1, 10)]:
+        entry_dir = other.put("spec", f"{i:032d}", write_bytes(1000))
+        os.utime(entry_dir, (entry_dir.stat().st_mtime - age,) * 2)
+
+    store = ArtifactStore(tmp_path, max_bytes=1500)
+    store.put("spec", f"{2:032d}", write_bytes(1000))
+    assert store.get("spec", f"{0:032d}") is None
+    assert store.get("spec", f"{1:032d}") is not None
+    assert store.get("spec", f"{2:032d}") is not None
+
+
+def test_entries_of_a_long_run_are_evicted_unless_pinned(tmp_path, monkeypatch):
+    """Entries this store put are evicted once past the grace period, unless a later step still needs them."""
+    import allin1.artifacts
+    from types import SimpleNamespace
+
+    now = [1e9]
+    monkeypatch.setattr(allin1.artifacts, "time", SimpleNamespace(time=lambda: now[0]))
+    store = ArtifactStore(tmp_path, max_bytes=2500)
+    for i in range(3):
+        store.put("spec", f"{i:032d}", write_bytes(1000))
+        now[0] += 1
+    store.pin(store.entry_dir("spec", f"{0:032d}"))
+
+    now[0] += EVICTION_GRACE
+    store.put("spec", f"{3:032d}", write_bytes(1000))
+    assert store.get("spec", f"{0:032d}") is not None
+    assert store.get("spec", f"{1:032d}") is None
+    assert store.get("spec", f"{2:032d}") is None
+    assert store.get("spec", f"{3:032d}") is not None
+
+
+def test_index_is_read_once(tmp_path, monkeypatch):
+    store = ArtifactStore(tmp_path, max_bytes=10 ** 6)
+    scans = []
+    entries = store.entries
+    monkeypatch.setattr(store, "entries", lambda: scans.append(1) or entries())
+    for i in range(5):
+        store.put("spec", f"{i:032d}", write_bytes(1000))
+    assert len(scans) == 1
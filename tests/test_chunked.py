@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from allin1.helpers import min_chunk_overlap, run_model_chunked
+from conftest import assert_outputs_close
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_chunked_matches_whole(random_model, batch_size):
+    """With the default overlap, every stitched frame sees its whole receptive field."""
+    model = random_model(depth=4)
+    chunk_size = min_chunk_overlap(model.cfg) + 160
+    spec = torch.randn(1, 4, 7 * chunk_size + 11, 81)
+    with torch.no_grad():
+        expected = model(spec)
+        actual = run_model_chunked(model, spec, chunk_size, batch_size=batch_size, include_embeddings=True)
+    assert_outputs_close(actual, expected)
+
+
+def test_chunk_overlap_below_receptive_field_is_rejected(random_model):
+    model = random_model(depth=4)
+    spec = torch.randn(1, 4, 1000, 81)
+    with pytest.raises(AssertionError):
+        run_model_chunked(model, spec, 300, chunk_overlap=min_chunk_overlap(model.cfg) - 1)
@@ -0,0 +1,30 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from allin1.models.compiled import CompiledModel
+from conftest import assert_outputs_close
+
+
+@pytest.mark.parametrize("num_frames", [3, 300, 3000, 12000])
+def test_torchscript_matches_eager(tmp_path, random_model, num_frames):
+    """Inputs are not padded, and a graph traced at one length serves the other lengths that pad the same layers."""
+    model = random_model()
+    compiled = CompiledModel(model, "torchscript", tmp_path)
+    for length in [num_frames, num_frames + 1]:
+        spec = torch.randn(1, 4, length, 81)
+        with torch.no_grad():
+            expected = model(spec)
+            actual = compiled(spec)
+        assert_outputs_close(actual, expected)
+    assert len(compiled.traced) <= 1
+
+
+def test_torchscript_leaves_model_untouched(tmp_path, random_model):
+    """The model may be shared, e.g. by the model registry, so tracing must not switch its attention backend."""
+    pytest.importorskip("natten")
+    from allin1.models.dinat import set_attention_backend
+
+    model = set_attention_backend(random_model(), "natten")
+    CompiledModel(model, "torchscript", tmp_path).warmup()
+    assert {module.backend for module in model.modules() if hasattr(module, "attention_ndim")} == {"natten"}
@@ -0,0 +1,195 @@
+"""CPU parity of the inference paths against the eager model, on small random-weight folds (no downloads)."""
+
+import json
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from omegaconf import OmegaConf
+from allin1.helpers import load_logits, run_model_sparse, save_logits
+from allin1.models.ensemble import average_outputs
+from allin1.models.fused import fuse_model
+from allin1.models.loaders import ENSEMBLE_MODELS, load_pretrained_model
+from allin1.models.quantization import quantize_model
+from allin1.models.store import MANIFEST_FILE
+from conftest import assert_outputs_close
+
+DEPTH = 4
+
+
+@pytest.fixture
+def store(tmp_path, random_model):
+    """A model store holding random folds under the names of the pretrained Harmonix folds."""
+    manifest = {}
+    for seed, fold_name in enumerate(ENSEMBLE_MODELS["harmonix-all"]):
+        model = random_model(seed=seed, depth=DEPTH)
+        torch.save(model.state_dict(), tmp_path / f"{fold_name}.pt")
+        manifest[fold_name] = dict(
+            file=f"{fold_name}.pt",
+            config=OmegaConf.to_container(OmegaConf.structured(model.cfg)),
+            thresholds=dict(beat=0.2 + 0.01 * seed, downbeat=0.3),
+        )
+    (tmp_path / MANIFEST_FILE).write_text(json.dumps(manifest))
+    return tmp_path
+
+
+def load(store, model_name="harmonix-all", **kwargs):
+    return load_pretrained_model(model_name, device="cpu", cached=False, store_dir=store, **kwargs)
+
+
+def spectrogram(num_frames=500, seed=1):
+    return torch.randn(1, 4, num_frames, 81, generator=torch.Generator().manual_seed(seed))
+
+
+@torch.no_grad()
+def test_store_folds_match_ensemble(store):
+    ensemble = load(store)
+    folds = [load(store, fold_name) for fold_name in ENSEMBLE_MODELS["harmonix-all"]]
+    spec = spectrogram()
+    expected = average_outputs([fold(spec) for fold in folds])
+    assert_outputs_close(ensemble(spec), expected)
+    assert ensemble.cfg.best_threshold_beat == pytest.approx(0.235)
+
+
+@torch.no_grad()
+def test_store_loads_without_mmap(store, monkeypatch):
+    """torch < 2.1 cannot memory-map or assign the stored tensors, and copies them instead."""
+    import allin1.models.store
+
+    expected = load(store, "harmonix-fold0")
+    monkeypatch.setattr(allin1.models.store, "MMAP_SUPPORTED", False)
+    monkeypatch.setattr(allin1.models.store, "ASSIGN_SUPPORTED", False)
+    spec = spectrogram()
+    assert_outputs_close(load(store, "harmonix-fold0")(spec), expected(spec), rtol=0, atol=0)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("ensemble_mode", ["batched", "adaptive"])
+def test_ensemble_modes_match_serial(store, ensemble_mode):
+    """The adaptive ensemble evaluates every fold with a zero tolerance."""
+    serial = load(store)
+    model = load(store, ensemble_mode=ensemble_mode, ensemble_tolerance=0.)
+    spec = spectrogram()
+    actual = model(spec)
+    assert_outputs_close(actual, serial(spec))
+    assert actual.num_models == 8
+
+
+@torch.no_grad()
+def test_adaptive_ensemble_stops_early(store):
+    model = load(store, ensemble_mode="adaptive", ensemble_tolerance=1.)
+    folds = [load(store, fold_name) for fold_name in ENSEMBLE_MODELS["harmonix-all"][:2]]
+    spec = spectrogram()
+    actual = model(spec)
+    assert actual.num_models == 2
+    assert_outputs_close(actual, average_outputs([fold(spec) for fold in folds]))
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("model_name", ["harmonix-fold0", "harmonix-all"])
+def test_fused_matches_eager(store, model_name):
+    model = load(store, model_name)
+    spec = spectrogram()
+    assert_outputs_close(fuse_model(model)(spec), model(spec))
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("tasks", [["beats"], ["segments"]])
+@pytest.mark.parametrize("fused", [False, True])
+def test_tasks_match_all_tasks(random_model, tasks, fused):
+    model = random_model(depth=DEPTH)
+    if fused:
+        model = fuse_model(model)
+    spec = spectrogram()
+    expected = model(spec)
+    actual = model(spec, tasks=tasks, include_embeddings=False)
+    keys = ["logits_beat", "logits_downbeat"] if tasks == ["beats"] else ["logits_section", "logits_function"]
+    assert_outputs_close(actual, expected, keys=keys)
+    skipped = [key for key in ["logits_beat", "logits_section", "embeddings"] if key not in keys]
+    assert all(getattr(actual, key) is None for key in skipped)
+
+
+@torch.no_grad()
+def test_output_levels_match_encoder_layers(random_model):
+    model = random_model(depth=DEPTH)
+    spec = spectrogram()
+    N, K, T, F = spec.shape
+    hidden_states = model.embeddings(spec.reshape(-1, 1, T, F))
+    layer_outputs = []
+    for layer in model.encoder.layers:
+        hidden_states = layer(hidden_states)[0]
+        layer_outputs.append(hidden_states.reshape(N, K, T, -1))
+
+    output = model(spec, output_levels=[1, -1])
+    torch.testing.assert_close(output.hidden_state_levels[0], layer_outputs[1])
+    torch.testing.assert_close(output.hidden_state_levels[1], layer_outputs[-1])
+    assert model(spec).hidden_state_levels is None
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("fused", [False, True])
+def test_quantized_close_to_eager(random_model, fused):
+    """int8 weights are approximate: the logits must stay highly correlated with the fp32 ones."""
+    model = random_model(depth=DEPTH)
+    spec = spectrogram()
+    expected = model(spec)
+    actual = quantize_model(fuse_model(model) if fused else model)(spec)
+    for key in ["logits_beat", "logits_downbeat", "logits_section", "logits_function"]:
+        logits = torch.stack([getattr(actual, key).flatten(), getattr(expected, key).flatten()])
+        assert torch.corrcoef(logits)[0, 1] > 0.98
+
+
+@torch.no_grad()
+def test_torch_attention_matches_natten(random_model):
+    pytest.importorskip("natten")
+    from allin1.models.dinat import set_attention_backend
+
+    model = random_model(depth=DEPTH)
+    spec = spectrogram()
+    expected = model(spec)
+    assert_outputs_close(set_attention_backend(model, "natten")(spec), expected)
+
+
+@torch.no_grad()
+def test_padded_batch_matches_single_tracks(random_model):
+    """Zero-padding a shorter track in a batch only changes its frames within a receptive field of its end."""
+    from allin1.helpers import receptive_field
+
+    model = random_model(depth=DEPTH)
+    long, short = spectrogram(500, seed=1), spectrogram(400, seed=2)
+    batch = torch.cat([long, torch.nn.functional.pad(short, (0, 0, 0, 100))])
+    output = model(batch)
+    expected = model(long)
+    torch.testing.assert_close(output.logits_beat[:1], expected.logits_beat, rtol=1e-4, atol=1e-4)
+    expected = model(short)
+    end = 400 - receptive_field(model.cfg)
+    torch.testing.assert_close(output.logits_beat[1:, :end], expected.logits_beat[:, :end], rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(output.embeddings[1:, :, :end], expected.embeddings[:, :, :end], rtol=1e-4, atol=1e-4)
+
+
+@torch.no_grad()
+def test_sparse_matches_regions(random_model):
+    model = random_model(depth=DEPTH)
+    spec = spectrogram()
+    assert_outputs_close(run_model_sparse(model, spec, [(0, 500)], include_embeddings=True), model(spec))
+
+    output = run_model_sparse(model, spec, [(0, 200), (350, 500)], include_embeddings=True)
+    for start, end in [(0, 200), (350, 500)]:
+        expected = model(spec[:, :, start:end])
+        torch.testing.assert_close(output.logits_beat[:, start:end], expected.logits_beat, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(
+            output.logits_function[:, :, start:end], expected.logits_function, rtol=1e-4, atol=1e-4
+        )
+    assert (torch.sigmoid(output.logits_beat[:, 200:350]) < 1e-6).all()
+
+
+@torch.no_grad()
+def test_logits_cache_round_trip(tmp_path, store):
+    model = load(store)
+    logits = model(spectrogram(), include_embeddings=False)
+    cache_path = save_logits(tmp_path / "track.mp3", logits, model.cfg, tmp_path / "logits")
+    path, loaded, cfg = load_logits(cache_path)
+    assert path == tmp_path / "track.mp3"
+    assert loaded.num_models == 8
+    assert cfg.best_threshold_beat == model.cfg.best_threshold_beat
+    assert_outputs_close(loaded, logits, rtol=0, atol=0)
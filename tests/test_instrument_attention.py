@@ -0,0 +1,53 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from allin1.config import Config, HarmonixConfig
+from allin1.models.allinone import AllInOne
+from allin1.models.dinat import set_attention_backend, set_dense_instruments
+from allin1.models.fused import fuse_model
+from allin1.models.neighborhood import instrument_av, instrument_qk_rpb, na2d_av, na2d_qk_rpb
+
+
+def pad_instruments(x, bias, kernel_size):
+    B, H, K, T, D = x.shape
+    return torch.cat([x, bias[None, :, None, None, :].expand(B, H, kernel_size - K, T, D)], dim=2)
+
+
+@pytest.mark.parametrize("num_frames", [5, 7, 300])
+def test_dense_matches_padded_2d_attention(num_frames):
+    """The dense instrument attention equals the 2D attention over instruments zero-padded to the kernel size."""
+    torch.manual_seed(0)
+    kernel_size, shape = 5, (2, 3, 4, num_frames, 8)
+    query, key, value = torch.randn(shape), torch.randn(shape), torch.randn(shape)
+    key_bias, value_bias = torch.randn(3, 8), torch.randn(3, 8)
+    rpb = torch.randn(3, 2 * kernel_size - 1, 2 * kernel_size - 1)
+
+    padded_query = pad_instruments(query, torch.zeros(3, 8), kernel_size)
+    attention = na2d_qk_rpb(padded_query, pad_instruments(key, key_bias, kernel_size), rpb, kernel_size, 1)
+    expected = na2d_av(attention.softmax(-1), pad_instruments(value, value_bias, kernel_size), kernel_size, 1)
+
+    attention = instrument_qk_rpb(query, key, rpb, kernel_size, key_bias)
+    actual = instrument_av(attention.softmax(-1), value, kernel_size, value_bias)
+    torch.testing.assert_close(actual, expected[:, :, :4], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_model_outputs_unchanged(fused):
+    """Models give the same logits with and without the dense instrument attention."""
+    torch.manual_seed(0)
+    model = set_attention_backend(AllInOne(Config(data=HarmonixConfig())).eval(), "torch")
+    with torch.no_grad():
+        for module in model.modules():
+            if hasattr(module, "rpb") or isinstance(module, torch.nn.Linear):
+                for param in module.parameters():
+                    param.normal_(0, 0.2)
+    if fused:
+        model = fuse_model(model)
+
+    spec = torch.randn(1, 4, 3000, 81)
+    with torch.no_grad():
+        dense = model(spec)
+        padded = set_dense_instruments(model, False)(spec)
+    torch.testing.assert_close(dense.logits_beat, padded.logits_beat, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(dense.logits_function, padded.logits_function, rtol=1e-4, atol=1e-4)
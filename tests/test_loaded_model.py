@@ -0,0 +1,19 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from allin1 import analyze
+
+
+@pytest.mark.parametrize("options", [
+    dict(fused=True),
+    dict(quantize="int8"),
+    dict(attention_backend="torch"),
+    dict(compile_mode="torchscript"),
+    dict(ensemble_mode="batched"),
+    dict(backend="onnxruntime"),
+])
+def test_loading_options_conflict_with_loaded_model(random_model, options):
+    """Loading options are rejected for an already-loaded model instead of being silently ignored."""
+    with pytest.raises(ValueError, match=next(iter(options))):
+        analyze("track.mp3", model=random_model(depth=2), **options)
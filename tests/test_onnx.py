@@ -0,0 +1,21 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from allin1.models.export import OnnxModel, export_onnx, min_frames
+from conftest import assert_outputs_close
+
+
+@pytest.mark.parametrize("num_frames", [7, 300, 3000, 12000])
+def test_onnx_matches_eager(tmp_path, random_model, num_frames):
+    """Short tracks too: layers whose window is longer than the track pad it inside the graph, as in eager mode."""
+    model = random_model()
+    assert num_frames >= min_frames(model)
+    path = export_onnx(model, tmp_path / "fold.onnx")
+
+    spec = torch.randn(1, 4, num_frames, 81)
+    with torch.no_grad():
+        expected = model(spec)
+    assert_outputs_close(OnnxModel(path)(spec), expected)
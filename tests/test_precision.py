@@ -0,0 +1,68 @@
+import pytest
+import numpy as np
+
+torch = pytest.importorskip("torch")
+madmom = pytest.importorskip("madmom")
+
+from madmom.evaluation.beats import BeatEvaluation
+from madmom.evaluation.onsets import OnsetEvaluation
+from allin1.helpers import autocast
+from allin1.postprocessing import postprocess_metrical_structure, postprocess_functional_structure
+
+
+@pytest.fixture(scope="module")
+def model():
+    """A pretrained fold with the pure-PyTorch attention, which runs in bf16 on CPU."""
+    from allin1.models import load_pretrained_model
+    try:
+        return load_pretrained_model("harmonix-fold0", device="cpu", attention_backend="torch")
+    except Exception as e:
+        pytest.skip(f"Pretrained model is not available: {e}")
+
+
+@pytest.fixture(scope="module")
+def spec():
+    """60 seconds of a 120 BPM pulse with an accent every 4 beats and a change of texture halfway."""
+    rng = np.random.default_rng(0)
+    num_frames, fps = 6000, 100
+    spec = rng.random((4, num_frames, 81), dtype=np.float32) * 0.1
+    for i, frame in enumerate(range(0, num_frames, fps // 2)):
+        gain = 1.0 if i % 4 == 0 else 0.6
+        spec[1, frame:frame + 3] += gain  # drums
+        spec[0, frame:frame + 20, :20] += 0.5 * gain  # bass
+    spec[2:, num_frames // 2:] += 0.3  # other and vocals enter
+    return torch.from_numpy(spec).unsqueeze(0)
+
+
+def run(model, spec, precision):
+    with torch.no_grad(), autocast("cpu", precision):
+        return model(spec)
+
+
+def test_bf16_logits_are_fp32(model, spec):
+    logits = run(model, spec, "bf16")
+    assert logits.logits_beat.dtype == torch.float32
+    assert logits.logits_function.dtype == torch.float32
+    assert logits.embeddings.dtype == torch.float32
+
+
+def test_bf16_parity_with_fp32(model, spec):
+    """Beats, downbeats and segment boundaries of bf16 inference match those of fp32."""
+    logits_fp32 = run(model, spec, "fp32")
+    logits_bf16 = run(model, spec, "bf16")
+
+    prob_fp32 = torch.sigmoid(logits_fp32.logits_beat)
+    prob_bf16 = torch.sigmoid(logits_bf16.logits_beat)
+    assert (prob_fp32 - prob_bf16).abs().max().item() < 0.05
+
+    metrical_fp32 = postprocess_metrical_structure(logits_fp32, model.cfg)
+    metrical_bf16 = postprocess_metrical_structure(logits_bf16, model.cfg)
+    assert BeatEvaluation(metrical_bf16["beats"], metrical_fp32["beats"]).fmeasure >= 0.95
+    assert BeatEvaluation(metrical_bf16["downbeats"], metrical_fp32["downbeats"]).fmeasure >= 0.9
+
+    segments_fp32 = postprocess_functional_structure(logits_fp32, model.cfg)
+    segments_bf16 = postprocess_functional_structure(logits_bf16, model.cfg)
+    boundaries_fp32 = np.array([segment.start for segment in segments_fp32[1:]])
+    boundaries_bf16 = np.array([segment.start for segment in segments_bf16[1:]])
+    if len(boundaries_fp32) or len(boundaries_bf16):
+        assert OnsetEvaluation(boundaries_bf16, boundaries_fp32, window=0.5).fmeasure >= 0.9
@@ -0,0 +1,48 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from allin1.models.loaders import MODEL_REGISTRY, ModelRegistry, load_pretrained_model
+
+
+def backends(model):
+    return {module.backend for module in model.modules() if hasattr(module, "attention_ndim")}
+
+
+def test_attention_backend_does_not_switch_shared_model(random_model):
+    """Another backend gets its own registry entry, which shares the weights of the cached model."""
+    pytest.importorskip("natten")
+    from allin1.models.dinat import set_attention_backend
+
+    model = set_attention_backend(random_model(), "natten")
+    MODEL_REGISTRY.clear()
+    MODEL_REGISTRY.put("harmonix-fold0", "cpu", model)
+    try:
+        switched = load_pretrained_model("harmonix-fold0", device="cpu", attention_backend="torch")
+        assert backends(switched) == {"torch"}
+        assert backends(model) == {"natten"}
+        assert load_pretrained_model("harmonix-fold0", device="cpu") is model
+        assert load_pretrained_model("harmonix-fold0", device="cpu", attention_backend="torch") is switched
+        assert all(a is b for a, b in zip(switched.parameters(), model.parameters()))
+    finally:
+        MODEL_REGISTRY.clear()
+
+
+def test_ensemble_is_evicted_with_its_folds(random_model):
+    """Evicting a fold held by a cached ensemble frees nothing, so the ensemble's entries count as one."""
+    folds = [random_model(seed=seed, depth=2) for seed in range(4)]
+    registry = ModelRegistry(max_memory=None)
+    registry.put("fold0", "cpu", folds[0])
+    registry.put("fold1", "cpu", folds[1])
+    registry.put("other", "cpu", folds[2])
+    registry.put("all", "cpu", torch.nn.ModuleList(folds[:2]))
+    fold_nbytes = registry.memory_usage() // 3
+
+    registry.max_memory = 3.5 * fold_nbytes
+    registry.put("newest", "cpu", folds[3])
+    assert registry.keys() == [("fold0", "cpu"), ("fold1", "cpu"), ("all", "cpu"), ("newest", "cpu")]
+
+    registry.max_memory = 1.5 * fold_nbytes
+    registry.get("fold0", "cpu")
+    registry.put("other", "cpu", folds[2])
+    assert registry.keys() == [("other", "cpu")]
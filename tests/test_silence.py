@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from allin1.helpers import find_active_regions
+
+
+def spectrogram(levels):
+    """A (stems, frames, bins) log10(1 + magnitude) spectrogram whose loudest bin per frame has the given level."""
+    spec = np.zeros((4, len(levels), 81), dtype=np.float32)
+    spec[1, :, 10] = np.log10(1 + np.asarray(levels))
+    return spec
+
+
+@pytest.mark.parametrize("gap_db, silent", [(-66, True), (-54, False)])
+def test_gap_against_threshold(gap_db, silent):
+    levels = np.full(3000, 1000.)
+    levels[1000:2500] = 1000. * 10 ** (gap_db / 20)
+    regions = find_active_regions(spectrogram(levels), fps=100, threshold_db=-60, min_silence=10, margin=2)
+    assert regions == ([(0, 1200), (2300, 3000)] if silent else [(0, 3000)])
+
+
+def test_short_gaps_and_silent_edges():
+    levels = np.full(6000, 50.)
+    levels[:1500] = 0       # leading silence: no margin on the outer side
+    levels[3000:3500] = 0   # shorter than min_silence: kept
+    levels[4500:] = 0       # trailing silence
+    regions = find_active_regions(spectrogram(levels), fps=100, min_silence=10, margin=2)
+    assert regions == [(1300, 4700)]
+
+
+def test_all_silent_track_is_kept_whole():
+    assert find_active_regions(spectrogram(np.zeros(500)), fps=100) == [(0, 500)]
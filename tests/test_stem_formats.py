@@ -0,0 +1,24 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("demucs")
+
+from allin1.demix import STEMS, delete_stems, find_stem, read_f16, save_stems
+
+
+def test_f16_round_trip(tmp_path):
+    # Small enough that no sample clips, so the stems are not rescaled.
+    torch.manual_seed(0)
+    stems = {stem: 0.1 * torch.randn(2, 44100) for stem in STEMS}
+    save_stems(stems, tmp_path, 44100, "f16")
+
+    for stem, source in stems.items():
+        path = find_stem(tmp_path, stem)
+        assert path.name == f"{stem}.f16"
+        assert path.stat().st_size == source.numel() * 2
+        data, sample_rate = read_f16(path)
+        assert sample_rate == 44100
+        torch.testing.assert_close(torch.from_numpy(data), source, rtol=2**-11, atol=2**-24)
+
+    delete_stems(tmp_path)
+    assert not any(tmp_path.iterdir())
@@ -0,0 +1,68 @@
+import shutil
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("madmom")
+pytest.importorskip("demucs")
+
+from allin1.demix import STEMS, StemWriter, read_f16, save_stems
+from allin1.spectrogram import make_processor, spectrogram_from_files, spectrogram_from_stems, spectrogram_from_stream
+
+
+def random_stems(num_samples, scale=0.1):
+    torch.manual_seed(0)
+    return {stem: scale * torch.randn(2, num_samples) for stem in STEMS}
+
+
+def read_stem(path):
+    if path.suffix == ".f16":
+        return torch.from_numpy(read_f16(path)[0])
+    from demucs.separate import load_track
+    return load_track(path, 2, 44100)
+
+
+def split(stems, piece_size):
+    num_samples = stems[STEMS[0]].shape[-1]
+    for start in range(0, num_samples, piece_size):
+        yield {stem: source[:, start:start + piece_size] for stem, source in stems.items()}
+
+
+@pytest.mark.parametrize("piece_size", [1000, 44100, 100000])
+@pytest.mark.parametrize("scale", [0.1, 1.0])
+def test_streamed_spectrogram_matches_whole(piece_size, scale):
+    """Pieces of any size give the spectrogram of the whole stems, also when they are rescaled for clipping."""
+    stems = random_stems(3 * 44100 + 123, scale)
+    expected = spectrogram_from_stems(stems, 44100, make_processor())
+    actual = spectrogram_from_stream(split(stems, piece_size), 44100)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_in_memory_spectrogram_matches_files(tmp_path):
+    """Stems handed over in memory give the spectrogram of their 16-bit WAVs, up to quantization."""
+    stems = random_stems(2 * 44100 + 7, scale=1.0)
+    save_stems(stems, tmp_path, 44100, "wav")
+    expected = spectrogram_from_files(tmp_path, make_processor())
+    actual = spectrogram_from_stems(stems, 44100, make_processor())
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=2e-3)
+
+
+@pytest.mark.parametrize("stem_format", ["wav", "flac", "f16"])
+def test_stem_writer_matches_save_stems(tmp_path, stem_format):
+    if stem_format == "flac" and shutil.which("ffmpeg") is None:
+        pytest.skip("ffmpeg is needed to write FLAC")
+    stems = random_stems(2 * 44100 + 7)
+    save_stems(stems, tmp_path / "whole", 44100, stem_format)
+    writer = StemWriter(tmp_path / "streamed", 44100, stem_format)
+    for piece in split(stems, 30000):
+        writer.write(piece)
+    writer.close()
+
+    assert sorted(p.name for p in (tmp_path / "streamed").iterdir()) == \
+        sorted(p.name for p in (tmp_path / "whole").iterdir())
+    for stem in STEMS:
+        expected = read_stem(tmp_path / "whole" / f"{stem}.{stem_format}")
+        actual = read_stem(tmp_path / "streamed" / f"{stem}.{stem_format}")
+        torch.testing.assert_close(actual, expected, rtol=0, atol=2 / 2**15)